@@ -1,5 +1,6 @@
 """Main Config File."""
 import os
+import tempfile
  
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 TOP_LEVEL_DIR = os.path.abspath(os.curdir)
@@ -11,6 +12,36 @@ WTF_CSRF_ENABLED = True
 BCRYPT_LOG_ROUNDS = 12
 TOKEN_TIMEOUT = 3600  # 1*60*60
 
+#Authorization Cache Settings
+AUTH_DECISION_CACHE_SIZE = 4096  # memoized (role set, endpoint, action)
+AUTH_USER_CACHE_SIZE = 10000  # user id to role set id entries
+AUTH_SIDEBAR_CACHE_SIZE = 1024  # rendered (role set, active menu) sidebars
+AUTH_INDEX_AGGREGATE = False  # group grants with array_agg on PostgreSQL
+AUTH_INDEX_REBUILD_SECONDS = 300  # full consistency rebuild interval
+AUTH_GENERATION_FILE = os.path.join(tempfile.gettempdir(),
+                                    'flask_user_menus.generation')
+AUTH_GENERATION_CHECK_MS = 500  # how often workers poll the shared counter
+AUTH_SNAPSHOT_FILE = os.path.join(tempfile.gettempdir(),
+                                  'flask_user_menus.snapshot')
+
+#Management Tables Settings
+TABLE_PAGE_SIZE = 50  # rows per keyset page
+TABLE_COUNT_SECONDS = 60  # how long approximate row counts are cached
+TABLE_COUNT_CACHE_SIZE = 1000  # cached table row counts
+
+#Search Settings
+SEARCH_RESULT_LIMIT = 200  # ranked rows returned by a search box
+TYPEAHEAD_PAGE_SIZE = 20  # picker rows returned per typeahead request
+SEARCH_GENERATION_FILE = os.path.join(tempfile.gettempdir(),
+                                      'flask_user_menus.search')
+
+#Export Settings
+EXPORT_CHUNK_ROWS = 1000  # rows fetched and sent per chunk of an export
+
+#Import Settings
+IMPORT_CHUNK_ROWS = 500  # rows validated and inserted per transaction
+IMPORT_MAX_ERRORS = 1000  # problem rows reported by an import
+
 #Example Email Settings for sending Mail Notifications
 MAIL_SERVER = 'smtp.googlemail.com'
 MAIL_PORT = 465
@@ -18,4 +49,15 @@ MAIL_USE_TLS = False
 MAIL_USE_SSL = True
 MAIL_USERNAME = 'my_gmail_address'
 MAIL_PASSWORD = 'my_gmail_password'
-MAIL_DEFAULT_SENDER = 'my_gmail_address'
\ No newline at end of file
+MAIL_DEFAULT_SENDER = 'my_gmail_address'
+
+#Email Dispatch Settings
+MAIL_POOL_WORKERS = 4  # threads sending the queued emails
+MAIL_QUEUE_SIZE = 1000  # emails waiting for a sending thread
+MAIL_BATCH_SIZE = 50  # emails sent over one SMTP connection
+MAIL_QUEUE_TIMEOUT = 5  # seconds a sender waits for room in the queue
+
+#Password Hashing Settings
+PASSWORD_POOL_WORKERS = 2  # bcrypt processes per web worker, 0 hashes inline
+PASSWORD_POOL_PENDING = 16  # hashes queued or running per web worker
+PASSWORD_TIMEOUT = 5  # seconds a request waits for room and for its hash
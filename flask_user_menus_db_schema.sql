@@ -15,10 +15,23 @@ CREATE TABLE nav_menus
   last_modified_datetime timestamp without time zone,
   modified_by integer,
   menu_name character varying(80) NOT NULL,
+  parent_id integer,
+  menu_order integer NOT NULL DEFAULT 0,
+  menu_path character varying(255) NOT NULL DEFAULT '',
   CONSTRAINT nav_menus_pkey PRIMARY KEY (menu_id),
   CONSTRAINT nav_menus_menu_name_key UNIQUE (menu_name),
-  CONSTRAINT nav_menus_menu_url_key UNIQUE (menu_url)
+  CONSTRAINT nav_menus_menu_url_key UNIQUE (menu_url),
+  CONSTRAINT nav_menus_parent_id_fkey FOREIGN KEY (parent_id)
+      REFERENCES nav_menus (menu_id) MATCH SIMPLE
+      ON UPDATE NO ACTION ON DELETE NO ACTION
 );
+--menu_path lists the ids from the root down to the menu eg '1/5/12/', so a
+--subtree is one prefix scan on this index.
+CREATE INDEX nav_menus_menu_path_idx
+  ON nav_menus (menu_path varchar_pattern_ops);
+CREATE INDEX nav_menus_parent_id_idx ON nav_menus (parent_id);
+--Existing flat menus become roots:
+--UPDATE nav_menus SET menu_path = menu_id || '/' WHERE menu_path = '';
 CREATE TABLE nav_roles_menus
 (
   role_menu_id serial NOT NULL,
@@ -96,8 +109,39 @@ CREATE TABLE sec_users_roles
   CONSTRAINT sec_users_roles_user_id_fkey FOREIGN KEY (user_id)
       REFERENCES sec_users (user_id) MATCH SIMPLE
       ON UPDATE NO ACTION ON DELETE NO ACTION,
-  CONSTRAINT "UK_state_user_role" UNIQUE (user_role_id)
+  CONSTRAINT "UK_state_user_role" UNIQUE (user_role_id),
+  CONSTRAINT sec_users_roles_user_role_key UNIQUE (user_id, role_id)
 );
+--A user holds a role through one row, deactivated and reactivated rather
+--than duplicated, so bulk assignment can upsert on (user_id, role_id).
+--Existing databases first keep one row per user and role, the active one
+--where there is one:
+--DELETE FROM sec_users_roles d USING sec_users_roles k
+--  WHERE d.user_id = k.user_id AND d.role_id = k.role_id
+--    AND (d.is_active, d.user_role_id) < (k.is_active, k.user_role_id);
+--ALTER TABLE sec_users_roles ADD CONSTRAINT sec_users_roles_user_role_key
+--  UNIQUE (user_id, role_id);
+
+--Trigram indexes serving the substring search of the management pages,
+--see src/navigation/search.py. Without pg_trgm the search is served from
+--an index kept in each worker.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX sec_users_user_name_trgm_idx
+  ON sec_users USING gin (user_name gin_trgm_ops);
+CREATE INDEX sec_users_first_name_trgm_idx
+  ON sec_users USING gin (first_name gin_trgm_ops);
+CREATE INDEX sec_users_last_name_trgm_idx
+  ON sec_users USING gin (last_name gin_trgm_ops);
+CREATE INDEX sec_users_email_trgm_idx
+  ON sec_users USING gin (email gin_trgm_ops);
+CREATE INDEX sec_roles_role_name_trgm_idx
+  ON sec_roles USING gin (role_name gin_trgm_ops);
+CREATE INDEX sec_roles_role_description_trgm_idx
+  ON sec_roles USING gin (role_description gin_trgm_ops);
+CREATE INDEX nav_menus_menu_text_trgm_idx
+  ON nav_menus USING gin (menu_text gin_trgm_ops);
+CREATE INDEX nav_menus_menu_url_trgm_idx
+  ON nav_menus USING gin (menu_url gin_trgm_ops);
 
 --Your prefered placeHolder data for first time super admin login to 
 --access the /users view to then create the users within the app ;
@@ -107,6 +151,24 @@ INSERT INTO sec_users(
     VALUES ('start_user', 'Start', 'User', 
             'my_email_address@domain.com', True, 1);
 
+--Administrator role holding every action on the management pages, which
+--are guarded by has_required_roles per view, create, edit and delete.
+INSERT INTO sec_roles(role_name, role_description, created_by)
+    VALUES ('administrator', 'Manage users, roles and menus', 1);
+INSERT INTO sec_users_roles(user_id, role_id, created_by)
+    SELECT u.user_id, r.role_id, 1 FROM sec_users u, sec_roles r
+    WHERE u.user_name = 'start_user' AND r.role_name = 'administrator';
+INSERT INTO nav_menus(menu_name, menu_url, menu_text, created_by)
+    VALUES ('users', '/users', 'User Management', 1),
+           ('roles', '/users/roles', 'Role Management', 1),
+           ('menus', '/nav/menus', 'Menu Management', 1),
+           ('role_menus', '/nav/menus_management', 'Role Menus', 1);
+UPDATE nav_menus SET menu_path = menu_id || '/' WHERE menu_path = '';
+INSERT INTO nav_roles_menus(menu_id, role_id, can_view, can_create,
+            can_edit, can_delete, created_by)
+    SELECT m.menu_id, r.role_id, True, True, True, True, 1
+    FROM nav_menus m, sec_roles r WHERE r.role_name = 'administrator';
+
 
 
 
@@ -0,0 +1,12 @@
+"""Gunicorn settings building the authorization index before forking.
+
+Run with: gunicorn -c gunicorn_config.py run:app
+"""
+
+preload_app = True
+
+
+def when_ready(server):
+    """Warm the authorization index in the master process."""
+    from src.navigation import permissions
+    permissions.warm_up(server)
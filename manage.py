@@ -17,6 +17,156 @@ migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def check_endpoints():
+    """List the protected endpoints that have no matching menu url."""
+    from src.navigation import permissions
+    for endpoint in permissions.unmatched_endpoints(
+            permissions.current_index()):
+        print(endpoint)
+
+
+@manager.command
+def warm_up():
+    """Build the authorization index and report its size."""
+    from src.navigation import permissions
+    index = permissions.warm_up()
+    print('generation {}: {} roles, {} menus, {} bytes of masks'.format(
+        index.generation, len(index.role_bits), len(index.menu_masks),
+        index.menu_masks.nbytes()))
+
+
+@manager.option('--path', dest='path', default=None)
+def dump_snapshot(path):
+    """Write the authorization index to a snapshot workers boot from."""
+    from src.navigation import permissions
+    index = permissions.dump_snapshot(path)
+    print('wrote {}: {} roles, {} menus, {} role menus'.format(
+        path or permissions.snapshot_path(), len(index.role_bits),
+        len(index.menu_urls), len(index.grant_menus)))
+
+
+@manager.option('--name', dest='name', default='users',
+                help='users or grants')
+@manager.option('--format', dest='fmt', default='csv', help='csv or json')
+@manager.option('--path', dest='path', default=None)
+def export(name, fmt, path):
+    """Stream the users with their roles, or the role menu grants."""
+    import sys
+    from src.users import export as exports
+    if name not in exports.EXPORTS or fmt not in exports.FORMATS:
+        sys.exit('unknown export {}.{}'.format(name, fmt))
+    out = open(path, 'w', newline='') if path else sys.stdout
+    try:
+        for chunk in exports.export_chunks(name, fmt):
+            out.write(chunk)
+    finally:
+        if path:
+            out.close()
+
+
+@manager.option('--path', dest='path', required=True)
+@manager.option('--base-url', dest='base_url', default=None,
+                help='site url the confirmation emails link to')
+@manager.option('--no-email', dest='email', action='store_false',
+                default=True)
+def import_users(path, base_url, email):
+    """Import users and their roles from a CSV file."""
+    import sys
+    import time
+    from src.users import importer, utils
+    if email and not base_url:
+        sys.exit('give --base-url for the confirmation emails, or --no-email')
+    start = time.time()
+    with open(path, newline='', encoding='utf-8-sig') as lines:
+        try:
+            result = importer.import_users(lines)
+        except ValueError as e:
+            sys.exit('users not imported, {}'.format(e))
+    print('{} users imported with {} roles, {} rows skipped in {:.1f}s'
+          .format(result.created, result.assigned, result.skipped,
+                  time.time() - start))
+    for line, message in result.errors:
+        print('line {}: {}'.format(line, message))
+    if email and result.invitations:
+        print('sending {} confirmation emails'.format(
+            len(result.invitations)))
+        utils.send_confirmation_emails(result.invitations, base_url).join()
+
+
+@manager.option('--menus', dest='menus', type=int, default=1000)
+@manager.option('--roles', dest='roles', type=int, default=200)
+def bench_permissions(menus, roles):
+    """Benchmark the bitmask permission checks against a list scan."""
+    from src.navigation import benchmarks
+    benchmarks.bench_permission_checks(menus, roles)
+
+
+@manager.option('--rows', dest='rows', type=int, default=10000)
+@manager.option('--roles', dest='roles', type=int, default=200)
+def bench_index_rebuild(rows, roles):
+    """Benchmark rebuilding the authorization index from role menu rows."""
+    from src.navigation import benchmarks
+    benchmarks.bench_index_rebuild(rows, roles)
+
+
+@manager.option('--workers', dest='workers', type=int, default=4)
+@manager.option('--check-ms', dest='check_ms', type=int, default=50)
+def bench_generation(workers, check_ms):
+    """Measure and check how workers see bumps of the shared generation."""
+    from src.navigation import benchmarks
+    benchmarks.bench_generation(workers, check_ms=check_ms)
+
+
+@manager.option('--patterns', dest='patterns', type=int, default=5000)
+@manager.option('--depth', dest='depth', type=int, default=64)
+def bench_url_matcher(patterns, depth):
+    """Benchmark resolving request paths against menu url patterns."""
+    from src.navigation import benchmarks
+    benchmarks.bench_url_matching(patterns)
+    benchmarks.bench_ambiguous_urls(depth)
+
+
+@manager.option('--rows', dest='rows', type=int, default=100000)
+def bench_list_rows(rows):
+    """Benchmark loading list pages as entities and as projected rows."""
+    from src.navigation import benchmarks
+    benchmarks.bench_list_rows(rows)
+
+
+@manager.option('--rows', dest='rows', type=int, default=10000)
+def bench_table_render(rows):
+    """Benchmark rendering the users table with flask_table and compiled."""
+    from src.navigation import benchmarks
+    benchmarks.bench_table_render(rows)
+
+
+@manager.option('--messages', dest='messages', type=int, default=2000)
+@manager.option('--handshake-ms', dest='handshake_ms', type=int, default=20)
+def bench_mail_dispatch(messages, handshake_ms):
+    """Benchmark sending emails to a local SMTP stub, per thread and pooled."""
+    from src.users import benchmarks
+    benchmarks.bench_mail_dispatch(messages, handshake_ms)
+
+
+@manager.option('--logins', dest='logins', type=int, default=16)
+@manager.option('--seconds', dest='seconds', type=int, default=5)
+@manager.option('--rounds', dest='rounds', type=int, default=None)
+def bench_login_storm(logins, seconds, rounds):
+    """Benchmark page latency during a login storm, inline and pooled."""
+    from src.users import benchmarks
+    benchmarks.bench_login_storm(logins, seconds, rounds)
+
+
+@manager.option('--menus', dest='menus', type=int, default=1000)
+@manager.option('--workers', dest='workers', type=int, default=4)
+def bench_worker_memory(menus, workers):
+    """Report the private memory forked workers dirty per index layout."""
+    from src.navigation import benchmarks
+    benchmarks.bench_worker_memory(menus, workers=workers)
+
+
 if __name__ == '__main__':
     manager.run()
     
@@ -25,4 +175,18 @@ if __name__ == '__main__':
 # python manage.py db migrate
 # python manage.py db upgrade
 # python manage.py db downgrade
+# python manage.py check_endpoints
+# python manage.py bench_permissions --menus 1000 --roles 200
+# python manage.py bench_index_rebuild --rows 10000
+# python manage.py bench_generation --workers 4 --check-ms 50
+# python manage.py bench_worker_memory --menus 1000 --workers 4
+# python manage.py bench_url_matcher --patterns 5000 --depth 64
+# python manage.py bench_list_rows --rows 100000
+# python manage.py bench_table_render --rows 10000
+# python manage.py bench_mail_dispatch --messages 2000 --handshake-ms 20
+# python manage.py bench_login_storm --logins 16 --seconds 5
+# python manage.py warm_up
+# python manage.py dump_snapshot --path /tmp/flask_user_menus.snapshot
+# python manage.py export --name users --format csv --path users.csv
+# python manage.py import_users --path users.csv --base-url http://example.com/
 
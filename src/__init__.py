@@ -44,3 +44,8 @@ from src.navigation.views import nav_blueprint
 # register the blueprints
 app.register_blueprint(users_blueprint)
 app.register_blueprint(nav_blueprint)
+
+# resolve the endpoints protected by has_required_roles
+from src.navigation import permissions, sidebar
+permissions.init_app(app)
+sidebar.init_app(app)
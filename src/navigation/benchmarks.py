@@ -0,0 +1,574 @@
+"""Micro-benchmarks for the navigation and authorization structures.
+
+The benchmarks work on synthetic data so they can be run without a
+populated database, eg `python manage.py bench_permissions`.
+"""
+
+import gc
+import json
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from collections import namedtuple
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from . import permissions
+from .generation import SharedGeneration
+from .matcher import UrlMatcher, is_param, split_path
+
+
+Grant = namedtuple('Grant', ['role_menu_id', 'menu_id', 'role_id',
+                             'can_view', 'can_create', 'can_edit',
+                             'can_delete'])
+
+
+def build_grants(menus, roles, roles_per_menu, seed=0):
+    """Generate role ids, menu urls and random role menu grants."""
+    rand = random.Random(seed)
+    role_ids = list(range(1, roles + 1))
+    menu_urls = {m: '/menu/{}'.format(m) for m in range(1, menus + 1)}
+    grants = []
+    for menu_id in menu_urls:
+        for role_id in rand.sample(role_ids, roles_per_menu):
+            grants.append(Grant(len(grants) + 1, menu_id, role_id, True,
+                                rand.random() < 0.5, rand.random() < 0.3,
+                                rand.random() < 0.1))
+    return role_ids, menu_urls, grants
+
+
+def report(title, timings, number):
+    """Print the per-call cost of each timed approach."""
+    print(title)
+    for label, seconds in timings:
+        print('  {:<28} {:>10.3f} us/check'.format(
+            label, seconds / number * 1e6))
+
+
+def bench_permission_checks(menus=1000, roles=200, roles_per_menu=20,
+                            user_roles=3, number=100000):
+    """Compare the role name list scan with the bitmask check."""
+    role_ids, menu_urls, grants = build_grants(menus, roles, roles_per_menu)
+    menu_dict = {}
+    for g in grants:
+        menu_dict.setdefault(menu_urls[g.menu_id], []).append(
+            'role_{}'.format(g.role_id))
+    index = permissions.compile_index(role_ids, menu_urls,
+                                      permissions.fold_grants(grants), {})
+
+    rand = random.Random(1)
+    my_role_ids = rand.sample(role_ids, user_roles)
+    my_roles = ['role_{}'.format(r) for r in my_role_ids]
+    menu_ids = [rand.randint(1, menus) for _ in range(number)]
+    urls = [menu_urls[menu_id] for menu_id in menu_ids]
+
+    def list_scan():
+        for url in urls:
+            url_roles = menu_dict[url]
+            any(i in url_roles for i in my_roles)
+
+    def bitmask():
+        user_mask = permissions.role_mask(index, my_role_ids)
+        for menu_id in menu_ids:
+            permissions.is_permitted(index, user_mask, menu_id)
+
+    report('{} menus x {} roles, {} roles per menu, {} user roles'.format(
+               menus, roles, roles_per_menu, user_roles),
+           [('list scan', min(timeit.repeat(list_scan, number=1, repeat=3))),
+            ('bitmask', min(timeit.repeat(bitmask, number=1, repeat=3)))],
+           number)
+
+
+def legacy_menu_dict(menus_list):
+    """Group rows into a url to role names dict the way the session did."""
+    menu_url_list = []
+    menu_dict = {}
+    for m in menus_list:
+        if m.menu_url not in menu_url_list:
+            menu_url_list.append(m.menu_url)
+    for u in menu_url_list:
+        auth_roles = []
+        for m in menus_list:
+            if m.menu_url == u:
+                auth_roles.append(m.role_name)
+        menu_dict[u] = auth_roles
+    return menu_dict
+
+
+def bench_index_rebuild(rows=10000, roles=200, roles_per_menu=20):
+    """Time the index rebuild from role menu rows.
+
+    Compares the legacy nested loop grouping with the one pass fold and the
+    fold of rows already aggregated per menu by the database.
+    """
+    menus = rows // roles_per_menu
+    role_ids, menu_urls, grants = build_grants(menus, roles, roles_per_menu)
+    UrlRow = namedtuple('UrlRow', ['menu_url', 'role_name'])
+    legacy_rows = [UrlRow(menu_urls[g.menu_id], 'role_{}'.format(g.role_id))
+                   for g in grants]
+    aggregated = {}
+    for g in grants:
+        row = aggregated.setdefault(g.menu_id, (g.menu_id, [], [], []))
+        row[1].append(g.role_menu_id)
+        row[2].append(g.role_id)
+        row[3].append(permissions.grant_flags(g))
+
+    def legacy():
+        legacy_menu_dict(legacy_rows)
+
+    def one_pass():
+        permissions.compile_index(role_ids, menu_urls,
+                                  permissions.fold_grants(grants), {})
+
+    def folded():
+        permissions.compile_index(
+            role_ids, menu_urls,
+            permissions.fold_aggregates(aggregated.values()), {})
+
+    print('{} role menu rows, {} menus x {} roles'.format(
+        len(grants), menus, roles))
+    for label, func in [('legacy nested loops', legacy),
+                        ('one pass grouping', one_pass),
+                        ('database aggregated', folded)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print('  {:<28} {:>10.2f} ms/rebuild'.format(label, seconds * 1e3))
+
+
+def watch_generation(path, check_ms, last, results):
+    """Poll the shared counter like a worker would and report what it saw."""
+    shared = SharedGeneration(path)
+    seen, checked_at, observed = 0, 0, []
+    while seen < last:
+        now = time.time()
+        if (now - checked_at) * 1000 >= check_ms:
+            checked_at = now
+            value = shared.read()
+            if value != seen:
+                seen = value
+                observed.append((value, now))
+        time.sleep(0.0001)
+    results.put(observed)
+
+
+def bump_generation(path, bumps):
+    """Bump the shared counter a number of times, as a committing worker."""
+    shared = SharedGeneration(path)
+    for _ in range(bumps):
+        shared.bump()
+    shared.close()
+
+
+def bench_generation(workers=4, bumps=50, check_ms=50, number=1000000):
+    """Measure cross worker invalidation latency and per request overhead.
+
+    Spawns worker processes polling the shared counter at most once per
+    check_ms while this process bumps it, then reports how long each bump
+    took to be noticed and what the throttled check costs per request.
+    Then checks that bumps made by several processes at once are all
+    counted. Raises RuntimeError when a worker missed the last bump, saw
+    the counter go backwards, or a concurrent bump was lost.
+    """
+    fd, path = tempfile.mkstemp(suffix='.generation')
+    os.close(fd)
+    shared = SharedGeneration(path)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=watch_generation,
+                                     args=(path, check_ms, bumps, results))
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    time.sleep(0.2)
+    bumped_at = {}
+    rand = random.Random(0)
+    for _ in range(bumps):
+        time.sleep(rand.uniform(0, 2 * check_ms / 1000.0))
+        bumped_at[shared.bump()] = time.time()
+    latencies = []
+    problems = []
+    for _ in procs:
+        observed = results.get()
+        values = [value for value, seen_at in observed]
+        if values != sorted(set(values)) or values[-1:] != [bumps]:
+            problems.append('a worker saw {}'.format(values))
+        latencies.extend(seen_at - bumped_at[value]
+                         for value, seen_at in observed)
+    for proc in procs:
+        proc.join()
+
+    start = shared.read()
+    procs = [multiprocessing.Process(target=bump_generation,
+                                     args=(path, bumps))
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    counted = shared.read() - start
+    if counted != workers * bumps:
+        problems.append('{} of {} concurrent bumps counted'.format(
+            counted, workers * bumps))
+
+    state = {'checked_at': 0, 'seen': shared.read()}
+
+    def throttled_check():
+        now = time.time()
+        if (now - state['checked_at']) * 1000 >= check_ms:
+            state['checked_at'] = now
+            return shared.read() != state['seen']
+        return False
+
+    read_cost = timeit.timeit(shared.read, number=number) / number
+    check_cost = timeit.timeit(throttled_check, number=number) / number
+    shared.close()
+    os.remove(path)
+
+    latencies.sort()
+    print('{} workers, {} bumps, checking every {} ms'.format(
+        workers, bumps, check_ms))
+    print('  invalidation latency  median {:.2f} ms, max {:.2f} ms'.format(
+        latencies[len(latencies) // 2] * 1e3, latencies[-1] * 1e3))
+    print('  counter read          {:.3f} us'.format(read_cost * 1e6))
+    print('  throttled check       {:.3f} us/request'.format(
+        check_cost * 1e6))
+    print('  concurrent bumps      {} of {} counted'.format(
+        counted, workers * bumps))
+    if problems:
+        raise RuntimeError('shared generation check failed: ' +
+                           '; '.join(problems))
+
+
+def private_dirty_kb():
+    """Return the private dirty memory of this process in kB."""
+    path = '/proc/self/smaps_rollup'
+    if not os.path.exists(path):
+        path = '/proc/self/smaps'
+    total = 0
+    with open(path) as smaps:
+        for line in smaps:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+    return total
+
+
+def serve_checks(check, requests, results):
+    """Run permission checks in a forked worker and report its growth."""
+    before = private_dirty_kb()
+    for n in range(requests):
+        check(n)
+    results.put(private_dirty_kb() - before)
+
+
+def bench_worker_memory(menus=1000, roles=200, roles_per_menu=20,
+                        workers=4, requests=5000):
+    """Report the private memory forked workers dirty per index layout.
+
+    Compares the legacy menu dict decoded from the session cookie on every
+    request, a dict of role name lists built before the fork, and the packed
+    index built by warm_up before the fork.
+    """
+    role_ids, menu_urls, grants = build_grants(menus, roles, roles_per_menu)
+    menu_dict = {}
+    for g in grants:
+        menu_dict.setdefault(menu_urls[g.menu_id], []).append(
+            'role_{}'.format(g.role_id))
+    cookie = json.dumps({'menu_dict': menu_dict})
+    index = permissions.compile_index(role_ids, menu_urls,
+                                      permissions.fold_grants(grants), {})
+    urls = list(menu_dict)
+    my_roles = ['role_1', 'role_2', 'role_3']
+    user_mask = permissions.role_mask(index, [1, 2, 3])
+
+    def session_dict(n):
+        url_roles = json.loads(cookie)['menu_dict'][urls[n % menus]]
+        return any(i in url_roles for i in my_roles)
+
+    def prefork_dict(n):
+        url_roles = menu_dict[urls[n % menus]]
+        return any(i in url_roles for i in my_roles)
+
+    def packed(n):
+        return permissions.is_permitted(index, user_mask, n % menus + 1)
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    context = multiprocessing.get_context('fork')
+    print('{} menus x {} roles, {} workers x {} requests, session cookie '
+          '{} kB'.format(menus, roles, workers, requests, len(cookie) // 1024))
+    for label, check in [('session dict per request', session_dict),
+                         ('dict of lists before fork', prefork_dict),
+                         ('packed index before fork', packed)]:
+        results = context.Queue()
+        procs = [context.Process(target=serve_checks,
+                                 args=(check, requests, results))
+                 for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+        growth = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+        print('  {:<28} {:>8} kB private per worker'.format(
+            label, sum(growth) // len(growth)))
+
+
+def build_url_patterns(count, seed=0):
+    """Generate exact, parameterized and wildcard menu url patterns."""
+    rand = random.Random(seed)
+    patterns = []
+    for n in range(count):
+        section = 'section{}'.format(n % 50)
+        kind = rand.random()
+        if kind < 0.6:
+            patterns.append('/{}/page{}'.format(section, n))
+        elif kind < 0.9:
+            patterns.append('/{}/<int:item_id>/detail{}'.format(section, n))
+        else:
+            patterns.append('/{}/archive{}/*'.format(section, n))
+    return patterns
+
+
+def concrete_path(pattern, rand):
+    """Build a request path matching a pattern."""
+    segments = [str(rand.randint(1, 9999)) if is_param(s) and s != '*' else s
+                for s in split_path(pattern)]
+    if segments and segments[-1] == '*':
+        segments[-1] = 'year{}'.format(rand.randint(2000, 2017))
+    return '/' + '/'.join(segments)
+
+
+def pattern_regex(pattern):
+    """Translate a menu url pattern into a regular expression."""
+    parts = []
+    for segment in split_path(pattern):
+        if segment == '*':
+            parts.append('(?:/.*)?')
+        elif is_param(segment):
+            parts.append('/[^/]+')
+        else:
+            parts.append('/' + re.escape(segment))
+    return ''.join(parts)
+
+
+def bench_url_matching(patterns=5000, number=2000):
+    """Compare the segment trie with scanning the patterns one by one.
+
+    Also times one combined regular expression of every pattern, which the
+    re module still tries alternative by alternative.
+    """
+    urls = build_url_patterns(patterns)
+    rand = random.Random(1)
+    paths = [concrete_path(rand.choice(urls), rand) for _ in range(number)]
+    compiled = [(re.compile(pattern_regex(url) + '$'), n)
+                for n, url in enumerate(urls)]
+    combined = re.compile('|'.join('({})'.format(pattern_regex(url))
+                                   for url in urls) + '$')
+    start = time.time()
+    matcher = UrlMatcher((url, n) for n, url in enumerate(urls))
+    compile_ms = (time.time() - start) * 1e3
+
+    def regex_scan():
+        for path in paths:
+            for regex, value in compiled:
+                if regex.match(path):
+                    break
+
+    def combined_regex():
+        for path in paths:
+            match = combined.match(path)
+            if match:
+                match.lastindex
+
+    def trie():
+        for path in paths:
+            matcher.match(path)
+
+    missed = sum(matcher.match(path) is None for path in paths)
+    report('{} patterns compiled in {:.1f} ms, {} paths, {} unmatched'.format(
+               patterns, compile_ms, number, missed),
+           [('regex scan', min(timeit.repeat(regex_scan, number=1,
+                                              repeat=1))),
+            ('combined regex', min(timeit.repeat(combined_regex, number=1,
+                                                  repeat=1))),
+            ('segment trie', min(timeit.repeat(trie, number=1, repeat=3)))],
+           number)
+
+
+def build_ambiguous_patterns(depth):
+    """Generate patterns of depth literal segments, some made parameters.
+
+    Every pattern shares the literal path up to its parameters, so a walk
+    along the literals may take the parameter branch at every segment.
+    """
+    patterns = []
+    for first in range(-1, depth):
+        for second in range(first + 1, depth):
+            params = (first, second)
+            patterns.append('/' + '/'.join(
+                '<p>' if n in params else 'a' for n in range(depth)) + '/z')
+    return patterns
+
+
+def bench_ambiguous_urls(depth=64, number=2000):
+    """Time paths running deep into ambiguous patterns without matching.
+
+    A path of literal segments ending in no pattern's last segment may be
+    on every node of the trie, yet once its states are compiled it costs
+    one step per segment.
+    """
+    print('ambiguous patterns, literal paths ending unmatched')
+    depths = [d for d in (depth // 8, depth // 4, depth // 2, depth) if d]
+    for d in depths:
+        patterns = build_ambiguous_patterns(d)
+        matcher = UrlMatcher((url, n) for n, url in enumerate(patterns))
+        path = '/' + '/'.join(['a'] * d) + '/q'
+        start = time.time()
+        missed = matcher.match(path) is None
+        first_ms = (time.time() - start) * 1e3
+        seconds = min(timeit.repeat(lambda: matcher.match(path),
+                                    number=number, repeat=3))
+        print('  depth {:>4} {:>7} patterns: first {:>8.3f} ms, then '
+              '{:>7.3f} us/path{}'.format(d, len(patterns), first_ms,
+                                           seconds / number * 1e6,
+                                           '' if missed else ' (matched)'))
+
+
+def user_table_rows(count, seed=0):
+    """Generate sec_users rows shaped like real ones."""
+    rand = random.Random(seed)
+    start = datetime(2017, 1, 1)
+    for n in range(count):
+        created = start + timedelta(minutes=n)
+        yield {'user_id': n + 1, 'user_name': 'user{}'.format(n),
+               'user_password': b'x' * 60,
+               'first_name': 'First{}'.format(rand.randrange(1000)),
+               'last_name': 'Last{}'.format(rand.randrange(1000)),
+               'email': 'user{}@example.com'.format(n),
+               'confirmation_sent_at': created, 'is_confirmed': True,
+               'confirmed_at': created, 'is_active': True,
+               'is_deleted': False, 'is_authenticated': False,
+               'has_ever_logged_in': True, 'created_datetime': created,
+               'last_modified_datetime': created,
+               'login_datetime': created + timedelta(days=1),
+               'password_last_change_datetime': None,
+               'created_by': 1, 'modified_by': 1}
+
+
+def bench_list_rows(rows=100000):
+    """Compare loading the users list as entities and as projected rows.
+
+    The rows sit in a throwaway SQLite database, so the numbers measure the
+    loading itself: time, and the memory held by the loaded list.
+    """
+    from src.users.models import User
+    from src.users.utils import UserRow
+    engine = create_engine('sqlite://')
+    User.__table__.create(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(),
+                           list(user_table_rows(rows)))
+    columns = [getattr(User, name) for name in UserRow._fields]
+
+    def entities(session):
+        return session.query(User).all()
+
+    def projected(session):
+        return [UserRow._make(values) for values in
+                session.query(*columns).all()]
+
+    print('{} users'.format(rows))
+    for label, load in [('ORM entities', entities),
+                        ('projected UserRow', projected)]:
+        timings = []
+        for _ in range(3):
+            session = Session(bind=engine)
+            start = time.time()
+            load(session)
+            timings.append(time.time() - start)
+            session.close()
+        gc.collect()
+        session = Session(bind=engine)
+        tracemalloc.start()
+        loaded = load(session)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('  {:<28} {:>8.1f} ms {:>8.1f} MB {:>8.0f} rows/ms'.format(
+            label, min(timings) * 1e3, held / 2.0 ** 20,
+            rows / (min(timings) * 1e3)))
+        del loaded
+        session.close()
+
+
+def flask_table_twin(table):
+    """Declare the flask_table equivalent of a compiled table class.
+
+    flask_table translates its labels through Flask-Babel, which the app
+    does not set up otherwise.
+    """
+    from flask import url_for
+    from flask_babel import Babel
+    from src import app
+    if 'babel' not in app.extensions:
+        Babel(app)
+    import flask_table
+    from .render import BoolCol, LinkCol
+    attrs = {'thead_attrs': table.thead_attrs, 'classes': table.classes,
+             'allow_sort': table.allow_sort}
+    for key, col in table.columns():
+        options = {'allow_sort': col.allow_sort,
+                   'td_html_attrs': col.td_html_attrs}
+        if isinstance(col, LinkCol):
+            attrs[key] = flask_table.LinkCol(
+                col.name, col.endpoint, url_kwargs=col.url_kwargs,
+                anchor_attrs=col.anchor_attrs, **options)
+        elif isinstance(col, BoolCol):
+            attrs[key] = flask_table.BoolCol(col.name, **options)
+        else:
+            attrs[key] = flask_table.Col(col.name, **options)
+
+    def sort_url(self, col_key, reverse=False):
+        return url_for(table.sort_endpoint, sort=col_key,
+                       direction='desc' if reverse else 'asc')
+    attrs['sort_url'] = sort_url
+    return flask_table.create_table(table.__name__, options=attrs)
+
+
+def bench_table_render(rows=10000):
+    """Compare rendering the users table with flask_table and compiled.
+
+    Both render the same projected rows in a test request and have to give
+    the same html.
+    """
+    from src import app
+    from src.users.tables import UserDetailsTable
+    from src.users.utils import UserRow
+    users = [UserRow(*values) for values in
+             ((row['user_id'],) + tuple(row[name] for name in
+                                        UserRow._fields[1:])
+              for row in user_table_rows(rows))]
+    try:
+        twin = flask_table_twin(UserDetailsTable)
+    except ImportError:
+        twin = None
+    with app.test_request_context('/users'):
+        def compiled():
+            return str(UserDetailsTable(users, sort_by='user_name').__html__())
+
+        def per_cell():
+            return twin(users, sort_by='user_name').__html__()
+
+        timings = [('compiled table', compiled)]
+        if twin is None:
+            print('flask_table is not installed, timing the compiled '
+                  'table only')
+        else:
+            timings.insert(0, ('flask_table', per_cell))
+            print('{} rows, same html: {}'.format(
+                rows, compiled() == per_cell()))
+        for label, render in timings:
+            seconds = min(timeit.repeat(render, number=1, repeat=3))
+            print('  {:<28} {:>10.2f} ms/render'.format(label, seconds * 1e3))
@@ -0,0 +1,98 @@
+"""Form fields picking a role, menu or user through a typeahead."""
+
+from flask import url_for
+from markupsafe import Markup, escape
+from wtforms import Field
+from . import search
+
+
+def typeahead_widget(field, **kwargs):
+    """Render a picker as a hidden id and a text box looking up labels.
+
+    The text box is wired up by typeahead.js from its data attributes.
+    """
+    kwargs.setdefault('id', field.id)
+    css = kwargs.pop('class', '') or kwargs.pop('class_', '')
+    label = field.label_text()
+    return Markup(
+        '<input type="hidden" name="%s" id="%s" value="%s">'
+        '<input type="text" class="%s" id="%s_label" value="%s" '
+        'placeholder="%s" autocomplete="off" data-typeahead="%s" '
+        'data-typeahead-target="%s">' % (
+            escape(field.name), escape(kwargs['id']),
+            escape(field.raw_id()), escape(css), escape(kwargs['id']),
+            escape(label), escape(kwargs.get('placeholder', '')),
+            escape(url_for('navigation.typeahead', picker=field.picker)),
+            escape(kwargs['id'])))
+
+
+class TypeaheadField(Field):
+    """Pick one row offered by a picker, submitted as its primary key.
+
+    Like QuerySelectField the data is the picked object, but only the
+    submitted id is looked up, checked against the picker's prefix index
+    and then loaded by primary key, so no choice list is built.
+    """
+
+    widget = staticmethod(typeahead_widget)
+
+    def __init__(self, label=None, validators=None, picker=None,
+                 allow_blank=False, **kwargs):
+        """Set up a field for one of search.PICKERS."""
+        super(TypeaheadField, self).__init__(label, validators, **kwargs)
+        self.picker = picker
+        self.allow_blank = allow_blank
+        self._id = None
+
+    @property
+    def model(self):
+        """Return the model the picker offers rows of."""
+        return search.PICKERS[self.picker].model
+
+    def raw_id(self):
+        """Return the id of the picked row, '' when none is."""
+        if self._id is not None:
+            return self._id
+        if self.data is not None:
+            return getattr(self.data, search.primary_key(self.model).key)
+        return ''
+
+    def label_text(self):
+        """Return the label of the picked row, '' when none is."""
+        if self.data is None:
+            return ''
+        return getattr(self.data, search.PICKERS[self.picker].label)
+
+    def _get_data(self):
+        """Load the picked row by primary key on first access."""
+        if self._id is not None:
+            self._data = self.model.query.get(self._id)
+            self._id = None
+        return self._data
+
+    def _set_data(self, data):
+        """Set the picked row."""
+        self._data = data
+        self._id = None
+
+    data = property(_get_data, _set_data)
+
+    def process_formdata(self, valuelist):
+        """Keep the submitted id, loading the row only when it is read."""
+        self._data = None
+        self._id = None
+        if valuelist and valuelist[0]:
+            try:
+                self._id = int(valuelist[0])
+            except ValueError:
+                self._id = -1
+
+    def pre_validate(self, form):
+        """Check the submitted id is one the picker offers."""
+        key = self._id
+        if key is None:
+            if self.data is None and not self.allow_blank:
+                raise ValueError(self.gettext('Not a valid choice'))
+            return
+        if not search.is_offered(self.picker, key) or self.data is None:
+            raise ValueError(self.gettext('Not a valid choice'))
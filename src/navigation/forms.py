@@ -2,9 +2,9 @@
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField,  BooleanField
-from wtforms import HiddenField, SubmitField
+from wtforms import HiddenField, SubmitField, IntegerField
 from wtforms.validators import DataRequired, Optional
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
+from .fields import TypeaheadField
 
 
 class MenuDetailsForm(FlaskForm):
@@ -16,6 +16,12 @@ class MenuDetailsForm(FlaskForm):
                            render_kw={'class': 'form-control'})
     menu_text = StringField('Menu Details', validators=[DataRequired()],
                             render_kw={'class': 'form-control'})
+    parent = TypeaheadField(label=u"Parent Menu", picker='menus',
+                            allow_blank=True, validators=[Optional()],
+                            render_kw={'class': 'form-control'})
+    menu_order = IntegerField('Menu Order', default=0,
+                              validators=[Optional()],
+                              render_kw={'class': 'form-control'})
     is_active = SelectField(u'Status',
                             choices=[('True', 'Active'), ('False',
                                                           'Inactive')],
@@ -36,14 +42,14 @@ class SearchMenuForm(FlaskForm):
 class RoleMenuSelectionForm(FlaskForm):
     """Select a menu to add to a role."""
 
-    role_id = QuerySelectField(label=u"Role Name", allow_blank=True,
-                               validators=[DataRequired()],
-                               render_kw={'class': 'form-control',
-                                          'placeholder': "Role Name"})
-    menu_id = QuerySelectField(label=u"Menu Name", allow_blank=True,
-                               validators=[DataRequired()],
-                               render_kw={'class': 'form-control',
-                                          'placeholder': "Menu Name"})
+    role_id = TypeaheadField(label=u"Role Name", picker='roles',
+                             validators=[DataRequired()],
+                             render_kw={'class': 'form-control',
+                                        'placeholder': "Role Name"})
+    menu_id = TypeaheadField(label=u"Menu Name", picker='menus',
+                             validators=[DataRequired()],
+                             render_kw={'class': 'form-control',
+                                        'placeholder': "Menu Name"})
     is_active = SelectField(u'Status',
                             choices=[('True', 'Active'),
                                      ('False', 'Inactive')],
@@ -57,10 +63,10 @@ class RoleMenuSelectionForm(FlaskForm):
 class SelectRoleForm(FlaskForm):
     """Select a role to filter menus."""
 
-    role = QuerySelectField(label=u"Role Name", allow_blank=True,
-                            validators=[DataRequired()],
-                            render_kw={'class': 'form-control',
-                                       'placeholder': "Role Name"})
+    role = TypeaheadField(label=u"Role Name", picker='roles',
+                          validators=[DataRequired()],
+                          render_kw={'class': 'form-control',
+                                     'placeholder': "Role Name"})
     submit_select_role = SubmitField('Search Role Menus', render_kw={
                                         'class': 'btn btn-success'})
 
@@ -88,14 +94,14 @@ class RoleMenuSelectionForm(FlaskForm):
 class NewRoleMenuForm(FlaskForm):
     """Capture the details of a new Role Menu mapping."""
 
-    role_id = QuerySelectField(label=u"Role Name", allow_blank=True,
-                               validators=[DataRequired()],
-                               render_kw={'class': 'form-control',
-                                          'placeholder': "Role Name"})
-    menu_id = QuerySelectField(label=u"Menu Name", allow_blank=True,
-                               validators=[DataRequired()],
-                               render_kw={'class': 'form-control',
-                                          'placeholder': "Menu Name"})
+    role_id = TypeaheadField(label=u"Role Name", picker='roles',
+                             validators=[DataRequired()],
+                             render_kw={'class': 'form-control',
+                                        'placeholder': "Role Name"})
+    menu_id = TypeaheadField(label=u"Menu Name", picker='menus',
+                             validators=[DataRequired()],
+                             render_kw={'class': 'form-control',
+                                        'placeholder': "Menu Name"})
     is_active = SelectField(u'Status',
                             choices=[('True', 'Active'),
                                      ('False', 'Inactive')],
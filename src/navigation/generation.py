@@ -0,0 +1,63 @@
+"""Generation counter shared by every worker process.
+
+The counter is a single 64 bit integer in a small memory mapped file, so
+reading it costs no system call. Writers serialize their increments with a
+POSIX record lock, which also excludes forked processes sharing the file.
+
+The file also holds a random id written when it is created, so a counter
+that starts again from 0 in a new file, eg after a reboot emptied /tmp, can
+be told apart from the one it replaced.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+
+_COUNTER = struct.Struct('=Q')
+_FILE_ID = struct.Struct('=Q')
+_SIZE = _COUNTER.size + _FILE_ID.size
+
+
+class SharedGeneration(object):
+    """Hold a counter mapped from a file shared between processes."""
+
+    def __init__(self, path):
+        """Open or create the counter file and map it in memory."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < _SIZE:
+                os.ftruncate(self._fd, _SIZE)
+                os.pwrite(self._fd, os.urandom(_FILE_ID.size), _COUNTER.size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, _SIZE)
+
+    @property
+    def file_id(self):
+        """Return the random id the counter file was created with."""
+        return _FILE_ID.unpack_from(self._map, _COUNTER.size)[0]
+
+    def read(self):
+        """Return the current value of the counter."""
+        return _COUNTER.unpack_from(self._map)[0]
+
+    def bump(self):
+        """Increment the counter and return its new value."""
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            value = self.read() + 1
+            _COUNTER.pack_into(self._map, 0, value)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return value
+
+    def close(self):
+        """Unmap the counter and close its file."""
+        self._map.close()
+        os.close(self._fd)
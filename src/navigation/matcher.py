@@ -0,0 +1,248 @@
+"""Segment trie matching request paths against menu url patterns.
+
+A menu url is either an exact path, eg `/users/roles`, a parameterized path
+whose `<name>` or `<converter:name>` segments match any single segment, eg
+`/users/<int:user_id>`, or a section ending in `*` matching the section and
+everything below it, eg `/reports/*`.
+
+Patterns are compiled into a trie keyed on path segments, so a path is
+resolved by walking its segments rather than by trying every pattern.
+Literal segments win over parameters, which win over a trailing wildcard,
+and the deepest wildcard along the path wins over shallower ones.
+
+A literal branch may lead nowhere where the parameter branch beside it
+matches, so rather than backing up the walk follows both at once: each
+step moves from the ordered set of trie nodes the path so far may be on
+to the set the next segment leads to. These sets are compiled into states
+as walks first reach them, each holding one successor per literal segment
+and one for any other segment, so matching a path takes one lookup per
+segment however deep and ambiguous the patterns are.
+
+As in Flask routing a trailing slash is part of the url: `/users/` and
+`/users` are different urls, and parameters do not match an empty segment.
+A wildcard section matches with or without the slash.
+"""
+
+_MISSING = object()
+_STATE_LIMIT = 10000
+
+
+def split_path(path):
+    """Split a path into its segments, '' last for a trailing slash."""
+    segments = [segment for segment in path.split('/') if segment]
+    if segments and path.endswith('/'):
+        segments.append('')
+    return segments
+
+
+def is_param(segment):
+    """Tell whether a pattern segment matches any single segment."""
+    return segment == '*' or (segment.startswith('<') and
+                              segment.endswith('>'))
+
+
+def is_pattern(url):
+    """Tell whether a menu url holds parameters or a wildcard."""
+    return any(is_param(segment) for segment in split_path(url))
+
+
+def link_for(url):
+    """Return a linkable path for a menu url, None when it has parameters."""
+    segments = split_path(url)
+    if segments and segments[-1] == '*':
+        segments = segments[:-1]
+        url = '/' + '/'.join(segments) + ('/' if segments else '')
+    if any(is_param(segment) for segment in segments):
+        return None
+    return url
+
+
+class _Node(object):
+    """Hold the children and values of one trie node."""
+
+    __slots__ = ('literals', 'param', 'rest', 'value')
+
+    def __init__(self):
+        """Set up an empty node."""
+        self.literals = {}
+        self.param = None
+        self.rest = _MISSING
+        self.value = _MISSING
+
+
+class _State(object):
+    """Hold the trie nodes a path may be on and where its segments lead."""
+
+    __slots__ = ('nodes', 'rest', 'value', 'steps', 'other', 'empty')
+
+    def __init__(self, nodes, rest):
+        """Set up a state from its nodes, best first, and fallback node."""
+        self.nodes = nodes
+        self.rest = rest
+        self.steps = None
+        self.other = None
+        self.empty = None
+        self.value = rest.rest if rest is not None else _MISSING
+        for node in nodes:
+            value = node.value if node.value is not _MISSING else node.rest
+            if value is not _MISSING:
+                self.value = value
+                break
+
+
+class UrlMatcher(object):
+    """Resolve paths to the values of the menu url patterns they match."""
+
+    def __init__(self, patterns=()):
+        """Compile (pattern, value) pairs."""
+        self._root = _Node()
+        self._size = 0
+        self._owned = None
+        self._reset()
+        for pattern, value in patterns:
+            self.add(pattern, value)
+
+    def _own(self, node):
+        """Return a node this matcher may change, copying a shared one."""
+        if node is None:
+            node = _Node()
+        elif self._owned is None or id(node) in self._owned:
+            return node
+        else:
+            shared, node = node, _Node()
+            node.literals = dict(shared.literals)
+            node.param = shared.param
+            node.rest = shared.rest
+            node.value = shared.value
+        if self._owned is not None:
+            self._owned.add(id(node))
+        return node
+
+    def _walk(self, segments):
+        """Return the node of a pattern's segments, creating its path."""
+        self._root = node = self._own(self._root)
+        for segment in segments:
+            if is_param(segment):
+                node.param = node = self._own(node.param)
+            else:
+                node.literals[segment] = node = self._own(
+                    node.literals.get(segment))
+        return node
+
+    def add(self, pattern, value):
+        """Compile one more pattern, replacing any equal one."""
+        segments = split_path(pattern)
+        rest = bool(segments) and segments[-1] == '*'
+        if rest:
+            segments = segments[:-1]
+        node = self._walk(segments)
+        if rest:
+            self._size += node.rest is _MISSING
+            node.rest = value
+        else:
+            self._size += node.value is _MISSING
+            node.value = value
+        self._reset()
+
+    def copy(self):
+        """Return a matcher sharing these nodes until its changes reach them.
+
+        Adding or removing a pattern then copies only the nodes on its path.
+        """
+        matcher = UrlMatcher()
+        matcher._root = self._root
+        matcher._size = self._size
+        matcher._owned = set()
+        matcher._reset()
+        return matcher
+
+    def remove(self, pattern):
+        """Drop a compiled pattern, leaving its emptied nodes in place."""
+        segments = split_path(pattern)
+        node = self._root
+        rest = bool(segments) and segments[-1] == '*'
+        if rest:
+            segments = segments[:-1]
+        for segment in segments:
+            node = node.param if is_param(segment) else \
+                node.literals.get(segment)
+            if node is None:
+                return
+        if (node.rest if rest else node.value) is _MISSING:
+            return
+        node = self._walk(segments)
+        if rest:
+            node.rest = _MISSING
+        else:
+            node.value = _MISSING
+        self._size -= 1
+        self._reset()
+
+    def match(self, path, default=None):
+        """Return the value of the most specific pattern matching a path."""
+        state = self._start or self._begin()
+        for segment in split_path(path):
+            steps = state.steps
+            if steps is None:
+                steps = self._compile(state)
+            following = steps.get(segment)
+            if following is None:
+                following = state.other if segment else state.empty
+            state = following
+        return default if state.value is _MISSING else state.value
+
+    def _reset(self):
+        """Drop the compiled states, the trie they were built from changed."""
+        self._states = {}
+        self._start = None
+
+    def _begin(self):
+        """Return the state of the trie root, compiling it the first time."""
+        start = self._start = self._state((self._root,), None)
+        return start
+
+    def _state(self, nodes, rest):
+        """Return the state of a set of nodes, creating it once."""
+        key = (nodes, rest)
+        state = self._states.get(key)
+        if state is None:
+            if len(self._states) >= _STATE_LIMIT:
+                self._states = {}
+            state = self._states[key] = _State(nodes, rest)
+        return state
+
+    def _follow(self, state, segment, param):
+        """Return the state a segment leads to from another state.
+
+        Each node hands on its literal child before its parameter child,
+        and a node with a wildcard ends the set, since the nodes after it
+        could only match where its own wildcard already does.
+        """
+        nodes = []
+        rest = state.rest
+        for node in state.nodes:
+            child = node.literals.get(segment)
+            if child is not None:
+                nodes.append(child)
+            if param and node.param is not None:
+                nodes.append(node.param)
+            if node.rest is not _MISSING:
+                rest = node
+                break
+        return self._state(tuple(nodes), rest)
+
+    def _compile(self, state):
+        """Work out where each segment leads from a state, the first time."""
+        segments = set()
+        for node in state.nodes:
+            segments.update(node.literals)
+        steps = dict((segment, self._follow(state, segment, bool(segment)))
+                     for segment in segments)
+        state.other = self._follow(state, None, True)
+        state.empty = self._follow(state, None, False)
+        state.steps = steps
+        return steps
+
+    def __len__(self):
+        """Return the number of compiled patterns."""
+        return self._size
@@ -1,6 +1,8 @@
 """Contain all navigation related data structures in models."""
 
 from datetime import datetime
+from sqlalchemy import event, func, literal, select
+from sqlalchemy.orm.attributes import set_committed_value
 from src import db
 
 
@@ -12,6 +14,14 @@ class Menu(db.Model):
     menu_url = db.Column(db.String(80), nullable=False, unique=True)
     menu_name = db.Column(db.String(80), nullable=False, unique=True)
     menu_text = db.Column(db.Text, nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('nav_menus.menu_id'),
+                          nullable=True, index=True)
+    menu_order = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
+    menu_path = db.Column(db.String(255), nullable=False, default='',
+                          server_default='', index=True)
+    parent = db.relationship('Menu', remote_side=[menu_id],
+                             backref='children')
     menu_roles = db.relationship('users.models.Role',
                                  secondary='nav_roles_menus',
                                  backref=db.backref('menus_roles',
@@ -22,11 +32,14 @@ class Menu(db.Model):
     last_modified_datetime = db.Column(db.DateTime, nullable=True)
     modified_by = db.Column(db.Integer)
 
-    def __init__(self, menu_name, menu_url, menu_text, created_by):
+    def __init__(self, menu_name, menu_url, menu_text, created_by,
+                 parent_id=None, menu_order=0):
         """Set up a new menu url."""
         self.menu_url = menu_url
         self.menu_name = menu_name
         self.menu_text = menu_text
+        self.parent_id = parent_id
+        self.menu_order = menu_order
         self.is_active = True
         self.created_datetime = datetime.now()
         self.confirmation_sent_at = self.created_datetime
@@ -35,3 +48,46 @@ class Menu(db.Model):
     def __repr__(self):
         """Represent an instance of the class."""
         return self.menu_name
+
+
+def menu_path_of(connection, menu_id):
+    """Fetch the materialized path of a menu, '' for the root."""
+    if menu_id is None:
+        return ''
+    menus = Menu.__table__
+    return connection.execute(select([menus.c.menu_path]).where(
+        menus.c.menu_id == menu_id)).scalar() or ''
+
+
+@event.listens_for(Menu, 'after_insert')
+def set_menu_path(mapper, connection, target):
+    """Store the path of a new menu below its parent.
+
+    The path lists the ids from the root down to the menu, each followed by
+    a slash, so a subtree is every menu whose path starts with its root's.
+    """
+    menus = Menu.__table__
+    path = '{}{}/'.format(menu_path_of(connection, target.parent_id),
+                          target.menu_id)
+    connection.execute(menus.update().where(
+        menus.c.menu_id == target.menu_id).values(menu_path=path))
+    set_committed_value(target, 'menu_path', path)
+
+
+@event.listens_for(Menu, 'after_update')
+def move_menu_branch(mapper, connection, target):
+    """Rewrite the paths of a moved menu and of its whole branch at once."""
+    if not db.inspect(target).attrs.parent_id.history.has_changes():
+        return
+    menus = Menu.__table__
+    old_path = menu_path_of(connection, target.menu_id)
+    new_path = '{}{}/'.format(menu_path_of(connection, target.parent_id),
+                              target.menu_id)
+    if new_path.startswith(old_path) and new_path != old_path:
+        raise ValueError('Menu {} cannot be moved below its own branch'
+                         .format(target.menu_name))
+    connection.execute(menus.update().where(
+        menus.c.menu_path.like(old_path + '%')).values(
+            menu_path=literal(new_path, db.String).concat(
+                func.substr(menus.c.menu_path, len(old_path) + 1))))
+    set_committed_value(target, 'menu_path', new_path)
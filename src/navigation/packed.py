@@ -0,0 +1,194 @@
+"""Compact array backed storage for the authorization masks.
+
+The masks of every menu live in a sorted array of menu ids and one flat
+buffer of fixed width little endian rows, instead of a dict of tuples of
+Python ints. A forked worker reading them touches two objects rather than
+thousands, so the pages built before the fork stay shared.
+
+The buffers are never written once built. Masks changed since are held in
+a small persistent overlay in front of them, so a change copies only the
+rows it touches, and are folded into new buffers once the overlay has
+grown to a quarter of them.
+"""
+
+from array import array
+from bisect import bisect_left
+from .persistent import PersistentMap
+
+_UNCHANGED = object()
+
+
+def width_for(mask):
+    """Return the row width in bytes able to hold a mask."""
+    return max(8, -(-mask.bit_length() // 64) * 8)
+
+
+class PackedMasks(object):
+    """Hold one row of action masks per menu in flat buffers.
+
+    The ids, rows, row width, overlay of changed rows and menu count are
+    swapped together as one tuple, so readers never see them out of step.
+    """
+
+    __slots__ = ('_state', '_actions')
+
+    def __init__(self, menu_masks=None, actions=4, width=0):
+        """Pack a {menu_id: (mask, ...)} mapping."""
+        menu_masks = menu_masks or {}
+        top = max((m for masks in menu_masks.values() for m in masks),
+                  default=0)
+        width = max(width, width_for(top))
+        ids = sorted(menu_masks)
+        rows = bytearray(b''.join(self._pack(menu_masks[menu_id], width)
+                                  for menu_id in ids))
+        self._actions = actions
+        self._state = (array('q', ids), rows, width, None, len(ids))
+
+    @classmethod
+    def from_buffers(cls, ids, rows, width, actions=4):
+        """Wrap existing ids and rows, eg a view on a mapped snapshot."""
+        packed = cls(None, actions)
+        packed._state = (ids, rows, width, None, len(ids))
+        return packed
+
+    def copy(self):
+        """Return masks sharing these buffers, later changed on their own."""
+        packed = PackedMasks(None, self._actions)
+        packed._state = self._state
+        return packed
+
+    def buffers(self):
+        """Return the (ids, rows, width) buffers holding every mask."""
+        state = self._state
+        if state[3] is not None:
+            self._state = state = self._fold(state)
+        return state[:3]
+
+    @staticmethod
+    def _pack(masks, width):
+        """Encode the masks of one menu as a row."""
+        return b''.join(m.to_bytes(width, 'little') for m in masks)
+
+    @staticmethod
+    def _find(ids, menu_id):
+        """Return the row position of a menu, or -1."""
+        if menu_id is None:
+            return -1
+        pos = bisect_left(ids, menu_id)
+        if pos < len(ids) and ids[pos] == menu_id:
+            return pos
+        return -1
+
+    def _fold(self, state):
+        """Return a state with the changed rows written into new buffers."""
+        return PackedMasks(dict(self._items(state)), self._actions,
+                           state[2])._state
+
+    def mask(self, menu_id, action):
+        """Return the mask of one action on a menu, 0 when untracked."""
+        ids, rows, width, changed, _ = self._state
+        if changed is not None:
+            masks = changed.get(menu_id, _UNCHANGED)
+            if masks is not _UNCHANGED:
+                return masks[action] if masks else 0
+        pos = self._find(ids, menu_id)
+        if pos < 0:
+            return 0
+        start = (pos * self._actions + action) * width
+        return int.from_bytes(rows[start:start + width], 'little')
+
+    def _get(self, state, menu_id, default=None):
+        """Return the masks of a menu in a state as a tuple."""
+        ids, rows, width, changed, _ = state
+        if changed is not None:
+            masks = changed.get(menu_id, _UNCHANGED)
+            if masks is not _UNCHANGED:
+                return default if masks is None else masks
+        pos = self._find(ids, menu_id)
+        if pos < 0:
+            return default
+        start = pos * self._actions * width
+        return tuple(int.from_bytes(rows[start + a * width:
+                                         start + (a + 1) * width], 'little')
+                     for a in range(self._actions))
+
+    def get(self, menu_id, default=None):
+        """Return the masks of a menu as a tuple."""
+        return self._get(self._state, menu_id, default)
+
+    def __getitem__(self, menu_id):
+        """Return the masks of a tracked menu."""
+        masks = self.get(menu_id)
+        if masks is None:
+            raise KeyError(menu_id)
+        return masks
+
+    def updated(self, changes):
+        """Return masks with some rows replaced, None dropping a menu.
+
+        Changes map menu ids to their new masks. Only the overlay entries
+        of these menus are copied, the buffers are shared.
+        """
+        ids, rows, width, changed, count = state = self._state
+        editor = (changed or PersistentMap()).edit()
+        for menu_id, masks in changes.items():
+            count += ((masks is not None) -
+                      (self._get(state, menu_id) is not None))
+            if masks is None and self._find(ids, menu_id) < 0:
+                editor.pop(menu_id)
+            else:
+                editor[menu_id] = tuple(masks) if masks is not None else None
+        changed = editor.finish() if len(editor) else None
+        state = (ids, rows, width, changed, count)
+        if changed is not None and len(changed) > len(ids) // 4 + 64:
+            state = self._fold(state)
+        packed = PackedMasks(None, self._actions)
+        packed._state = state
+        return packed
+
+    def __setitem__(self, menu_id, masks):
+        """Store the masks of a menu."""
+        self._state = self.updated({menu_id: masks})._state
+
+    def pop(self, menu_id, default=None):
+        """Remove a menu and return its masks."""
+        masks = self.get(menu_id)
+        if masks is None:
+            return default
+        self._state = self.updated({menu_id: None})._state
+        return masks
+
+    def __contains__(self, menu_id):
+        """Tell whether a menu has masks."""
+        return self.get(menu_id) is not None
+
+    def __len__(self):
+        """Return the number of menus with masks."""
+        return self._state[4]
+
+    def _items(self, state):
+        """Iterate over the (menu_id, masks) pairs of a state in order."""
+        ids, _, _, changed, _ = state
+        menu_ids = sorted(set(ids).union(changed)) if changed else ids
+        for menu_id in menu_ids:
+            masks = self._get(state, menu_id)
+            if masks is not None:
+                yield menu_id, masks
+
+    def __iter__(self):
+        """Iterate over the menu ids in order."""
+        return (menu_id for menu_id, _ in self._items(self._state))
+
+    def items(self):
+        """Iterate over (menu_id, masks) pairs."""
+        return self._items(self._state)
+
+    def nbytes(self):
+        """Return the size of the packed buffers and changed rows."""
+        ids, rows, width, changed, _ = self._state
+        return (len(rows) + ids.itemsize * len(ids) +
+                len(changed or ()) * (self._actions * width + ids.itemsize))
+
+    def __repr__(self):
+        """Represent the masks as a dict."""
+        return repr(dict(self.items()))
@@ -0,0 +1,193 @@
+"""Keyset pagination and streamed rendering for the management tables.
+
+Pages are sought with a WHERE clause on the sorted column and the primary
+key as a tiebreaker instead of an OFFSET, so reading page 1000 costs what
+page 1 does. The cursor carried in the url is the primary key of the row a
+page continues from, and its sort value is read back with one primary key
+lookup, so no typed value has to be encoded in the url.
+"""
+
+import time
+from collections import namedtuple
+from flask import Response, get_flashed_messages, stream_with_context
+from sqlalchemy import and_, or_, case, false
+from src import app, db
+
+
+Page = namedtuple('Page', ['rows', 'after', 'before', 'total', 'size',
+                           'truncated'])
+
+_counts = {}
+
+
+def sort_column(model, sort, default):
+    """Return the attribute a table is sorted on, ignoring unknown names."""
+    columns = model.__table__.columns
+    return getattr(model, sort if sort and sort in columns else default)
+
+
+def _beyond(column, value, descending):
+    """Compare a column to a value in the direction of the order."""
+    return column < value if descending else column > value
+
+
+def seek(query, column, key, cursor, descending, backwards):
+    """Restrict and order a query to the rows beyond a cursor row.
+
+    Nullable columns sort their nulls last, whatever the direction. Going
+    backwards the order is reversed, so the page has to be flipped back.
+    """
+    descending = descending != backwards
+    nullable = column.property.columns[0].nullable
+    if cursor is not None:
+        found = db.session.query(column).filter(key == cursor).first()
+        if found is not None:
+            value = found[0]
+            later_key = _beyond(key, cursor, descending)
+            if value is None:
+                clause = and_(column.is_(None), later_key)
+                if backwards:
+                    clause = or_(column.isnot(None), clause)
+            else:
+                clause = or_(_beyond(column, value, descending),
+                             and_(column == value, later_key))
+                if nullable and not backwards:
+                    clause = or_(column.is_(None), clause)
+                elif nullable:
+                    clause = and_(column.isnot(None), clause)
+            query = query.filter(clause)
+    order = [column.desc() if descending else column.asc(),
+             key.desc() if descending else key.asc()]
+    if nullable:
+        null_flag = case([(column.is_(None), 1)], else_=0)
+        order.insert(0, null_flag.desc() if backwards else null_flag.asc())
+    return query.order_by(*order)
+
+
+def keyset_page(query, column, key, reverse=False, after=None, before=None,
+                size=None):
+    """Fetch one page of a query sorted on a column and its primary key.
+
+    After and before are the primary keys of the rows the page follows or
+    precedes. The page carries the cursors of its neighbours, None at
+    either end.
+    """
+    size = size or app.config.get('TABLE_PAGE_SIZE', 50)
+    backwards = after is None and before is not None
+    rows = seek(query, column, key, before if backwards else after,
+                reverse, backwards).limit(size + 1).all()
+    more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+    pk = key.key
+    first = getattr(rows[0], pk) if rows else None
+    last = getattr(rows[-1], pk) if rows else None
+    has_after = more if not backwards else before is not None
+    has_before = more if backwards else after is not None
+    return Page(rows, last if has_after else None,
+                first if has_before else None, None, size, False)
+
+
+def estimate_rows(query):
+    """Read the planner's estimate of the rows a query returns."""
+    statement = query.order_by(None).statement
+    compiled = statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def approximate_count(query, key):
+    """Return a count of the rows a query matches, cached under a key.
+
+    On PostgreSQL the planner's estimate is used instead of a full count.
+    Counts are kept for TABLE_COUNT_SECONDS.
+    """
+    now = time.time()
+    cached = _counts.get(key)
+    if cached and now - cached[1] < app.config.get('TABLE_COUNT_SECONDS', 60):
+        return cached[0]
+    if db.engine.dialect.name == 'postgresql':
+        count = estimate_rows(query)
+    else:
+        count = query.order_by(None).count()
+    if len(_counts) >= app.config.get('TABLE_COUNT_CACHE_SIZE', 1000):
+        _counts.clear()
+    _counts[key] = (count, now)
+    return count
+
+
+def ranked_page(query, key, hits, after=None, before=None, size=None):
+    """Fetch one page of search hits in the order they were ranked.
+
+    After and before are primary keys among the hits, so a page is a slice
+    of the hit list rather than a seek on a column.
+    """
+    size = size or app.config.get('TABLE_PAGE_SIZE', 50)
+    positions = dict((hit, position) for position, hit in enumerate(hits))
+    if after in positions:
+        start = positions[after] + 1
+    elif before in positions:
+        start = max(positions[before] - size, 0)
+    else:
+        start = 0
+    page_hits = hits[start:start + size]
+    rows = query.filter(key.in_(page_hits)).all() if page_hits else []
+    rows.sort(key=lambda row: positions[getattr(row, key.key)])
+    end = start + len(page_hits)
+    return Page(rows, hits[end - 1] if end < len(hits) else None,
+                hits[start] if start > 0 else None, len(hits), size,
+                getattr(hits, 'truncated', False))
+
+
+def paginate(query, model, sort, default_sort, reverse, after=None,
+             before=None, hits=None, row=None):
+    """Page a management table query on a whitelisted sort column.
+
+    Reverse is a bool, after and before the cursors read from the url.
+    Hits are the ranked primary keys of a search, kept in rank order
+    unless a sort column was asked for, and the page is marked truncated
+    when the search was (see search.Hits). Row is a namedtuple type naming
+    the model columns a table shows, primary key included, in which case
+    only those columns are selected and no entities are loaded.
+    """
+    key = getattr(model, model.__mapper__.primary_key[0].key)
+    if row is not None:
+        query = query.with_entities(*[getattr(model, name)
+                                      for name in row._fields])
+    if hits is not None:
+        if sort is None:
+            page = ranked_page(query, key, hits, after, before)
+            return project(page, row)
+        query = query.filter(key.in_(hits) if hits else false())
+    column = sort_column(model, sort, default_sort)
+    page = keyset_page(query, column, key, reverse, after, before)
+    if hits is not None:
+        page = page._replace(total=len(hits),
+                             truncated=getattr(hits, 'truncated', False))
+    else:
+        page = page._replace(total=approximate_count(query,
+                                                     model.__tablename__))
+    return project(page, row)
+
+
+def project(page, row):
+    """Turn the selected columns of a page into rows of a namedtuple type."""
+    if row is None:
+        return page
+    return page._replace(rows=[row._make(values) for values in page.rows])
+
+
+def stream_template(template_name, **context):
+    """Render a template to a streamed response.
+
+    The flashed messages are read first, so the session is saved before the
+    headers are sent.
+    """
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+    return Response(stream_with_context(stream))
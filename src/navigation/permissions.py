@@ -0,0 +1,776 @@
+"""Process wide authorization index shared by every request.
+
+Each role is given a bit position and every tracked menu keeps one integer
+mask per action, so a permission check is a single bitwise AND between the
+user's role mask and the menu's action mask. Endpoints are resolved to their
+menu ids when the index is compiled, so no url is built per request. Menu
+urls may be patterns (see matcher.UrlMatcher), compiled into a trie that
+also resolves request paths to menus.
+
+The index is built once per process and read without locking. Committed
+changes to roles, menus and role menus are applied as deltas building a new
+index next to the published one. Its mappings are persistent (see
+persistent.PersistentMap) and its masks keep changed rows in an overlay, so
+only the entries of the roles and menus in the batch are copied and only
+the affected menus rebuilt. The new index is published with one reference
+swap bumping the generation number. The bits of deleted roles are given to
+the next roles created, so the masks do not grow as roles come and go. A
+full rebuild runs periodically as a consistency check. Every commit also
+bumps a generation counter shared by all worker processes, which the other
+workers check at most once per AUTH_GENERATION_CHECK_MS before reloading.
+
+The masks are packed in flat buffers (see packed.PackedMasks) and the index
+can be built in a pre-fork master with warm_up, so every worker boots with
+it in shared copy-on-write pages. Workers can also boot from a snapshot
+written by dump_snapshot, falling back to the database when the snapshot
+is missing, corrupt or older than the shared generation counter.
+
+Users sharing the same roles share one interned role set id, and decisions
+are memoized per (role set, endpoint, action) in a bounded LRU cache keyed
+on the generation. Pages deciding many links at once use permitted, which
+decides a whole batch in one pass and memoizes it the same way.
+"""
+
+import functools
+import gc
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from flask_login import current_user
+from sqlalchemy import event, func, case
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from src import app, db
+from src.users.models import Role as rol
+from src.users.models import RoleMenu as rol_menu
+from src.users.models import UserRole as usr_rol
+from .models import Menu as menu
+from .generation import SharedGeneration
+from .matcher import UrlMatcher
+from .packed import PackedMasks
+from .persistent import PersistentMap
+from . import snapshot
+
+
+ACTIONS = ('view', 'create', 'edit', 'delete')
+VIEW, CREATE, EDIT, DELETE = range(len(ACTIONS))
+NO_ACCESS = (0,) * len(ACTIONS)
+METHOD_ACTIONS = {'POST': CREATE, 'PUT': EDIT, 'PATCH': EDIT,
+                  'DELETE': DELETE}
+
+AuthIndex = namedtuple('AuthIndex', ['generation', 'role_bits',
+                                     'menu_masks', 'endpoint_menus',
+                                     'menu_urls', 'menu_grants',
+                                     'grant_menus', 'menu_items',
+                                     'url_matcher', 'used_bits'])
+
+_build_lock = threading.RLock()
+_swap_lock = threading.Lock()
+_auth_index = AuthIndex(0, PersistentMap(), PackedMasks(), {},
+                        PersistentMap(), PersistentMap(), PersistentMap(),
+                        PersistentMap(), UrlMatcher(), 0)
+_built_at = 0
+_replay = None
+
+_shared = None
+_seen_shared = 0
+_checked_at = 0
+
+_protected_endpoints = set()
+_endpoint_urls = {}
+
+_role_sets = {}
+_role_set_members = []
+_user_role_sets = {}
+
+
+def protect_endpoint(endpoint):
+    """Register an endpoint guarded by the authorization index."""
+    _protected_endpoints.add(endpoint)
+
+
+def init_app(app):
+    """Resolve the url of every endpoint once the blueprints are registered.
+
+    The index is then built before the first request is served, reporting
+    the protected endpoints that have no matching menu url.
+    """
+    rules = sorted(app.url_map.iter_rules(), key=lambda r: bool(r.arguments))
+    for rule in rules:
+        _endpoint_urls.setdefault(rule.endpoint, rule.rule)
+    app.before_first_request(current_index)
+    app.add_template_global(permitted)
+
+
+def compile_urls(menu_urls):
+    """Compile the menu url patterns into a matcher of menu ids."""
+    return UrlMatcher((url, menu_id) for menu_id, url in menu_urls.items())
+
+
+def resolve_endpoints(menu_urls, endpoint_urls, url_matcher=None):
+    """Map endpoints to the menu ids whose url patterns match their rules."""
+    url_matcher = url_matcher or compile_urls(menu_urls)
+    endpoint_menus = {}
+    for endpoint, url in endpoint_urls.items():
+        menu_id = url_matcher.match(url)
+        if menu_id is not None:
+            endpoint_menus[endpoint] = menu_id
+    return endpoint_menus
+
+
+def menu_for_path(index, path):
+    """Return the id of the menu matching a request path, or None."""
+    return index.url_matcher.match(path)
+
+
+def unmatched_endpoints(index):
+    """List the protected endpoints that no menu url matches."""
+    return sorted(_protected_endpoints.difference(index.endpoint_menus))
+
+
+def grant_flags(grant):
+    """Pack the can_* flags of a role menu into one action bitfield."""
+    return (bool(grant.can_view) << VIEW | bool(grant.can_create) << CREATE |
+            bool(grant.can_edit) << EDIT | bool(grant.can_delete) << DELETE)
+
+
+def combine_bits(role_bits, role_ids):
+    """Combine the bits of the given role ids into one mask."""
+    mask = 0
+    for role_id in role_ids:
+        mask |= role_bits.get(role_id, 0)
+    return mask
+
+
+def action_masks(role_bits, grants):
+    """Build the action masks of one menu from its (role_id, flags)."""
+    masks = [0] * len(ACTIONS)
+    for role_id, flags in grants:
+        bit = role_bits.get(role_id, 0)
+        for action in range(len(ACTIONS)):
+            if flags >> action & 1:
+                masks[action] |= bit
+    return tuple(masks)
+
+
+def fold_grants(grants):
+    """Group role menu rows per menu in one pass.
+
+    Grants are rows carrying role_menu_id, menu_id, role_id and the can_view,
+    can_create, can_edit and can_delete flags.
+    """
+    menu_grants = {}
+    for g in grants:
+        menu_grants.setdefault(g.menu_id, {})[g.role_menu_id] = (
+            g.role_id, grant_flags(g))
+    return menu_grants
+
+
+def fold_aggregates(rows):
+    """Turn rows aggregated per menu by the database into menu grants.
+
+    Each row carries a menu_id followed by aligned arrays of role_menu_id,
+    role_id and packed action flags.
+    """
+    return {menu_id: {rm_id: (role_id, flags) for rm_id, role_id, flags in
+                      zip(rm_ids, role_ids, flag_list)}
+            for menu_id, rm_ids, role_ids, flag_list in rows}
+
+
+def compile_index(role_ids, menu_urls, menu_grants, endpoint_urls,
+                  generation=0, menu_items=None):
+    """Compile roles, menus and grouped role menu grants into an index.
+
+    Menu urls map menu ids to urls, menu grants map menu ids to their
+    {role_menu_id: (role_id, flags)} grants and menu items map menu ids to
+    their (menu_name, menu_text, is_active, parent_id, menu_order) for
+    rendering.
+    """
+    role_bits = {role_id: 1 << pos for pos, role_id in enumerate(role_ids)}
+    menu_masks = PackedMasks({menu_id: action_masks(role_bits,
+                                                    grants.values())
+                              for menu_id, grants in menu_grants.items()},
+                             len(ACTIONS))
+    grant_menus = ((rm_id, menu_id) for menu_id, grants in menu_grants.items()
+                   for rm_id in grants)
+    url_matcher = compile_urls(menu_urls)
+    endpoint_menus = resolve_endpoints(menu_urls, endpoint_urls, url_matcher)
+    return AuthIndex(generation, PersistentMap(role_bits), menu_masks,
+                     endpoint_menus, PersistentMap(menu_urls),
+                     PersistentMap(menu_grants), PersistentMap(grant_menus),
+                     PersistentMap(menu_items or {}), url_matcher,
+                     (1 << len(role_bits)) - 1)
+
+
+def fetch_grants():
+    """Fetch one row per role menu with its action flags."""
+    return db.session.query(rol_menu.role_menu_id, rol_menu.menu_id,
+                            rol_menu.role_id, rol_menu.can_view,
+                            rol_menu.can_create, rol_menu.can_edit,
+                            rol_menu.can_delete).all()
+
+
+def packed_flags():
+    """Return a column packing the can_* flags of role menus as grant_flags."""
+    return sum(case([(getattr(rol_menu, 'can_' + action), 1 << pos)],
+                    else_=0) for pos, action in enumerate(ACTIONS))
+
+
+def fetch_aggregated_grants():
+    """Fetch one row per menu with its role menus aggregated in arrays.
+
+    The grouping is done by the database with array_agg, which needs
+    PostgreSQL.
+    """
+    flags = packed_flags()
+    arrays = [func.array_agg(aggregate_order_by(column,
+                                                rol_menu.role_menu_id))
+              for column in (rol_menu.role_menu_id, rol_menu.role_id, flags)]
+    return db.session.query(rol_menu.menu_id, *arrays) \
+        .group_by(rol_menu.menu_id).all()
+
+
+def load_index():
+    """Fetch the roles, menus and role menu grants and compile them.
+
+    With AUTH_INDEX_AGGREGATE set the grants are grouped per menu by the
+    database where it supports it, otherwise they are grouped in one pass
+    over the role menu rows.
+    """
+    role_ids = [r.role_id for r in
+                db.session.query(rol.role_id).order_by(rol.role_id)]
+    menu_urls, menu_items = {}, {}
+    for m in db.session.query(menu.menu_id, menu.menu_url, menu.menu_name,
+                              menu.menu_text, menu.is_active, menu.parent_id,
+                              menu.menu_order):
+        menu_urls[m.menu_id] = m.menu_url
+        menu_items[m.menu_id] = (m.menu_name, m.menu_text, bool(m.is_active),
+                                 m.parent_id, m.menu_order)
+    if (app.config.get('AUTH_INDEX_AGGREGATE', False) and
+            db.engine.dialect.name == 'postgresql'):
+        menu_grants = fold_aggregates(fetch_aggregated_grants())
+    else:
+        menu_grants = fold_grants(fetch_grants())
+    index = compile_index(role_ids, menu_urls, menu_grants, _endpoint_urls,
+                          menu_items=menu_items)
+    for endpoint in unmatched_endpoints(index):
+        app.logger.warning('Protected endpoint %s (%s) has no matching '
+                           'menu url', endpoint, _endpoint_urls.get(endpoint))
+    return index
+
+
+def snapshot_path():
+    """Return the configured snapshot file, if any."""
+    return app.config.get('AUTH_SNAPSHOT_FILE')
+
+
+def dump_snapshot(path=None):
+    """Load the index from the database and write it to a snapshot file.
+
+    The snapshot is stamped with the shared generation counter read before
+    loading, so any change committed since makes it stale.
+    """
+    path = path or snapshot_path()
+    shared_stamp = read_shared_stamp()
+    index = load_index()
+    snapshot.write_snapshot(path, shared_stamp, index)
+    return index
+
+
+def load_snapshot(path=None):
+    """Build the index from a snapshot file.
+
+    Return None when there is no snapshot, when it cannot be read or when
+    its stamp does not match the shared generation counter.
+    """
+    path = path or snapshot_path()
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        parts = snapshot.read_snapshot(path)
+    except snapshot.SnapshotError as e:
+        app.logger.warning('Ignoring authorization snapshot %s: %s', path, e)
+        return None
+    if parts['stamp'] != read_shared_stamp():
+        app.logger.info('Authorization snapshot %s is stale', path)
+        return None
+    menu_grants = parts['menu_grants']
+    grant_menus = ((rm_id, menu_id) for menu_id, grants in menu_grants.items()
+                   for rm_id in grants)
+    menu_masks = PackedMasks.from_buffers(*parts['masks'],
+                                          actions=len(ACTIONS))
+    role_bits = parts['role_bits']
+    url_matcher = compile_urls(parts['menu_urls'])
+    index = AuthIndex(0, PersistentMap(role_bits), menu_masks,
+                      resolve_endpoints(parts['menu_urls'], _endpoint_urls,
+                                        url_matcher),
+                      PersistentMap(parts['menu_urls']),
+                      PersistentMap(menu_grants), PersistentMap(grant_menus),
+                      PersistentMap(parts['menu_items']), url_matcher,
+                      combine_bits(role_bits, role_bits))
+    for endpoint in unmatched_endpoints(index):
+        app.logger.warning('Protected endpoint %s (%s) has no matching '
+                           'menu url', endpoint, _endpoint_urls.get(endpoint))
+    return index
+
+
+def shared_generation():
+    """Return the counter shared between workers, if one is configured."""
+    global _shared
+    if _shared is None:
+        path = app.config.get('AUTH_GENERATION_FILE')
+        _shared = SharedGeneration(path) if path else False
+    return _shared or None
+
+
+def read_shared_generation():
+    """Read the counter shared between workers, 0 when there is none."""
+    shared = shared_generation()
+    return shared.read() if shared else 0
+
+
+def read_shared_stamp():
+    """Return the (file id, value) of the shared counter, (0, 0) without."""
+    shared = shared_generation()
+    return (shared.file_id, shared.read()) if shared else (0, 0)
+
+
+def announce_change():
+    """Bump the shared counter so the other workers reload their caches."""
+    global _seen_shared
+    shared = shared_generation()
+    if shared:
+        with _swap_lock:
+            value = shared.bump()
+            if value == _seen_shared + 1:
+                _seen_shared = value
+
+
+def publish_index(index, shared_stamp=None):
+    """Swap in a new index and bump the generation number.
+
+    Deltas committed while the index was being loaded are replayed on it
+    first so none are lost. The cached user role sets are dropped since
+    they may have changed in another worker.
+    """
+    global _auth_index, _built_at, _replay, _seen_shared
+    with _swap_lock:
+        if _replay:
+            index = _apply_deltas(index, _replay)
+        _replay = None
+        _auth_index = index._replace(generation=_auth_index.generation + 1)
+        _built_at = time.time()
+        if shared_stamp is not None:
+            _seen_shared = shared_stamp
+    _user_role_sets.clear()
+    clear_decisions()
+    return _auth_index
+
+
+def rebuild_index(from_snapshot=False):
+    """Reload the index and publish it.
+
+    With from_snapshot set a current snapshot is used instead of the
+    database when there is one.
+    """
+    global _replay
+    with _build_lock:
+        with _swap_lock:
+            _replay = []
+        try:
+            shared_stamp = read_shared_generation()
+            index = load_snapshot() if from_snapshot else None
+            if index is None:
+                index = load_index()
+        except Exception:
+            with _swap_lock:
+                _replay = None
+            raise
+        return publish_index(index, shared_stamp)
+
+
+def warm_up(server=None):
+    """Build the index in a master process before it forks its workers.
+
+    Callable as a gunicorn on_starting/when_ready hook. The database
+    connections used for the build are closed so no worker inherits them,
+    and the objects built so far are moved out of the garbage collector's
+    reach so its passes do not dirty the shared pages.
+    """
+    with app.app_context():
+        index = rebuild_index(from_snapshot=True)
+        db.session.remove()
+        db.engine.dispose()
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return index
+
+
+def is_stale():
+    """Tell whether the published index must be reloaded.
+
+    It is when AUTH_INDEX_REBUILD_SECONDS have passed since the last build,
+    or when another worker has announced a change. The shared counter is
+    read at most once per AUTH_GENERATION_CHECK_MS.
+    """
+    global _checked_at
+    now = time.time()
+    if now - _built_at > app.config.get('AUTH_INDEX_REBUILD_SECONDS', 300):
+        return True
+    if (now - _checked_at) * 1000 < app.config.get(
+            'AUTH_GENERATION_CHECK_MS', 500):
+        return False
+    _checked_at = now
+    return read_shared_generation() != _seen_shared
+
+
+def current_index():
+    """Return the published index, building it on first use.
+
+    When the index is stale one request reloads it while the others keep
+    using the published one.
+    """
+    index = _auth_index
+    if not index.generation:
+        with _build_lock:
+            if not _auth_index.generation:
+                rebuild_index(from_snapshot=True)
+            index = _auth_index
+    elif is_stale():
+        if _build_lock.acquire(False):
+            try:
+                index = rebuild_index()
+            finally:
+                _build_lock.release()
+    return index
+
+
+def _apply_deltas(index, deltas):
+    """Apply role, menu and role menu deltas to a new index.
+
+    Only the entries of the roles, menus and role menus in the deltas are
+    copied, and only the action masks of the menus whose grants changed are
+    rebuilt. The endpoints are resolved again when a menu url changed. The
+    index given is left as it was for the requests still reading it, the
+    new one is returned.
+
+    A new role takes the lowest bit no role holds, so the bits of deleted
+    roles are reused. Deleting a role rebuilds the masks of the menus it
+    had grants on, which clears its bit before it is handed out again.
+    """
+    role_bits = index.role_bits.edit()
+    menu_urls, menu_items = index.menu_urls.edit(), index.menu_items.edit()
+    menu_grants = index.menu_grants.edit()
+    grant_menus = index.grant_menus.edit()
+    used_bits = index.used_bits
+    url_matcher = index.url_matcher
+    copied = set()
+
+    def grants_of(menu_id):
+        if menu_id not in copied:
+            menu_grants[menu_id] = dict(menu_grants.get(menu_id, {}))
+            copied.add(menu_id)
+        return menu_grants[menu_id]
+
+    touched = set()
+    for (kind, key), value in sorted(deltas, key=lambda d: d[0][0] != 'role'):
+        if kind == 'role':
+            if value is None:
+                used_bits &= ~role_bits.pop(key, 0)
+                touched.update(menu_id for menu_id, grants in
+                               index.menu_grants.items() if any(
+                                   role_id == key for role_id, _ in
+                                   grants.values()))
+            elif key not in role_bits:
+                role_bits[key] = bit = ~used_bits & (used_bits + 1)
+                used_bits |= bit
+        elif kind == 'menu':
+            old_url = menu_urls.get(key)
+            new_url = value[0] if value is not None else None
+            if old_url != new_url:
+                if url_matcher is index.url_matcher:
+                    url_matcher = url_matcher.copy()
+                if old_url is not None:
+                    url_matcher.remove(old_url)
+                if new_url is not None:
+                    url_matcher.add(new_url, key)
+            if value is None:
+                menu_urls.pop(key)
+                menu_items.pop(key)
+                touched.add(key)
+            else:
+                menu_urls[key] = new_url
+                menu_items[key] = value[1:]
+        elif kind == 'grant':
+            old_menu = grant_menus.pop(key)
+            if old_menu is not None:
+                grants_of(old_menu).pop(key, None)
+                touched.add(old_menu)
+            if value is not None:
+                menu_id, role_id, flags = value
+                grants_of(menu_id)[key] = (role_id, flags)
+                grant_menus[key] = menu_id
+                touched.add(menu_id)
+    role_bits = role_bits.finish()
+    changed_masks = {}
+    for menu_id in touched:
+        grants = menu_grants.get(menu_id)
+        if grants:
+            changed_masks[menu_id] = action_masks(role_bits, grants.values())
+        else:
+            menu_grants.pop(menu_id)
+            changed_masks[menu_id] = None
+    menu_masks = index.menu_masks
+    if changed_masks:
+        menu_masks = menu_masks.updated(changed_masks)
+    menu_urls = menu_urls.finish()
+    endpoint_menus = index.endpoint_menus
+    if url_matcher is not index.url_matcher:
+        endpoint_menus = resolve_endpoints(menu_urls, _endpoint_urls,
+                                           url_matcher)
+    return index._replace(role_bits=role_bits, menu_masks=menu_masks,
+                          endpoint_menus=endpoint_menus, menu_urls=menu_urls,
+                          menu_grants=menu_grants.finish(),
+                          grant_menus=grant_menus.finish(),
+                          menu_items=menu_items.finish(),
+                          url_matcher=url_matcher, used_bits=used_bits)
+
+
+def apply_deltas(deltas):
+    """Apply committed deltas to the published index and bump its generation.
+
+    Deltas are ((kind, key), value) pairs where kind is 'role', 'menu' or
+    'grant' and a value of None records a deletion. Menu values are
+    (menu_url, menu_name, menu_text, is_active, parent_id, menu_order)
+    tuples.
+    """
+    global _auth_index
+    with _swap_lock:
+        if _replay is not None:
+            _replay.extend(deltas)
+        if not _auth_index.generation:
+            return _auth_index
+        _auth_index = _apply_deltas(_auth_index, deltas)._replace(
+            generation=_auth_index.generation + 1)
+    clear_decisions()
+    return _auth_index
+
+
+def role_mask(index, role_ids):
+    """Combine the bits of the given roles into one mask."""
+    return combine_bits(index.role_bits, role_ids)
+
+
+def is_permitted(index, user_mask, menu_id, action=VIEW):
+    """Check whether a role mask grants an action on a menu."""
+    return bool(index.menu_masks.mask(menu_id, action) & user_mask)
+
+
+def endpoint_permitted(index, user_mask, endpoint, action=VIEW):
+    """Check whether a role mask grants an action on an endpoint.
+
+    Endpoints not guarded by has_required_roles are always allowed, guarded
+    ones no menu url matches never are.
+    """
+    if endpoint not in _protected_endpoints:
+        return True
+    return is_permitted(index, user_mask, index.endpoint_menus.get(endpoint),
+                        action)
+
+
+def intern_role_set(role_ids):
+    """Return the stable id shared by every user holding these roles."""
+    key = frozenset(role_ids)
+    role_set_id = _role_sets.get(key)
+    if role_set_id is None:
+        with _swap_lock:
+            role_set_id = _role_sets.get(key)
+            if role_set_id is None:
+                role_set_id = len(_role_set_members)
+                _role_set_members.append(key)
+                _role_sets[key] = role_set_id
+    return role_set_id
+
+
+def role_set_roles(role_set_id):
+    """Return the role ids of an interned role set."""
+    return _role_set_members[role_set_id]
+
+
+def user_role_set(user):
+    """Return the interned role set id of a user."""
+    role_set_id = _user_role_sets.get(user.user_id)
+    if role_set_id is None:
+        role_set_id = intern_role_set(r.role_id for r in user.roles)
+        if len(_user_role_sets) >= app.config.get('AUTH_USER_CACHE_SIZE',
+                                                  10000):
+            _user_role_sets.clear()
+        _user_role_sets[user.user_id] = role_set_id
+    return role_set_id
+
+
+@functools.lru_cache(maxsize=app.config.get('AUTH_DECISION_CACHE_SIZE', 4096))
+def _decide(role_set_id, endpoint, action, generation):
+    """Compute a decision for a role set against the current index."""
+    index = current_index()
+    user_mask = role_mask(index, role_set_roles(role_set_id))
+    return endpoint_permitted(index, user_mask, endpoint, action)
+
+
+def is_authorized(role_set_id, endpoint, action=VIEW):
+    """Return the memoized decision for a role set on an endpoint."""
+    return _decide(role_set_id, endpoint, action, current_index().generation)
+
+
+def action_index(action):
+    """Return the index of an action given by index or by name."""
+    if isinstance(action, str):
+        return ACTIONS.index(action)
+    return action
+
+
+def request_action(request, intents=()):
+    """Map a request to the action it performs, without touching the db.
+
+    Reads are views. For other methods the intents are tried in order, each
+    a (key, action) pair where the key names a posted field, eg the submit
+    button of a form, a field=value pair or a ?query argument, eg '?menu'
+    when editing the menu picked in the url. Without a matching intent the
+    HTTP method decides.
+
+    The posted fields are chosen by the browser, so this is only the check
+    made before the view runs. Views with several branches check the action
+    of the branch that does the work with allows.
+    """
+    if request.method not in METHOD_ACTIONS:
+        return VIEW
+    for key, action in intents:
+        if key.startswith('?'):
+            given = request.args.get(key[1:])
+            expected = ''
+        else:
+            name, _, expected = key.partition('=')
+            given = request.form.get(name)
+        if given and (not expected or given == expected):
+            return action_index(action)
+    return METHOD_ACTIONS[request.method]
+
+
+def current_role_set():
+    """Return the interned role set id of the current user, if any."""
+    if current_user and current_user.is_authenticated:
+        return user_role_set(current_user)
+    return intern_role_set(())
+
+
+def normalize_check(check):
+    """Turn an endpoint or (endpoint, action) check into (endpoint, action).
+
+    Actions may be given by index or by name, eg ('users.users_processing',
+    'edit').
+    """
+    if isinstance(check, str):
+        return check, VIEW
+    endpoint, action = check
+    return endpoint, action_index(action)
+
+
+@functools.lru_cache(maxsize=app.config.get('AUTH_DECISION_CACHE_SIZE', 4096))
+def _decide_many(role_set_id, checks, generation):
+    """Decide a batch of (endpoint, action) checks with one role mask."""
+    index = current_index()
+    user_mask = role_mask(index, role_set_roles(role_set_id))
+    return tuple(endpoint_permitted(index, user_mask, endpoint, action)
+                 for endpoint, action in checks)
+
+
+def authorize_many(role_set_id, checks):
+    """Return the decisions of a role set on several checks, in order."""
+    checks = tuple(normalize_check(check) for check in checks)
+    return _decide_many(role_set_id, checks, current_index().generation)
+
+
+def allows(endpoint, action):
+    """Tell whether the current user may perform an action on an endpoint."""
+    return authorize_many(current_role_set(), [(endpoint, action)])[0]
+
+
+def permitted(*checks):
+    """Decide checks for the current user, keyed as they were given.
+
+    Exposed to the templates, eg
+    `{% set allowed = permitted('users.users_processing',
+    ('navigation.navmenus', 'edit')) %}`.
+    """
+    return dict(zip(checks, authorize_many(current_role_set(), checks)))
+
+
+def clear_decisions():
+    """Drop every memoized authorization decision."""
+    _decide.cache_clear()
+    _decide_many.cache_clear()
+
+
+def record_change(session, kind, key, value=True):
+    """Note an authorization change to apply when the session commits.
+
+    Bulk statements that bypass the unit of work use this to report the
+    rows they touched.
+    """
+    changes = session.info.setdefault('auth_changes', OrderedDict())
+    changes.pop((kind, key), None)
+    changes[(kind, key)] = value
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_auth_changes(session, flush_context):
+    """Note the authorization rows the flush inserted, updated or deleted."""
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, rol_menu):
+            record_change(session, 'grant', obj.role_menu_id,
+                          (obj.menu_id, obj.role_id, grant_flags(obj)))
+        elif isinstance(obj, menu):
+            record_change(session, 'menu', obj.menu_id,
+                          (obj.menu_url, obj.menu_name, obj.menu_text,
+                           obj.is_active not in (False, 'False'),
+                           obj.parent_id, obj.menu_order or 0))
+        elif isinstance(obj, rol):
+            record_change(session, 'role', obj.role_id)
+        elif isinstance(obj, usr_rol):
+            record_change(session, 'user', obj.user_id)
+    for obj in session.deleted:
+        if isinstance(obj, rol_menu):
+            record_change(session, 'grant', obj.role_menu_id, None)
+        elif isinstance(obj, menu):
+            record_change(session, 'menu', obj.menu_id, None)
+        elif isinstance(obj, rol):
+            record_change(session, 'role', obj.role_id, None)
+        elif isinstance(obj, usr_rol):
+            record_change(session, 'user', obj.user_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_auth_changes(session):
+    """Apply the committed changes to the index and the role set cache.
+
+    The other workers are told about the change through the shared counter.
+    """
+    changes = session.info.pop('auth_changes', None)
+    if not changes:
+        return
+    deltas = []
+    for (kind, key), value in changes.items():
+        if kind == 'user':
+            _user_role_sets.pop(key, None)
+        else:
+            deltas.append(((kind, key), value))
+    if deltas:
+        apply_deltas(deltas)
+    announce_change()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_auth_changes(session):
+    """Forget the changes noted by a rolled back transaction."""
+    session.info.pop('auth_changes', None)
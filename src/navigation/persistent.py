@@ -0,0 +1,196 @@
+"""Persistent mapping sharing everything but the entries a change touches.
+
+The index published to the requests is never changed in place, so applying
+a delta means building a new mapping next to the old one. A plain dict
+would have to be copied whole for every delta. Here the entries live in
+small dict buckets at the leaves of a trie of 32 way nodes keyed on their
+hash, and a change copies only the bucket holding the key and the nodes on
+its path, sharing every other bucket with the mapping it came from.
+
+Changes are made through an Editor, which copies each node at most once
+however many keys of a batch fall in it, and whose result is a new
+PersistentMap. The trie is laid out again when the mapping has grown well
+past the size its depth was chosen for.
+"""
+
+from collections.abc import Mapping
+
+_BITS = 5
+_FANOUT = 1 << _BITS
+_MASK = _FANOUT - 1
+_BUCKET = 8
+
+
+def depth_for(size):
+    """Return the trie depth keeping the buckets of a mapping small."""
+    depth = 0
+    while _BUCKET << (_BITS * depth) < size:
+        depth += 1
+    return depth
+
+
+def _build(items, depth):
+    """Lay out (key, value) pairs in a trie of the given depth."""
+    nodes = [{} for _ in range(1 << (_BITS * depth))]
+    mask = len(nodes) - 1
+    for key, value in items:
+        nodes[hash(key) & mask][key] = value
+    for _ in range(depth):
+        nodes = [nodes[start:start + _FANOUT]
+                 for start in range(0, len(nodes), _FANOUT)]
+    return nodes[0]
+
+
+def _buckets(node, depth):
+    """Iterate over the dict buckets of a trie."""
+    if not depth:
+        yield node
+        return
+    for child in node:
+        yield from _buckets(child, depth - 1)
+
+
+class PersistentMap(Mapping):
+    """Read only mapping whose changes are made through an Editor."""
+
+    __slots__ = ('_root', '_depth', '_size')
+
+    def __init__(self, items=()):
+        """Build a mapping from a mapping or (key, value) pairs."""
+        if not isinstance(items, Mapping):
+            items = dict(items)
+        self._depth = depth_for(len(items))
+        self._root = _build(items.items(), self._depth)
+        self._size = len(items)
+
+    @classmethod
+    def _wrap(cls, root, depth, size):
+        """Wrap an already laid out trie."""
+        mapping = cls.__new__(cls)
+        mapping._root = root
+        mapping._depth = depth
+        mapping._size = size
+        return mapping
+
+    def _bucket(self, key):
+        """Return the bucket a key falls in."""
+        node = self._root
+        code = hash(key)
+        for level in range(self._depth - 1, -1, -1):
+            node = node[code >> (_BITS * level) & _MASK]
+        return node
+
+    def __getitem__(self, key):
+        """Return the value of a key."""
+        return self._bucket(key)[key]
+
+    def get(self, key, default=None):
+        """Return the value of a key, or default."""
+        return self._bucket(key).get(key, default)
+
+    def __contains__(self, key):
+        """Tell whether a key is held."""
+        return key in self._bucket(key)
+
+    def __iter__(self):
+        """Iterate over the keys."""
+        for bucket in _buckets(self._root, self._depth):
+            yield from bucket
+
+    def items(self):
+        """Iterate over the (key, value) pairs."""
+        for bucket in _buckets(self._root, self._depth):
+            yield from bucket.items()
+
+    def values(self):
+        """Iterate over the values."""
+        for bucket in _buckets(self._root, self._depth):
+            yield from bucket.values()
+
+    def __len__(self):
+        """Return the number of keys."""
+        return self._size
+
+    def __repr__(self):
+        """Represent the mapping as a dict."""
+        return 'PersistentMap({!r})'.format(dict(self.items()))
+
+    def edit(self):
+        """Return an Editor for a new mapping starting from this one."""
+        return Editor(self)
+
+
+class Editor(object):
+    """Gather the changes of a batch into a new PersistentMap."""
+
+    def __init__(self, mapping):
+        """Start from a mapping, which is left untouched."""
+        self._root = mapping._root
+        self._depth = mapping._depth
+        self._size = mapping._size
+        self._owned = set()
+
+    def _own(self, node):
+        """Return a node this editor may change, copying it the first time."""
+        if id(node) in self._owned:
+            return node
+        node = list(node) if isinstance(node, list) else dict(node)
+        self._owned.add(id(node))
+        return node
+
+    def _bucket(self, key):
+        """Return the bucket of a key, copying its path the first time."""
+        self._root = node = self._own(self._root)
+        code = hash(key)
+        for level in range(self._depth - 1, -1, -1):
+            slot = code >> (_BITS * level) & _MASK
+            node[slot] = node = self._own(node[slot])
+        return node
+
+    def _find(self, key):
+        """Return the bucket of a key without copying anything."""
+        node = self._root
+        code = hash(key)
+        for level in range(self._depth - 1, -1, -1):
+            node = node[code >> (_BITS * level) & _MASK]
+        return node
+
+    def __getitem__(self, key):
+        """Return the value of a key."""
+        return self._find(key)[key]
+
+    def get(self, key, default=None):
+        """Return the value of a key, or default."""
+        return self._find(key).get(key, default)
+
+    def __contains__(self, key):
+        """Tell whether a key is held."""
+        return key in self._find(key)
+
+    def __setitem__(self, key, value):
+        """Set the value of a key."""
+        bucket = self._bucket(key)
+        self._size += key not in bucket
+        bucket[key] = value
+
+    def pop(self, key, default=None):
+        """Remove a key and return its value, or default."""
+        if key not in self._find(key):
+            return default
+        self._size -= 1
+        return self._bucket(key).pop(key)
+
+    def __len__(self):
+        """Return the number of keys."""
+        return self._size
+
+    def finish(self):
+        """Return the edited mapping, laid out again when it outgrew its trie.
+
+        The editor must not be used afterwards.
+        """
+        mapping = PersistentMap._wrap(self._root, self._depth, self._size)
+        if self._size > 4 * (_BUCKET << (_BITS * self._depth)):
+            mapping = PersistentMap(mapping.items())
+        self._owned = None
+        return mapping
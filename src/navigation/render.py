@@ -0,0 +1,236 @@
+"""Compiled rendering of the management tables.
+
+Tables are declared the way flask_table declares them, with Col, BoolCol
+and LinkCol attributes in display order, and render the same markup. On
+first use a table class is compiled into one row format string holding
+every tag and attribute, and one small function per cell filling in the
+values. Link and sort urls are built with url_for once, with marker values
+standing in for the row values, and split around the markers into a
+prefix the rows only have to append their quoted values to.
+"""
+
+import re
+from collections import namedtuple
+from operator import attrgetter
+from flask import request, url_for
+from markupsafe import Markup, escape
+from werkzeug.urls import url_quote, url_quote_plus
+
+_MARKER = '__row_value_{}__'
+_MARKERS = re.compile('__row_value_([0-9]+)__')
+
+SortArgs = namedtuple('SortArgs', ['sort', 'direction'])
+
+
+class Col(object):
+    """Show a row attribute as escaped text, '' for None."""
+
+    _counter = 0
+
+    def __init__(self, name, attr=None, allow_sort=True,
+                 td_html_attrs=None, th_html_attrs=None):
+        """Set up a column headed name, reading attr or its own key."""
+        self.name = name
+        self.attr = attr
+        self.allow_sort = allow_sort
+        self.td_html_attrs = td_html_attrs or {}
+        self.th_html_attrs = th_html_attrs or {}
+        self._order = Col._counter
+        Col._counter += 1
+
+    def content(self, key):
+        """Return the format of the cell content and its value function."""
+        get = attrgetter(self.attr or key)
+
+        def cell(row):
+            value = get(row)
+            if callable(value):
+                value = value()
+            return '' if value is None else escape(value)
+        return '{}', cell
+
+
+class BoolCol(Col):
+    """Show a row attribute as Yes or No."""
+
+    def content(self, key):
+        """Return the format of the cell content and its value function."""
+        get = attrgetter(self.attr or key)
+        return '{}', lambda row: 'Yes' if get(row) else 'No'
+
+
+class LinkCol(Col):
+    """Show a link to an endpoint, filled in with row attributes.
+
+    Url_kwargs maps the endpoint arguments to the row attributes giving
+    them, eg dict(user_name='user_name').
+    """
+
+    def __init__(self, name, endpoint, url_kwargs=None, anchor_attrs=None,
+                 **kwargs):
+        """Set up a column linking to an endpoint."""
+        super(LinkCol, self).__init__(name, **kwargs)
+        self.endpoint = endpoint
+        self.url_kwargs = url_kwargs or {}
+        self.anchor_attrs = anchor_attrs or {}
+
+    def content(self, key):
+        """Return the format of the cell content and its value function."""
+        href = url_builder(self.endpoint, self.url_kwargs)
+        attrs = braces(format_attrs(dict(self.anchor_attrs,
+                                         href=_MARKER.format(0))))
+        anchor = '<a{}>{}</a>'.format(
+            attrs.replace(_MARKER.format(0), '{}'), braces(escape(self.name)))
+        return anchor, href
+
+
+def braces(text):
+    """Escape the braces of markup going into a format string."""
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def format_attrs(attrs):
+    """Format html attributes, sorted and escaped as flask_table does."""
+    return ''.join(' {}="{}"'.format(escape(name), escape(value))
+                   for name, value in sorted(attrs.items()))
+
+
+def url_builder(endpoint, url_kwargs):
+    """Return a function building the url of an endpoint for a row.
+
+    The url is built once with markers for the row values. Each row then
+    joins the literal pieces with its values, quoted as url_for would quote
+    them in the path or in the query string.
+    """
+    names = list(url_kwargs)
+    url = url_for(endpoint, **dict((name, _MARKER.format(n))
+                                   for n, name in enumerate(names)))
+    path_end = url.find('?')
+    pieces = []
+    position = 0
+    for match in _MARKERS.finditer(url):
+        name = names[int(match.group(1))]
+        quote = url_quote if path_end < 0 or match.start() < path_end \
+            else url_quote_plus
+        pieces.append((str(escape(url[position:match.start()])),
+                       attrgetter(url_kwargs[name]), quote))
+        position = match.end()
+    tail = str(escape(url[position:]))
+
+    def href(row):
+        return ''.join([literal + quote(str(get(row)))
+                        for literal, get, quote in pieces]) + tail
+    return href
+
+
+class CompiledTable(object):
+    """Holds the row format and cell functions of a compiled table."""
+
+    def __init__(self, table):
+        """Compile the columns of a table class."""
+        cells = []
+        row_format = ['<tr>']
+        self.columns = table.columns()
+        for key, col in self.columns:
+            content, cell = col.content(key)
+            row_format.append('<td{}>{}</td>'.format(
+                braces(format_attrs(col.td_html_attrs)), content))
+            cells.append(cell)
+        row_format.append('</tr>')
+        self.row_format = ''.join(row_format)
+        self.cells = cells
+        self.sort_href = None
+        if table.allow_sort:
+            self.sort_href = url_builder(table.sort_endpoint,
+                                         dict(sort='sort',
+                                              direction='direction'))
+
+    def rows(self, items):
+        """Render the rows of the table body."""
+        fmt = self.row_format.format
+        cells = self.cells
+        return '\n'.join([fmt(*[cell(row) for cell in cells])
+                          for row in items])
+
+
+class Table(object):
+    """Render rows as an html table, sortable on its columns.
+
+    Subclasses declare their columns as class attributes, and the endpoint
+    the sort links point at as sort_endpoint.
+    """
+
+    html_attrs = None
+    classes = []
+    thead_attrs = None
+    allow_sort = False
+    sort_endpoint = None
+    no_items = 'No Items'
+
+    def __init__(self, items, sort_by=None, sort_reverse=False):
+        """Hold the rows to render and the column they are sorted on."""
+        self.items = items
+        self.sort_by = sort_by
+        self.sort_reverse = sort_reverse
+
+    @classmethod
+    def columns(cls):
+        """Return the (key, column) pairs in declaration order."""
+        found = {}
+        for klass in reversed(cls.__mro__):
+            for key, value in vars(klass).items():
+                if isinstance(value, Col):
+                    found[key] = value
+        return sorted(found.items(), key=lambda item: item[1]._order)
+
+    @classmethod
+    def compiled(cls):
+        """Return the table compiled for the script root being served."""
+        compiled = cls.__dict__.get('_compiled')
+        if compiled is None:
+            compiled = {}
+            cls._compiled = compiled
+        root = request.script_root
+        if root not in compiled:
+            compiled[root] = CompiledTable(cls)
+        return compiled[root]
+
+    def th(self, compiled, key, col):
+        """Render one header cell, linked to sort on it where allowed."""
+        label = escape(col.name)
+        if self.allow_sort and col.allow_sort:
+            direction = 'asc'
+            if self.sort_by == key:
+                if self.sort_reverse:
+                    label = escape('↑') + label
+                else:
+                    direction = 'desc'
+                    label = escape('↓') + label
+            label = '<a href="{}">{}</a>'.format(
+                compiled.sort_href(SortArgs(key, direction)), label)
+        return '<th{}>{}</th>'.format(format_attrs(col.th_html_attrs),
+                                       label)
+
+    def thead(self, compiled):
+        """Render the table header."""
+        return '<thead{}><tr>{}</tr></thead>'.format(
+            format_attrs(self.thead_attrs or {}),
+            ''.join(self.th(compiled, key, col)
+                    for key, col in compiled.columns))
+
+    def __html__(self):
+        """Render the table, or a paragraph when there are no rows."""
+        if not self.items:
+            return Markup('<p>{}</p>').format(self.no_items)
+        compiled = self.compiled()
+        attrs = dict(self.html_attrs or {})
+        if self.classes:
+            attrs['class'] = ' '.join(self.classes)
+        html = '<table{}>\n{}\n<tbody>\n{}\n</tbody>\n</table>'.format(
+            format_attrs(attrs), self.thead(compiled),
+            compiled.rows(self.items))
+        return Markup(html)
+
+    def __str__(self):
+        """Render the table."""
+        return self.__html__()
@@ -0,0 +1,459 @@
+"""Search boxes and pickers of the user, role and menu pages.
+
+On PostgreSQL with the pg_trgm extension installed the search is an ILIKE
+over the searched columns, which the trigram GIN indexes created in
+flask_user_menus_db_schema.sql serve without a table scan, ranked by the
+trigram similarity of the best matching column.
+
+Elsewhere each searched model gets an in-process trigram index, built on
+its first search and kept current by the committed inserts, updates and
+deletes of the session. A term is looked up by intersecting the rows
+holding each of its trigrams and then checking the substring on those few
+rows only. Commits changing a searched or picked column also bump a
+counter per model shared by the worker processes, so the other workers
+drop the indexes of that model and build them again on next use.
+
+Both ways return at most SEARCH_RESULT_LIMIT primary keys, best first,
+flagged as truncated when more rows hold the term, so the pages can say
+that the search has to be narrowed to reach the others.
+
+The role, menu and user pickers are served from a PrefixIndex per picker,
+holding the labels of the rows the picker offers in sorted order, so a
+typeahead lookup is a binary search and a slice. They are kept current the
+same way as the trigram indexes.
+"""
+
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple, OrderedDict
+from sqlalchemy import event, func, inspect, or_
+from src import app, db
+from src.users.models import User as usr
+from src.users.models import Role as rol
+from .models import Menu as menu
+from .generation import SharedGeneration
+
+SEARCH_COLUMNS = OrderedDict([
+    (usr, ('user_name', 'first_name', 'last_name', 'email')),
+    (rol, ('role_name', 'role_description')),
+    (menu, ('menu_text', 'menu_url')),
+])
+
+Picker = namedtuple('Picker', ['model', 'label', 'where', 'pages'])
+
+PICKERS = {
+    'roles': Picker(rol, 'role_name', (('is_active', True),),
+                    ('navigation.menus_management',)),
+    'assignable_roles': Picker(rol, 'role_name', (('is_active', True),
+                                                 ('is_default', False)),
+                               ('users.users_processing',)),
+    'menus': Picker(menu, 'menu_name', (('is_active', True),),
+                    ('navigation.menus_management', 'navigation.navmenus')),
+    'users': Picker(usr, 'user_name', (('is_active', True),),
+                    ('users.users_processing',)),
+}
+
+_indexes = {}
+_lock = threading.Lock()
+_shared = None
+_seen_shared = {}
+_has_trgm = None
+
+
+def trigrams(text):
+    """Return the three character windows of a padded, lowercased text.
+
+    The padding follows pg_trgm, so matches at the start of a text share
+    more trigrams with the term and rank higher.
+    """
+    text = '  ' + text.lower() + ' '
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def similarity(left, right):
+    """Return the share of trigrams two sets have in common."""
+    if not left or not right:
+        return 0.0
+    shared = len(left & right)
+    return float(shared) / (len(left) + len(right) - shared)
+
+
+def flag(value):
+    """Read a boolean column as saved, forms may set it as 'True'/'False'."""
+    if value is None:
+        return None
+    return value not in (False, 'False')
+
+
+def escape_like(term):
+    """Escape the LIKE wildcards in a search term."""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class TrigramIndex(object):
+    """Map the trigrams of some rows' searched columns to their keys."""
+
+    def __init__(self, rows=()):
+        """Index (key, values) pairs."""
+        self._postings = {}
+        self._rows = {}
+        for key, values in rows:
+            self.add(key, values)
+
+    def add(self, key, values):
+        """Index a row, replacing any row under the same key."""
+        self.remove(key)
+        values = tuple((value or '').lower() for value in values)
+        self._rows[key] = values
+        for gram in set().union(*[trigrams(value) for value in values]):
+            self._postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        """Drop a row from the index."""
+        values = self._rows.pop(key, None)
+        if values is None:
+            return
+        for gram in set().union(*[trigrams(value) for value in values]):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+
+    def candidates(self, term):
+        """Return the keys of the rows that may hold a term.
+
+        Terms shorter than a trigram cannot be looked up and yield every
+        key, leaving the substring check to find them.
+        """
+        grams = [term[i:i + 3] for i in range(len(term) - 2)]
+        if not grams:
+            return set(self._rows)
+        postings = sorted((self._postings.get(gram, ()) for gram in grams),
+                          key=len)
+        found = set(postings[0])
+        for keys in postings[1:]:
+            found.intersection_update(keys)
+            if not found:
+                break
+        return found
+
+    def search(self, term, limit):
+        """Return the keys of up to limit rows holding a term, best first."""
+        term = term.lower()
+        wanted = trigrams(term)
+        ranked = []
+        for key in self.candidates(term):
+            values = self._rows[key]
+            if any(term in value for value in values):
+                score = max(similarity(wanted, trigrams(value))
+                            for value in values)
+                ranked.append((-score, key))
+        ranked.sort()
+        return [key for score, key in ranked[:limit]]
+
+    def __len__(self):
+        """Return the number of indexed rows."""
+        return len(self._rows)
+
+
+class PrefixIndex(object):
+    """Keep the labels of some rows sorted for prefix lookups."""
+
+    def __init__(self, rows=()):
+        """Index (key, label) pairs."""
+        self._labels = {}
+        for key, label in rows:
+            self._labels[key] = ((label or '').lower(), label)
+        self._entries = sorted((folded, key) for key, (folded, label)
+                               in self._labels.items())
+
+    def add(self, key, label):
+        """Index a row, replacing any row under the same key."""
+        self.remove(key)
+        folded = (label or '').lower()
+        self._labels[key] = (folded, label)
+        insort(self._entries, (folded, key))
+
+    def remove(self, key):
+        """Drop a row from the index."""
+        entry = self._labels.pop(key, None)
+        if entry is not None:
+            del self._entries[bisect_left(self._entries, (entry[0], key))]
+
+    def lookup(self, prefix, after=None, limit=20):
+        """Return up to limit rows whose label starts with a prefix.
+
+        The (key, label) pairs come in label order, along with the key the
+        next page continues after, None on the last page.
+        """
+        prefix = prefix.lower()
+        start = bisect_left(self._entries, (prefix,))
+        if after in self._labels:
+            start = max(start, bisect_right(self._entries,
+                                            (self._labels[after][0], after)))
+        stop = min(start + limit + 1, len(self._entries))
+        keys = [key for folded, key in self._entries[start:stop]
+                if folded.startswith(prefix)]
+        more = len(keys) > limit
+        keys = keys[:limit]
+        return ([(key, self._labels[key][1]) for key in keys],
+                keys[-1] if more else None)
+
+    def __contains__(self, key):
+        """Tell whether a row is offered."""
+        return key in self._labels
+
+    def __len__(self):
+        """Return the number of indexed rows."""
+        return len(self._labels)
+
+
+def searched_columns(model):
+    """Return the columns searched on a model."""
+    return [getattr(model, name) for name in SEARCH_COLUMNS[model]]
+
+
+def primary_key(model):
+    """Return the primary key column of a model."""
+    return getattr(model, model.__mapper__.primary_key[0].key)
+
+
+def tracked_columns(model):
+    """Return the columns the search and picker indexes read from a model."""
+    names = list(SEARCH_COLUMNS.get(model, ()))
+    for picker in PICKERS.values():
+        if picker.model is model:
+            for name in (picker.label,) + tuple(col for col, value
+                                                in picker.where):
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+_tracked = dict((model, tracked_columns(model)) for model in SEARCH_COLUMNS)
+
+
+def offers(picker, values):
+    """Tell whether a picker offers a row, given its tracked values."""
+    return all(flag(values[name]) == value for name, value in picker.where)
+
+
+def has_trigram_indexes():
+    """Tell whether the database can serve the search from trigram indexes."""
+    global _has_trgm
+    if _has_trgm is None:
+        _has_trgm = False
+        if db.engine.dialect.name == 'postgresql':
+            _has_trgm = db.session.execute(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+            ).scalar() is not None
+    return _has_trgm
+
+
+def shared_generations():
+    """Return the counters shared between workers, one per searched model.
+
+    Each model's counter lives next to SEARCH_GENERATION_FILE, suffixed with
+    its table name. Returns {} when no file is configured.
+    """
+    global _shared
+    if _shared is None:
+        path = app.config.get('SEARCH_GENERATION_FILE')
+        _shared = {}
+        if path:
+            for model in SEARCH_COLUMNS:
+                _shared[model] = SharedGeneration(
+                    '{}.{}'.format(path, model.__tablename__))
+    return _shared
+
+
+def model_indexes(model):
+    """Return the names of the indexes built from a model."""
+    return [model] + [name for name, picker in PICKERS.items()
+                      if picker.model is model]
+
+
+def drop_stale_indexes():
+    """Drop the indexes of the models another worker has changed."""
+    for model, shared in shared_generations().items():
+        value = shared.read()
+        if value != _seen_shared.get(model, 0):
+            with _lock:
+                for name in model_indexes(model):
+                    _indexes.pop(name, None)
+                _seen_shared[model] = value
+
+
+def load_index(model):
+    """Build the in-process index of a model from the database."""
+    key = primary_key(model)
+    rows = db.session.query(key, *searched_columns(model)).all()
+    return TrigramIndex((row[0], row[1:]) for row in rows)
+
+
+def load_picker(name):
+    """Build the prefix index of a picker from the database."""
+    picker = PICKERS[name]
+    model = picker.model
+    key = primary_key(model)
+    rows = db.session.query(key, getattr(model, picker.label)).filter(
+        *[getattr(model, column) == value for column, value in picker.where]
+    ).all()
+    return PrefixIndex(rows)
+
+
+def cached_index(name, loader):
+    """Return an index built in this process, building it on first use."""
+    drop_stale_indexes()
+    index = _indexes.get(name)
+    if index is None:
+        index = loader(name)
+        with _lock:
+            index = _indexes.setdefault(name, index)
+    return index
+
+
+def model_index(model):
+    """Return the in-process trigram index of a model."""
+    return cached_index(model, load_index)
+
+
+def picker_index(name):
+    """Return the prefix index of a picker."""
+    return cached_index(name, load_picker)
+
+
+def search_database(model, term, limit):
+    """Search a model with ILIKE on its trigram indexes, best first."""
+    key = primary_key(model)
+    columns = searched_columns(model)
+    pattern = '%' + escape_like(term) + '%'
+    rank = func.greatest(*[func.similarity(column, term)
+                           for column in columns])
+    rows = db.session.query(key).filter(or_(
+        *[column.ilike(pattern, escape='\\') for column in columns]
+    )).order_by(rank.desc(), key).limit(limit).all()
+    return [row[0] for row in rows]
+
+
+class Hits(list):
+    """Primary keys of the rows holding a term, best first.
+
+    Truncated is set when more rows hold it than the limit returned.
+    """
+
+    truncated = False
+
+
+def find(model, term, limit=None):
+    """Return the Hits of the rows holding a term, at most limit of them."""
+    limit = limit or app.config.get('SEARCH_RESULT_LIMIT', 200)
+    if has_trigram_indexes():
+        found = search_database(model, term, limit + 1)
+    else:
+        index = model_index(model)
+        with _lock:
+            found = index.search(term, limit + 1)
+    hits = Hits(found[:limit])
+    hits.truncated = len(found) > limit
+    return hits
+
+
+def lookup(name, prefix, after=None, limit=None):
+    """Return a page of the rows a picker offers for a prefix.
+
+    See PrefixIndex.lookup.
+    """
+    limit = limit or app.config.get('TYPEAHEAD_PAGE_SIZE', 20)
+    index = picker_index(name)
+    with _lock:
+        return index.lookup(prefix, after, limit)
+
+
+def is_offered(name, key):
+    """Tell whether a picker offers the row under a key."""
+    index = picker_index(name)
+    with _lock:
+        return key in index
+
+
+def record_change(session, model, key, values):
+    """Note a row change to apply to the indexes when the session commits.
+
+    Values maps the tracked columns of the row to their values, None when
+    it was deleted. Bulk statements that bypass the unit of work use this
+    to report the rows they touched.
+    """
+    changes = session.info.setdefault('search_changes', OrderedDict())
+    changes.pop((model, key), None)
+    changes[(model, key)] = values
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_search_changes(session, flush_context):
+    """Note the indexed rows the flush inserted, updated or deleted.
+
+    Updates are noted only when they change a tracked column, so commits
+    such as a login's do not make the other workers rebuild their indexes.
+    """
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        model = type(obj)
+        names = _tracked.get(model)
+        if not names:
+            continue
+        key = getattr(obj, primary_key(model).key)
+        if obj in session.deleted:
+            record_change(session, model, key, None)
+            continue
+        if obj not in session.new:
+            attrs = inspect(obj).attrs
+            if not any(attrs[name].history.has_changes() for name in names):
+                continue
+        record_change(session, model, key,
+                      dict((name, getattr(obj, name)) for name in names))
+
+
+def apply_change(model, key, values):
+    """Apply one committed row to the indexes built in this process."""
+    index = _indexes.get(model)
+    if index is not None:
+        if values is None:
+            index.remove(key)
+        else:
+            index.add(key, [values[name] for name in SEARCH_COLUMNS[model]])
+    for name, picker in PICKERS.items():
+        index = _indexes.get(name)
+        if index is None or picker.model is not model:
+            continue
+        if values is not None and offers(picker, values):
+            index.add(key, values[picker.label])
+        else:
+            index.remove(key)
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_search_changes(session):
+    """Apply the committed changes to the indexes built in this process.
+
+    The other workers are told about the change through the shared counter.
+    """
+    changes = session.info.pop('search_changes', None)
+    if not changes:
+        return
+    shared = shared_generations()
+    with _lock:
+        for (model, key), values in changes.items():
+            apply_change(model, key, values)
+        for model in set(model for model, key in changes):
+            if model in shared:
+                value = shared[model].bump()
+                if value == _seen_shared.get(model, 0) + 1:
+                    _seen_shared[model] = value
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_search_changes(session):
+    """Forget the changes noted by a rolled back transaction."""
+    session.info.pop('search_changes', None)
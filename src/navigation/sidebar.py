@@ -0,0 +1,70 @@
+"""Sidebar menu rendered from the authorization index.
+
+Every user is shown the active menus their roles may view, nested under
+their nearest visible ancestor. The fragment only
+depends on the role set, the active menu and the index generation, so it is
+rendered once per (role set, active menu, generation) and shared by every
+user holding the same roles.
+"""
+
+import functools
+from collections import namedtuple
+from flask import Markup, render_template, request
+from src import app
+from . import permissions
+from .matcher import link_for
+from .utils import nest_menus
+
+
+MenuItem = namedtuple('MenuItem', ['menu_id', 'parent_id', 'menu_order',
+                                   'menu_name', 'menu_url', 'menu_text'])
+
+
+def init_app(app):
+    """Expose the sidebar to the templates."""
+    app.add_template_global(sidebar_menu)
+
+
+def visible_menus(index, role_ids):
+    """List the menus the roles may view as a nested tree.
+
+    A menu whose parent is hidden is attached to its nearest visible
+    ancestor, walking the parents held by the index.
+    """
+    user_mask = permissions.role_mask(index, role_ids)
+    visible = {menu_id for menu_id, item in index.menu_items.items()
+               if item[2] and permissions.is_permitted(index, user_mask,
+                                                       menu_id)}
+    menus = []
+    for menu_id in visible:
+        name, text, _, parent_id, menu_order = index.menu_items[menu_id]
+        seen = {menu_id}
+        while parent_id is not None and parent_id not in visible:
+            seen.add(parent_id)
+            parent = index.menu_items.get(parent_id)
+            parent_id = parent[3] if parent else None
+            if parent_id in seen:
+                parent_id = None
+        menus.append(MenuItem(menu_id, parent_id, menu_order, name,
+                              link_for(index.menu_urls.get(menu_id, '')),
+                              text))
+    return nest_menus(menus)
+
+
+@functools.lru_cache(maxsize=app.config.get('AUTH_SIDEBAR_CACHE_SIZE', 1024))
+def _render(role_set_id, active_menu, generation):
+    """Render the sidebar fragment of a role set."""
+    index = permissions.current_index()
+    menus = visible_menus(index, permissions.role_set_roles(role_set_id))
+    return Markup(render_template('_sidebar_menu.html', menus=menus,
+                                  active_menu=active_menu))
+
+
+def sidebar_menu():
+    """Return the sidebar of the current user for the current request."""
+    index = permissions.current_index()
+    role_set_id = permissions.current_role_set()
+    active_menu = index.endpoint_menus.get(request.endpoint)
+    if active_menu is None:
+        active_menu = permissions.menu_for_path(index, request.path)
+    return _render(role_set_id, active_menu, index.generation)
@@ -0,0 +1,162 @@
+"""Versioned binary snapshot of the compiled authorization index.
+
+The snapshot holds the role bits, menu urls and items, role menu grants and
+packed menu masks in flat native arrays behind a small header carrying a
+format version, the shared generation stamp it was taken at and a crc32 of
+the payload. The stamp is the (file id, value) pair of the shared counter,
+so a snapshot is not mistaken as current by a counter recreated from 0.
+Workers map it copy-on-write, so the masks are used straight from the page
+cache shared by every process.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+MAGIC = b'FDUMAUTH'
+VERSION = 4
+_HEADER = struct.Struct('<8sHBBQQQI')
+_COUNT = struct.Struct('<Q')
+
+
+class SnapshotError(Exception):
+    """Raise when a snapshot is unreadable, corrupt or of another version."""
+
+
+def _array_section(typecode, values):
+    """Encode an array preceded by its length."""
+    data = array(typecode, values)
+    return _COUNT.pack(len(data)) + data.tobytes()
+
+
+def _bytes_section(data):
+    """Encode a byte string preceded by its length."""
+    return _COUNT.pack(len(data)) + bytes(data)
+
+
+def _strings_section(values):
+    """Encode strings as an array of lengths and one utf-8 blob."""
+    encoded = [value.encode('utf-8') for value in values]
+    return (_array_section('I', [len(value) for value in encoded]) +
+            _bytes_section(b''.join(encoded)))
+
+
+def write_snapshot(path, stamp, index):
+    """Write the index to path, replacing any previous snapshot atomically.
+
+    The stamp is a (counter file id, generation) pair.
+    """
+    roles = sorted(index.role_bits.items(), key=lambda r: r[1])
+    grants = [(rm_id, menu_id, role_id, flags)
+              for menu_id, menu_grants in index.menu_grants.items()
+              for rm_id, (role_id, flags) in menu_grants.items()]
+    menu_ids = sorted(index.menu_urls)
+    items = [index.menu_items.get(menu_id, ('', '', False, None, 0))
+             for menu_id in menu_ids]
+    ids, rows, width = index.menu_masks.buffers()
+    sections = [
+        _array_section('q', [role_id for role_id, _ in roles]),
+        _array_section('H', [bit.bit_length() - 1 for _, bit in roles]),
+    ]
+    for column in range(4):
+        sections.append(_array_section('q', [g[column] for g in grants]))
+    sections += [
+        _array_section('q', menu_ids),
+        _strings_section(index.menu_urls[menu_id] for menu_id in menu_ids),
+        _strings_section(item[0] for item in items),
+        _strings_section(item[1] for item in items),
+        _array_section('B', [item[2] for item in items]),
+        _array_section('q', [item[3] or 0 for item in items]),
+        _array_section('i', [item[4] for item in items]),
+        _array_section('q', ids),
+        _bytes_section(rows),
+    ]
+    payload = b''.join(sections)
+    header = _HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little', width,
+                          stamp[0], stamp[1], len(payload),
+                          zlib.crc32(payload))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as snapshot:
+        snapshot.write(header)
+        snapshot.write(payload)
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    """Map a snapshot and decode it.
+
+    Return a dict with the stamp, role_bits, menu_urls, menu_items,
+    menu_grants and the (ids, rows, width) buffers of the menu masks, the
+    rows being a view on the copy-on-write mapping.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (OSError, ValueError) as e:
+        raise SnapshotError('cannot map {}: {}'.format(path, e))
+    view = memoryview(mapped)
+    if len(view) < _HEADER.size:
+        raise SnapshotError('truncated header')
+    magic, version, little, width, file_id, generation, length, crc = \
+        _HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError('unsupported snapshot format')
+    if little != (sys.byteorder == 'little'):
+        raise SnapshotError('snapshot written with another byte order')
+    payload = view[_HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise SnapshotError('checksum mismatch')
+
+    offset = [0]
+
+    def take_bytes():
+        count, = _COUNT.unpack_from(payload, offset[0])
+        start = offset[0] + _COUNT.size
+        offset[0] = start + count
+        return payload[start:start + count]
+
+    def take_array(typecode):
+        count, = _COUNT.unpack_from(payload, offset[0])
+        data = array(typecode)
+        start = offset[0] + _COUNT.size
+        offset[0] = start + count * data.itemsize
+        data.frombytes(payload[start:offset[0]])
+        return data
+
+    def take_strings():
+        lengths, blob = take_array('I'), bytes(take_bytes())
+        values, start = [], 0
+        for length in lengths:
+            values.append(blob[start:start + length].decode('utf-8'))
+            start += length
+        return values
+
+    role_ids, role_positions = take_array('q'), take_array('H')
+    rm_ids, grant_menus, grant_roles, flags = [take_array('q')
+                                               for _ in range(4)]
+    menu_ids, urls, names, texts = (take_array('q'), take_strings(),
+                                    take_strings(), take_strings())
+    actives, parents, orders = (take_array('B'), take_array('q'),
+                                take_array('i'))
+    mask_ids, mask_rows = take_array('q'), take_bytes()
+
+    menu_urls = dict(zip(menu_ids, urls))
+    menu_items = {menu_id: (name, text, bool(active), parent or None, order)
+                  for menu_id, name, text, active, parent, order in
+                  zip(menu_ids, names, texts, actives, parents, orders)}
+    menu_grants = {}
+    for rm_id, menu_id, role_id, flag in zip(rm_ids, grant_menus,
+                                             grant_roles, flags):
+        menu_grants.setdefault(menu_id, {})[rm_id] = (role_id, flag)
+    return {
+        'stamp': (file_id, generation),
+        'role_bits': {role_id: 1 << pos for role_id, pos in
+                      zip(role_ids, role_positions)},
+        'menu_urls': menu_urls,
+        'menu_items': menu_items,
+        'menu_grants': menu_grants,
+        'masks': (mask_ids, mask_rows, width),
+    }
@@ -1,7 +1,6 @@
 """Build Instruments Related Tables."""
 
-from flask_table import Table, Col, LinkCol, BoolCol, DatetimeCol, DateCol
-from flask import url_for
+from .render import Table, Col, LinkCol, BoolCol
 
 
 class MenusDetailsTable(Table):
@@ -28,12 +27,4 @@ class MenusDetailsTable(Table):
     last_modified_datetime = Col('Menu Last Modified', allow_sort=True,
                                  td_html_attrs={'style': 'font-size:12px'})
     allow_sort = True
-
-    def sort_url(self, col_key, reverse=False):
-        """Process sort url for the columns of the tables."""
-        if reverse:
-            direction = 'desc'
-        else:
-            direction = 'asc'
-        return url_for('navigation.navmenus', sort=col_key,
-                       direction=direction)
+    sort_endpoint = 'navigation.navmenus'
@@ -1,39 +1,34 @@
 """Utility Functions for user module."""
 
-from flask import session
-from sqlalchemy import or_, and_
-from . import models
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, bindparam
+from sqlalchemy.orm import aliased
+from . import models, paging, permissions, search
 from src import db
 from src.users.models import Role as rol
 from src.users.models import RoleMenu as rol_menu
 from . models import Menu as menu
 
 
-def build_menus_list(sort, reverse, opt_search):
-    """Build & display a menus list.
+MenuRow = namedtuple('MenuRow', ['menu_id', 'menu_name', 'menu_text',
+                                 'menu_url', 'is_active', 'created_datetime',
+                                 'last_modified_datetime'])
 
-    Display the data sorted by direction and where applicable filtered by
-    search string.
+
+def build_menus_list(sort, reverse, opt_search, after=None, before=None):
+    """Build & display a page of the menus list.
+
+    Display the data sorted by direction, one keyset page after or before
+    the given menu ids, and where applicable filtered by search string.
+    Only the displayed columns are read, as MenuRow tuples.
     """
-    if sort is None:
-        sort = 'menu_text'
-        reverse = 'asc'
-    if reverse:
-        reverse = 'desc'
-    else:
-        reverse = 'asc'
-    totalsort = str(str(sort) + ' ' + str(reverse))
-    if opt_search is None:
-        menus_list = models.Menu.query.order_by(totalsort).all()
-    else:
-        search_string = '%' + opt_search + '%'
-        filter_clause1 = (models.Menu.menu_url.like(search_string))
-        filter_clause2 = (models.Menu.menu_text.like(search_string))
-        menus_list = models.Menu.query.filter(or_(
-            filter_clause1,
-            filter_clause2
-        )).order_by(totalsort).all()
-    return menus_list
+    menus_list = models.Menu.query
+    hits = None
+    if opt_search:
+        hits = search.find(models.Menu, opt_search)
+    return paging.paginate(menus_list, models.Menu, sort, 'menu_text',
+                           reverse, after, before, hits, MenuRow)
 
 
 def build_roles_list():
@@ -42,13 +37,6 @@ def build_roles_list():
     return roles_list
 
 
-def build_active_roles_list():
-    """Build & display a roles list."""
-    filter_clause1 = rol.is_active == bool(1)
-    roles_list = rol.query.filter(filter_clause1).order_by(rol.role_name).all()
-    return roles_list
-
-
 def this_role(role_ids):
     """Build & display a roles list."""
     filter_clause1 = rol.role_id == role_ids
@@ -56,12 +44,161 @@ def this_role(role_ids):
     return roled.role_name
 
 
-def build_active_menus_list():
-    """Build & display a menus list."""
-    filter_clause1 = menu.is_active == bool(1)
-    menus_list = menu.query.filter(filter_clause1).order_by(
-                                    menu.menu_name).all()
-    return menus_list
+MenuNode = namedtuple('MenuNode', ['menu', 'children'])
+
+
+def nest_menus(menus):
+    """Nest menus under their parents, siblings in menu order.
+
+    Menus carry menu_id, parent_id, menu_order and menu_name. Those whose
+    parent is not among them become roots.
+    """
+    nodes = {m.menu_id: MenuNode(m, []) for m in menus}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node.menu.parent_id)
+        (parent.children if parent else roots).append(node)
+
+    def sort_key(node):
+        return node.menu.menu_order, node.menu.menu_name.lower()
+    for node in nodes.values():
+        node.children.sort(key=sort_key)
+    roots.sort(key=sort_key)
+    return roots
+
+
+def build_menu_tree(root_id=None, active_only=True):
+    """Load the menu tree, or the subtree of one menu, in one query.
+
+    The subtree is every menu whose materialized path starts with the path
+    of its root, which the menu_path index serves.
+    """
+    query = menu.query
+    if root_id is not None:
+        root = aliased(menu)
+        root_path = db.session.query(root.menu_path) \
+            .filter(root.menu_id == root_id).as_scalar()
+        query = query.filter(menu.menu_path.like(root_path.concat('%')))
+    if active_only:
+        query = query.filter(menu.is_active == bool(1))
+    return nest_menus(query.all())
+
+
+PermissionMatrix = namedtuple('PermissionMatrix', ['roles', 'menus',
+                                                   'flags'])
+
+
+def flatten_tree(nodes, depth=0):
+    """Yield the (depth, menu) pairs of a menu tree, parents first."""
+    for node in nodes:
+        yield depth, node.menu
+        for pair in flatten_tree(node.children, depth + 1):
+            yield pair
+
+
+def build_permission_matrix(role_ids=None):
+    """Load the roles x menus x actions matrix of the active roles and menus.
+
+    The roles come in name order and the menus in tree order as (depth,
+    menu) pairs. Flags maps each (menu_id, role_id) holding a role menu to
+    its actions, packed as permissions.grant_flags packs them by the one
+    query pivoting the role menus.
+    """
+    roles = db.session.query(rol.role_id, rol.role_name) \
+        .filter(rol.is_active == bool(1))
+    grants = db.session.query(rol_menu.menu_id, rol_menu.role_id,
+                              permissions.packed_flags())
+    if role_ids:
+        roles = roles.filter(rol.role_id.in_(role_ids))
+        grants = grants.filter(rol_menu.role_id.in_(role_ids))
+    return PermissionMatrix(
+        roles.order_by(rol.role_name).all(),
+        list(flatten_tree(build_menu_tree())),
+        dict(((menu_id, role_id), flags)
+             for menu_id, role_id, flags in grants))
+
+
+def fetch_cell_grants(cells):
+    """Map the (menu_id, role_id) of some cells to their role menu rows."""
+    menu_ids = set(menu_id for menu_id, role_id in cells)
+    role_ids = set(role_id for menu_id, role_id in cells)
+    rows = db.session.query(rol_menu.role_menu_id, rol_menu.menu_id,
+                            rol_menu.role_id, rol_menu.can_view,
+                            rol_menu.can_create, rol_menu.can_edit,
+                            rol_menu.can_delete) \
+        .filter(rol_menu.menu_id.in_(menu_ids),
+                rol_menu.role_id.in_(role_ids))
+    return dict(((row.menu_id, row.role_id), row) for row in rows
+                if (row.menu_id, row.role_id) in cells)
+
+
+def unknown_cells(cells):
+    """Return those of some (menu_id, role_id) cells naming no menu or role."""
+    menu_ids = set(menu_id for menu_id, role_id in cells)
+    role_ids = set(role_id for menu_id, role_id in cells)
+    known_menus = set(menu_id for menu_id, in db.session.query(
+        menu.menu_id).filter(menu.menu_id.in_(menu_ids)))
+    known_roles = set(role_id for role_id, in db.session.query(
+        rol.role_id).filter(rol.role_id.in_(role_ids)))
+    return sorted(cell for cell in cells
+                  if cell[0] not in known_menus or cell[1] not in known_roles)
+
+
+def save_permission_cells(changes, modified_by):
+    """Save the changed cells of the permission matrix in one transaction.
+
+    Changes map (menu_id, role_id) to the (was, now) packed flags of the
+    cell. When a cell no longer holds the flags it was edited from, nothing
+    is saved and the conflicting cells are returned. Otherwise the changed
+    role menus are updated and the missing ones inserted with one
+    executemany each, reported to the authorization index, and committed
+    together, so the caches are invalidated once. Return the number of
+    cells saved and the conflicts.
+
+    The roles of the cells are locked first, so a concurrent save of the
+    same roles waits and then sees the cells this one saved as conflicts.
+    """
+    role_ids = set(role_id for menu_id, role_id in changes)
+    db.session.query(rol.role_id).filter(
+        rol.role_id.in_(role_ids)).with_for_update().all()
+    current = fetch_cell_grants(changes)
+    conflicts = sorted(cell for cell, (was, now) in changes.items()
+                       if (permissions.grant_flags(current[cell])
+                           if cell in current else 0) != was)
+    if conflicts:
+        db.session.rollback()
+        return 0, conflicts
+    table = rol_menu.__table__
+    now_time = datetime.now()
+    updates = []
+    inserts = []
+    for (menu_id, role_id), (was, now) in changes.items():
+        if was == now:
+            continue
+        values = dict(('can_' + action, bool(now >> pos & 1))
+                      for pos, action in enumerate(permissions.ACTIONS))
+        if (menu_id, role_id) in current:
+            updates.append(dict(values, modified_by=modified_by,
+                                last_modified_datetime=now_time,
+                                grant_id=current[(menu_id,
+                                                  role_id)].role_menu_id))
+        else:
+            inserts.append(dict(values, menu_id=menu_id, role_id=role_id,
+                                created_by=modified_by,
+                                created_datetime=now_time))
+    if updates:
+        db.session.execute(table.update().where(
+            table.c.role_menu_id == bindparam('grant_id')), updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    saved = fetch_cell_grants(changes) if inserts else current
+    for cell, (was, now) in changes.items():
+        if was != now:
+            permissions.record_change(db.session, 'grant',
+                                      saved[cell].role_menu_id,
+                                      cell + (now,))
+    db.session.commit()
+    return len(updates) + len(inserts), []
 
 
 def build_role_menus(role_name):
@@ -104,36 +241,3 @@ def fetch_this_role_menu(opt_role_menu):
         .filter(filter_clause1).first()
     print(this_role_menu.menu_name)
     return this_role_menu
-
-
-def build_auth_menu_roles():
-    """Build a list of menus and authorized Roles.
-
-    Create a list of the menus and their urls tracked in the Database.
-    Fetch the roles authorized to access the menus/urls.
-    Create a dictionary and load into the session.
-    """
-    filter_clause1 = (rol_menu.can_view == bool(1))
-    menus_list = db.session.query(rol_menu.menu_id, rol_menu.role_id,
-                                  menu.menu_url, rol.role_name) \
-        .join(menu, rol_menu.menu_id == menu.menu_id) \
-        .join(rol, rol_menu.role_id == rol.role_id) \
-        .filter(filter_clause1).all()
-    menu_url_list = []
-    menu_dict = {}
-    for m in menus_list:
-        if m.menu_url not in menu_url_list:
-            this_url = m.menu_url
-            menu_url_list.append(m.menu_url)
-    for u in menu_url_list:
-        auth_roles = []
-        for m in menus_list:
-            if m.menu_url == u:
-                auth_roles.append(m.role_name)
-        menu_dict[u] = auth_roles
-    try:
-        del session['menu_dict']
-    except:
-        pass
-    session['menu_dict'] = menu_dict
-    return menu_dict
@@ -2,12 +2,15 @@
 
 import datetime
 from flask import render_template, Blueprint, request, flash, redirect, url_for
-from flask_login import current_user
+from flask import abort, jsonify
+from flask_login import current_user, login_required
 from sqlalchemy.exc import IntegrityError
 from src import db, app
 from src.users.models import RoleMenu
 from src.users.models import Role as rol
-from . import models, forms, tables, utils
+from src.users.utils import has_required_roles
+from . import models, forms, tables, utils, permissions, search
+from .paging import stream_template
 
 
 nav_blueprint = Blueprint('navigation', __name__, template_folder='templates')
@@ -19,13 +22,6 @@ def index():
     # return 'This is the homepage'
     return redirect(url_for('navigation.list_urls'))
 
-@nav_blueprint.route('/nav/test_menu_roles', methods=['GET', 'POST'])
-def menu_roles():
-    """Create a list of urls in the app."""
-    my_roles = utils.build_auth_menu_roles()
-    return str(my_roles)
-
-
 @nav_blueprint.route('/nav/list_urls', methods=['GET', 'POST'])
 def list_urls():
     """Create a list of urls in the app eg for a site map.
@@ -39,17 +35,17 @@ def list_urls():
 
 
 @nav_blueprint.route('/nav/menus_management', methods=['GET', 'POST'])
+@login_required
+@has_required_roles('navigation.menus_management',
+                    intents=[('submit_change_role_menu', 'edit')])
 def menus_management():
     """Map menu assignment to roles."""
     role_menus = None
     this_role = None
     is_set_role_menu = None
     roles_form = forms.SelectRoleForm()
-    roles_form.role.query = utils.build_active_roles_list()
     role_menu_detail_form = forms.RoleMenuSelectionForm()
     form = forms.NewRoleMenuForm()
-    form.role_id.query = utils.build_active_roles_list()
-    form.menu_id.query = utils.build_active_menus_list()
 
     opt_role = request.args.get("role")
     if opt_role:
@@ -66,7 +62,10 @@ def menus_management():
         role_menus = utils.build_role_menus(this_role_menu.role_id)
 
     if request.method == 'POST':
-        if form.submit_role_menu and ('role_id' in request.form):
+        if form.submit_role_menu.data and ('role_id' in request.form):
+            if not permissions.allows('navigation.menus_management',
+                                      'create'):
+                return redirect(url_for('users.unauthorized_access'))
             if form.validate_on_submit():
                 menu_id = request.form['menu_id']
                 role_id = request.form['role_id']
@@ -81,19 +80,19 @@ def menus_management():
                 )
                 db.session.add(role_menu)
                 db.session.commit()
-                utils.build_auth_menu_roles()
                 flash('New Role Menu successfully created!', 'success')
                 return redirect(url_for('navigation.menus_management'))
             else:
                 flash_errors(form)
-        if role_menu_detail_form.submit_change_role_menu and \
+        if role_menu_detail_form.submit_change_role_menu.data and \
                 ('role_menu_id' in request.form):
+            if not permissions.allows('navigation.menus_management', 'edit'):
+                return redirect(url_for('users.unauthorized_access'))
             if role_menu_detail_form.validate_on_submit():
                 role_menu_detail_form.populate_obj(set_role_menu)
                 set_role_menu.modified_by = current_user.user_id
                 set_role_menu.last_modified_datetime = datetime.datetime.now()
                 db.session.commit()
-                utils.build_auth_menu_roles()
                 flash('Role menu successfully updated.', 'success')
                 return redirect(url_for('navigation.menus_management'))
             else:
@@ -104,7 +103,91 @@ def menus_management():
                            is_set_role_menu=is_set_role_menu, form=form)
 
 
+@nav_blueprint.route('/nav/permissions', methods=['GET'])
+@login_required
+def permission_matrix():
+    """Show the actions of the active roles on every active menu.
+
+    ?roles=3,7 limits the columns to some roles. The user needs to be
+    allowed to view the role menus page.
+    """
+    if not all(permissions.authorize_many(permissions.current_role_set(),
+                                          ['navigation.menus_management'])):
+        return redirect(url_for('users.unauthorized_access'))
+    role_ids = [int(role_id) for role_id
+                in request.args.get('roles', '').split(',')
+                if role_id.strip().isdigit()]
+    matrix = utils.build_permission_matrix(role_ids)
+    return render_template('permission_matrix.html', matrix=matrix,
+                           actions=permissions.ACTIONS)
+
+
+@nav_blueprint.route('/nav/permissions', methods=['POST'])
+@login_required
+def save_permission_matrix():
+    """Save the changed cells of the permission matrix.
+
+    Take JSON such as {"cells": [[menu_id, role_id, was, now], ...]}, the
+    flags a cell was loaded with and those it was changed to, packed as
+    permissions.grant_flags packs them. Return {"saved": 2}, or status 409
+    and {"conflicts": [[menu_id, role_id], ...]} when cells were changed
+    since they were loaded, or status 400 and {"unknown": [...]} for cells
+    naming no menu or role. Changing role menus needs edit access to the
+    role menus page, adding them create access and taking actions away
+    delete access.
+    """
+    cells = (request.get_json(silent=True) or {}).get('cells')
+    limit = 1 << len(permissions.ACTIONS)
+    if not isinstance(cells, list) or not all(
+            isinstance(cell, list) and len(cell) == 4 and
+            all(isinstance(value, int) for value in cell) and
+            0 <= cell[2] < limit and 0 <= cell[3] < limit
+            for cell in cells):
+        abort(400)
+    changes = dict(((menu_id, role_id), (was, now))
+                   for menu_id, role_id, was, now in cells)
+    checks = [('navigation.menus_management', 'edit')]
+    if any(was == 0 for was, now in changes.values()):
+        checks.append(('navigation.menus_management', 'create'))
+    if any(was & ~now for was, now in changes.values()):
+        checks.append(('navigation.menus_management', 'delete'))
+    if not all(permissions.authorize_many(permissions.current_role_set(),
+                                          checks)):
+        abort(403)
+    unknown = utils.unknown_cells(changes)
+    if unknown:
+        return jsonify(unknown=unknown), 400
+    saved, conflicts = utils.save_permission_cells(changes,
+                                                   current_user.user_id)
+    if conflicts:
+        return jsonify(conflicts=conflicts), 409
+    return jsonify(saved=saved)
+
+
+@nav_blueprint.route('/nav/typeahead/<picker>')
+@login_required
+def typeahead(picker):
+    """Look up the rows a picker offers for a typed prefix.
+
+    Return one page as compact JSON, eg
+    {"items": [[3, "admin"], [7, "auditor"]], "next": 7}, the next page
+    being asked for with after=7. The user needs to be allowed to view one
+    of the pages the picker is used on.
+    """
+    if picker not in search.PICKERS:
+        abort(404)
+    pages = search.PICKERS[picker].pages
+    if not any(permissions.authorize_many(permissions.current_role_set(),
+                                          pages)):
+        abort(403)
+    items, after = search.lookup(picker, request.args.get('q', ''),
+                                 request.args.get('after', type=int))
+    return jsonify(items=items, next=after)
+
+
 @nav_blueprint.route('/nav/menus', methods=['GET', 'POST'])
+@login_required
+@has_required_roles('navigation.navmenus', intents=[('?menu', 'edit')])
 def navmenus():
     """Process Roles Details.
 
@@ -114,8 +197,11 @@ def navmenus():
     sort = request.args.get("sort")
     reverse = (request.args.get('direction', 'asc') == 'desc')
     opt_search = request.args.get("search_string")
-    menus_list = utils.build_menus_list(sort, reverse, opt_search)
-    menus_table = tables.MenusDetailsTable(menus_list, sort_by=sort,
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    menus_page = utils.build_menus_list(sort, reverse, opt_search, after,
+                                        before)
+    menus_table = tables.MenusDetailsTable(menus_page.rows, sort_by=sort,
                                            sort_reverse=reverse)
 
     opt_menu = request.args.get("menu")
@@ -140,8 +226,10 @@ def navmenus():
                             menu_name=form.menu_name.data,
                             menu_url=form.menu_url.data,
                             menu_text=form.menu_text.data,
-                            created_by=current_user.user_id
+                            created_by=current_user.user_id,
+                            menu_order=form.menu_order.data or 0
                             )
+                    menu.parent = form.parent.data
                     db.session.add(menu)
                     db.session.commit()
                     flash('New Menu {} successfully created!'
@@ -151,10 +239,14 @@ def navmenus():
             except IntegrityError as e:
                 flash('Menu already exists', 'error')
                 flash_errors(form)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), 'error')
         else:
             flash_errors(form)
-    return render_template('menu_details.html', form=form,
-                           menus_table=menus_table, searchform=searchform)
+    return stream_template('menu_details.html', form=form,
+                           menus_table=menus_table, menus_page=menus_page,
+                           searchform=searchform)
 
 
 def flash_errors(form):
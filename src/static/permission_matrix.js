@@ -0,0 +1,62 @@
+/*Permission matrix, saving only the changed cells*/
+
+$(document).ready(function(){
+    var matrix = $("#permission_matrix");
+    var status = $("#matrix_status");
+
+    function CellFlags(cell){
+        var flags = 0;
+        cell.find("input[type=checkbox]").each(function(){
+            if (this.checked) {
+                flags |= 1 << $(this).data("action");
+            }
+        });
+        return flags;
+    }
+
+    matrix.on("change", "input[type=checkbox]", function(){
+        var cell = $(this).closest("td");
+        cell.removeClass("danger");
+        cell.toggleClass("warning", CellFlags(cell) !== cell.data("was"));
+        status.text(matrix.find("td.warning").length + " changed cells");
+    });
+
+    $("#save_matrix").click(function(){
+        var changed = matrix.find("td.warning");
+        var cells = [];
+        changed.each(function(){
+            var cell = $(this);
+            cells.push([cell.data("menu"), cell.data("role"),
+                        cell.data("was"), CellFlags(cell)]);
+        });
+        if (!cells.length) {
+            return;
+        }
+        $.ajax({
+            url: matrix.data("save-url"),
+            type: "POST",
+            contentType: "application/json",
+            data: JSON.stringify({"cells": cells}),
+            success: function(response){
+                changed.each(function(){
+                    var cell = $(this);
+                    cell.data("was", CellFlags(cell));
+                    cell.removeClass("warning");
+                });
+                status.text(response.saved + " cells saved");
+            },
+            error: function(xhr){
+                if (xhr.status === 409) {
+                    $.each(xhr.responseJSON.conflicts, function(i, cell){
+                        matrix.find("td[data-menu=" + cell[0] + "][data-role=" +
+                                    cell[1] + "]").addClass("danger");
+                    });
+                    status.text("Cells changed by someone else, nothing " +
+                                "saved. Discard the changes to reload.");
+                } else {
+                    status.text("Changes not saved");
+                }
+            }
+        });
+    });
+});
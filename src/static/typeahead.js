@@ -0,0 +1,55 @@
+/*Typeahead pickers served by the /nav/typeahead endpoints*/
+
+$(document).ready(function(){
+    $("input[data-typeahead]").each(function(){
+        PickerBox($(this));
+    });
+
+    function PickerBox(box){
+        var target = $("#" + box.data("typeahead-target"));
+        var url = box.data("typeahead");
+        var shown = [];
+        var next = null;
+        var more = false;
+        box.autocomplete({
+            minLength: 0,
+            delay: 150,
+            source: function(request, response){
+                if (!more) {
+                    shown = [];
+                    next = null;
+                }
+                more = false;
+                $.getJSON(url, {'q': request.term, 'after': next},
+                          function(page){
+                    $.each(page.items, function(i, item){
+                        shown.push({'id': item[0], 'label': item[1],
+                                    'value': item[1]});
+                    });
+                    next = page.next;
+                    if (next === null) {
+                        response(shown);
+                    } else {
+                        response(shown.concat([{'label': 'More...',
+                                                'value': request.term,
+                                                'more': true}]));
+                    }
+                });
+            },
+            select: function(event, ui){
+                if (ui.item.more) {
+                    more = true;
+                    box.autocomplete("search", box.val());
+                    return false;
+                }
+                target.val(ui.item.id);
+            }
+        });
+        box.on("input", function(){
+            target.val('');
+        });
+        box.on("focus", function(){
+            box.autocomplete("search", box.val());
+        });
+    }
+});
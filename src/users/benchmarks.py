@@ -0,0 +1,250 @@
+"""Micro-benchmarks for the users email and password hashing pools.
+
+The benchmarks run against local stub servers so they need neither a mail
+server nor a populated database, eg `python manage.py bench_mail_dispatch`.
+"""
+
+import json
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.request
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from src.navigation.benchmarks import user_table_rows
+
+
+class SmtpStubHandler(socketserver.StreamRequestHandler):
+    """Speak just enough SMTP to accept messages and drop them."""
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        """Greet after the handshake delay, then accept every command."""
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.handshake)
+        self.wfile.write(b'220 stub\r\n')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    with server.lock:
+                        server.messages += 1
+                    self.wfile.write(b'250 queued\r\n')
+                continue
+            verb = line[:4].upper()
+            if verb == b'DATA':
+                in_data = True
+                self.wfile.write(b'354 go ahead\r\n')
+            elif verb == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+class SmtpStub(socketserver.ThreadingTCPServer):
+    """Local SMTP server counting connections and messages.
+
+    Each connection waits handshake seconds before its greeting, standing
+    in for the TLS handshake and login of a real server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, handshake=0.02):
+        """Listen on a free local port."""
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), SmtpStubHandler)
+        self.handshake = handshake
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+    def __enter__(self):
+        """Serve from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+def bench_mail_dispatch(messages=2000, handshake_ms=20):
+    """Compare a thread per email with the mail pool, on a local SMTP stub.
+
+    The mail settings are pointed at the stub while the benchmark runs.
+    """
+    from flask_mail import Message
+    from src import app, mail
+    from src.users.mailer import MailPool
+    state = app.extensions['mail']
+    saved = dict(vars(state))
+
+    def thread_per_message():
+        def send_async_email(msg):
+            with app.app_context():
+                mail.send(msg)
+        threads = [threading.Thread(target=send_async_email, args=[msg])
+                   for msg in build()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(threads)
+
+    def pooled():
+        pool = MailPool(app.config.get('MAIL_POOL_WORKERS', 4),
+                        app.config.get('MAIL_QUEUE_SIZE', 1000),
+                        app.config.get('MAIL_BATCH_SIZE', 50), None)
+        for msg in build():
+            pool.submit(msg)
+        pool.close()
+        print('  {}'.format(pool.stats()))
+        return pool.size
+
+    def build():
+        return [Message('Welcome', ['user{}@example.com'.format(n)],
+                        html='<p>Hello user{}</p>'.format(n),
+                        sender='admin@example.com')
+                for n in range(messages)]
+
+    print('{} emails, {} ms handshakes'.format(messages, handshake_ms))
+    try:
+        with app.app_context():
+            for label, dispatch in [('thread per email', thread_per_message),
+                                    ('mail pool', pooled)]:
+                with SmtpStub(handshake_ms / 1e3) as stub:
+                    state.server, state.port = stub.server_address
+                    state.use_ssl = state.use_tls = state.suppress = False
+                    state.username = state.password = None
+                    state.debug = False
+                    start = time.time()
+                    threads = dispatch()
+                    elapsed = time.time() - start
+                print('  {:<20} {:>8.1f} ms {:>6} threads {:>6} connections '
+                      '{:>6} delivered'.format(label, elapsed * 1e3, threads,
+                                               stub.connections,
+                                               stub.messages))
+    finally:
+        vars(state).update(saved)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Serve requests without logging each one."""
+
+    def log_message(self, *args):
+        """Drop the access log line."""
+
+
+class ThreadingWsgiStub(socketserver.ThreadingMixIn, WSGIServer):
+    """Local WSGI server with a thread per request, as a threaded worker."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, application):
+        """Listen on a free local port."""
+        WSGIServer.__init__(self, ('127.0.0.1', 0), QuietRequestHandler)
+        self.set_app(application)
+
+    def __enter__(self):
+        """Serve from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+def bench_login_storm(logins=16, seconds=5, rounds=None):
+    """Time a users page while logins hash their passwords, inline and pooled.
+
+    A local threaded server answers /login by checking a bcrypt password
+    and /users with a page of users as JSON. Logins clients post to /login
+    back to back while one client times /users every 20 ms.
+    """
+    from src import app
+    from src.users.hashing import (PasswordPool, PasswordPoolBusy, checkpw,
+                                   encode, hashpw)
+    rounds = rounds or app.config.get('BCRYPT_LOG_ROUNDS', 12)
+    password = encode('correct horse')
+    pw_hash = hashpw(password, rounds)
+    page = list(user_table_rows(app.config.get('TABLE_PAGE_SIZE', 50)))
+    pool = PasswordPool(app.config.get('PASSWORD_POOL_WORKERS', 2),
+                        app.config.get('PASSWORD_POOL_PENDING', 16),
+                        app.config.get('PASSWORD_TIMEOUT', 5))
+
+    def serve(check):
+        def application(environ, start_response):
+            status = '200 OK'
+            if environ['PATH_INFO'] == '/login':
+                try:
+                    body = b'ok' if check() else b'wrong'
+                except PasswordPoolBusy:
+                    status, body = '503 Service Unavailable', b'busy'
+            else:
+                body = json.dumps(page, default=str).encode('utf-8')
+            start_response(status, [('Content-Type', 'text/plain'),
+                                    ('Content-Length', str(len(body)))])
+            return [body]
+        return application
+
+    def storm(url, stop, counts):
+        while not stop.is_set():
+            try:
+                urllib.request.urlopen(url + '/login', b'').read()
+                key = 'done'
+            except urllib.error.HTTPError:
+                key = 'busy'
+            with lock:
+                counts[key] += 1
+
+    def probe(url):
+        latencies = []
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            start = time.time()
+            urllib.request.urlopen(url + '/users').read()
+            latencies.append(time.time() - start)
+            time.sleep(0.02)
+        return sorted(latencies)
+
+    lock = threading.Lock()
+    print('{} login clients for {} s, {} rounds, {} hashing processes'.format(
+        logins, seconds, rounds, pool.size))
+    print('  {:<16} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(
+        '', 'p50 ms', 'p95 ms', 'max ms', 'logins', 'busy'))
+    for label, check, clients in [
+            ('no logins', None, 0),
+            ('inline bcrypt', lambda: checkpw(password, pw_hash), logins),
+            ('password pool', lambda: pool.check_password(pw_hash,
+                                                          'correct horse'),
+             logins)]:
+        counts = {'done': 0, 'busy': 0}
+        stop = threading.Event()
+        with ThreadingWsgiStub(serve(check)) as server:
+            url = 'http://127.0.0.1:{}'.format(server.server_port)
+            threads = [threading.Thread(target=storm, args=(url, stop, counts))
+                       for n in range(clients)]
+            for thread in threads:
+                thread.start()
+            latencies = probe(url)
+            stop.set()
+            for thread in threads:
+                thread.join()
+        print('  {:<16} {:>9.1f} {:>9.1f} {:>9.1f} {:>7} {:>7}'.format(
+            label, latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3,
+            latencies[-1] * 1e3, counts['done'], counts['busy']))
+    pool.close()
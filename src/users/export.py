@@ -0,0 +1,128 @@
+"""Streaming exports of the users, their roles and the role menu grants.
+
+Each export is a projected query read with yield_per, so on PostgreSQL the
+rows come from a server side cursor EXPORT_CHUNK_ROWS at a time, and is
+encoded as CSV or as a JSON array one chunk of text per EXPORT_CHUNK_ROWS
+rows. Neither the rows nor the output are ever held whole, whether they go
+out as a chunked HTTP response or into a file from manage.py.
+"""
+
+import csv
+import io
+import json
+from collections import namedtuple, OrderedDict
+from datetime import date
+from itertools import groupby
+from operator import itemgetter
+from src import app, db
+from src.navigation.models import Menu as menu
+from src.navigation.permissions import ACTIONS
+from .models import User as usr, Role as rol
+from .models import UserRole as usr_rol, RoleMenu as rol_menu
+
+Export = namedtuple('Export', ['fields', 'rows', 'pages'])
+
+FORMATS = {'csv': 'text/csv', 'json': 'application/json'}
+
+
+def chunk_rows():
+    """Return the number of rows read and written at a time."""
+    return app.config.get('EXPORT_CHUNK_ROWS', 1000)
+
+
+def user_roles():
+    """Yield each user with the names of their active roles.
+
+    The users come in user_id order, one joined row per role, and are
+    folded back into one row per user as they stream past.
+    """
+    query = db.session.query(
+        usr.user_id, usr.user_name, usr.first_name, usr.last_name,
+        usr.email, usr.is_active, usr.is_confirmed, usr.created_datetime,
+        usr.login_datetime, rol.role_name
+    ).outerjoin(usr_rol, (usr_rol.user_id == usr.user_id) &
+                (usr_rol.is_active == True)
+    ).outerjoin(rol, rol.role_id == usr_rol.role_id
+    ).order_by(usr.user_id, rol.role_name).yield_per(chunk_rows())
+    for user, rows in groupby(query, key=itemgetter(slice(0, -1))):
+        yield user + ([row[-1] for row in rows if row[-1] is not None],)
+
+
+def role_menu_grants():
+    """Yield one row per action each role is granted on a menu."""
+    flags = [getattr(rol_menu, 'can_' + action) for action in ACTIONS]
+    query = db.session.query(
+        rol.role_name, menu.menu_name, menu.menu_url, rol_menu.is_active,
+        *flags
+    ).join(rol_menu, rol_menu.role_id == rol.role_id
+    ).join(menu, menu.menu_id == rol_menu.menu_id
+    ).order_by(rol.role_name, menu.menu_name).yield_per(chunk_rows())
+    for row in query:
+        for action, granted in zip(ACTIONS, row[4:]):
+            if granted:
+                yield row[:3] + (action, row[3])
+
+
+EXPORTS = OrderedDict([
+    ('users', Export(('user_id', 'user_name', 'first_name', 'last_name',
+                      'email', 'is_active', 'is_confirmed',
+                      'created_datetime', 'login_datetime', 'roles'),
+                     user_roles, ('users.users_processing',))),
+    ('grants', Export(('role_name', 'menu_name', 'menu_url', 'action',
+                       'is_active'),
+                      role_menu_grants, ('navigation.menus_management',))),
+])
+
+
+def csv_value(value):
+    """Write lists as ';' separated names and None as an empty cell."""
+    if isinstance(value, list):
+        return ';'.join(value)
+    return value
+
+
+def json_value(value):
+    """Write dates and datetimes in ISO format."""
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def csv_chunks(fields, rows):
+    """Encode rows as CSV, one chunk of text per EXPORT_CHUNK_ROWS rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    size = chunk_rows()
+    count = 0
+    for row in rows:
+        writer.writerow([csv_value(value) for value in row])
+        count += 1
+        if count % size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def json_chunks(fields, rows):
+    """Encode rows as a JSON array of objects, chunked as csv_chunks."""
+    encode = json.JSONEncoder(default=json_value).encode
+    size = chunk_rows()
+    parts = ['[']
+    separator = '\n'
+    for count, row in enumerate(rows, 1):
+        parts.append(separator + encode(OrderedDict(zip(fields, row))))
+        separator = ',\n'
+        if count % size == 0:
+            yield ''.join(parts)
+            parts = []
+    parts.append('\n]\n')
+    yield ''.join(parts)
+
+
+def export_chunks(name, fmt):
+    """Stream an export in a format as chunks of text."""
+    export = EXPORTS[name]
+    encoder = csv_chunks if fmt == 'csv' else json_chunks
+    return encoder(export.fields, export.rows())
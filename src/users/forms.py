@@ -1,10 +1,11 @@
 """Contains all the forms for instrument outstanding shares upload."""
 
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, SelectField, PasswordField, BooleanField
 from wtforms import HiddenField, SubmitField
 from wtforms.validators import DataRequired, Email, length, EqualTo, Optional
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
+from src.navigation.fields import TypeaheadField
 
 
 class EmailForm(FlaskForm):
@@ -35,14 +36,26 @@ class UserDetailsForm(FlaskForm):
                                       render_kw={'class': ' btn btn-primary'})
 
 
+class ImportUsersForm(FlaskForm):
+    """Form to upload a CSV of users to import."""
+
+    users_file = FileField('Users CSV',
+                           validators=[FileRequired(),
+                                       FileAllowed(['csv'], 'CSV files only')],
+                           render_kw={'class': 'form-control'})
+    submit_import = SubmitField('Import Users',
+                                render_kw={'class': ' btn btn-primary'})
+
+
 class AssignRoleForm(FlaskForm):
     """Form to specify new assigned role."""
 
     role_user_name = HiddenField('User Name', validators=[DataRequired()],
                                  render_kw={'class': 'form-control'})
-    role = QuerySelectField(label=u"Available Roles", allow_blank=False,
-                            validators=[DataRequired()],
-                            render_kw={'class': 'form-control'})
+    role = TypeaheadField(label=u"Available Roles",
+                          picker='assignable_roles',
+                          validators=[DataRequired()],
+                          render_kw={'class': 'form-control'})
     submit_assign = SubmitField('Assign This Role',
                                 render_kw={'class': ' btn btn-success'})
 
@@ -0,0 +1,134 @@
+"""Bounded pool of processes hashing and checking passwords.
+
+A bcrypt hash at BCRYPT_LOG_ROUNDS = 12 is about a quarter of a second of
+CPU. Computed in the request, a burst of logins keeps every core busy and
+slows down every other page. Here the hashes are computed by at most
+PASSWORD_POOL_WORKERS processes, while the request thread only waits on
+the future, so the CPU given to hashing is bounded and the cores left
+serve the other requests.
+
+At most PASSWORD_POOL_PENDING hashes are queued or running per web
+process. A request waits up to PASSWORD_TIMEOUT seconds for room and for
+its hash, then gets PasswordPoolBusy, so a login storm is turned away
+instead of piling up. PASSWORD_POOL_WORKERS = 0 hashes in the request.
+
+Hashes are the ones Flask-Bcrypt makes, and check the same way.
+"""
+
+import atexit
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+from src import app
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when a password could not be hashed in time."""
+
+
+def encode(password):
+    """Return a password as bytes, prehashed as Flask-Bcrypt would."""
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    if app.config.get('BCRYPT_HANDLE_LONG_PASSWORDS', False):
+        password = hashlib.sha256(password).hexdigest().encode('utf-8')
+    return password
+
+
+def hashpw(password, rounds):
+    """Hash an encoded password with a new salt."""
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def checkpw(password, pw_hash):
+    """Check an encoded password, an unset or malformed hash never matches."""
+    try:
+        return bcrypt.checkpw(password, pw_hash)
+    except ValueError:
+        return False
+
+
+class PasswordPool(object):
+    """Run the password hashes in a fixed number of processes."""
+
+    def __init__(self, workers=2, pending=16, timeout=5):
+        """Set up a pool, its processes start with the first hash."""
+        self.size = workers
+        self.pending = pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._slots = None
+
+    def _start(self):
+        """Start the executor, again in a forked process without it."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ProcessPoolExecutor(self.size)
+            self._slots = threading.BoundedSemaphore(self.pending)
+            self._pid = os.getpid()
+
+    def _restart(self, executor):
+        """Replace an executor whose processes died."""
+        with self._lock:
+            if self._executor is executor:
+                self._pid = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        """Return fn(*args) computed in the pool, waiting timeout seconds."""
+        if not self.size:
+            return fn(*args)
+        if self._pid != os.getpid():
+            self._start()
+        deadline = time.time() + self.timeout
+        slots, executor = self._slots, self._executor
+        if not slots.acquire(timeout=self.timeout):
+            raise PasswordPoolBusy('no room for another password hash')
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self._restart(executor)
+            raise PasswordPoolBusy('password hashing processes died')
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(max(0, deadline - time.time()))
+        except TimeoutError:
+            future.cancel()
+            raise PasswordPoolBusy('password hash took too long')
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise PasswordPoolBusy('password hashing processes died')
+
+    def hash_password(self, password):
+        """Return the bcrypt hash of a plaintext password."""
+        return self.run(hashpw, encode(password),
+                        app.config.get('BCRYPT_LOG_ROUNDS', 12))
+
+    def check_password(self, pw_hash, password):
+        """Tell whether a plaintext password matches a saved hash."""
+        if not pw_hash:
+            return False
+        if isinstance(pw_hash, str):
+            pw_hash = pw_hash.encode('utf-8')
+        return self.run(checkpw, encode(password), bytes(pw_hash))
+
+    def close(self):
+        """Stop the processes once the running hashes are done."""
+        if self._pid != os.getpid():
+            return
+        self._executor.shutdown()
+        self._pid = None
+
+
+pool = PasswordPool(app.config.get('PASSWORD_POOL_WORKERS', 2),
+                    app.config.get('PASSWORD_POOL_PENDING', 16),
+                    app.config.get('PASSWORD_TIMEOUT', 5))
+atexit.register(pool.close)
@@ -0,0 +1,186 @@
+"""Bulk import of users, with their roles, from CSV.
+
+The CSV needs user_name, first_name, last_name and email columns, and may
+give is_active and roles, the names of assignable roles separated by ';'
+as the users export writes them. Other columns are ignored, so an export
+can be imported again elsewhere.
+
+Rows are read IMPORT_CHUNK_ROWS at a time. Each chunk is validated in a
+few set based queries, then its users and their roles are inserted with
+one executemany statement each and committed, so a failing chunk does not
+undo the chunks before it. Invalid rows are skipped and reported by line.
+"""
+
+import csv
+import re
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+from sqlalchemy.exc import IntegrityError
+from src import app, db
+from src.navigation import search
+from .models import User as usr, Role as rol, UserRole as usr_rol
+
+REQUIRED = ('user_name', 'first_name', 'last_name', 'email')
+LENGTHS = {'user_name': 50, 'first_name': 50, 'last_name': 50, 'email': 255}
+EMAIL = re.compile(r'^.+@([^.@][^@]+)$')
+FLAGS = {'': True, 'true': True, '1': True, 'yes': True, 'active': True,
+         'false': False, '0': False, 'no': False, 'inactive': False}
+
+ImportResult = namedtuple('ImportResult', ['created', 'assigned', 'skipped',
+                                           'errors', 'invitations'])
+Invitation = namedtuple('Invitation', ['full_name', 'email', 'user_name'])
+
+
+def chunk_rows():
+    """Return the number of rows validated and inserted at a time."""
+    return app.config.get('IMPORT_CHUNK_ROWS', 500)
+
+
+def assignable_roles():
+    """Map the names of the roles an import may assign to their ids."""
+    picker = search.PICKERS['assignable_roles']
+    return dict(db.session.query(rol.role_name, rol.role_id).filter(
+        *[getattr(rol, column) == value for column, value in picker.where]))
+
+
+def read_rows(lines):
+    """Yield the (line number, row) pairs of a CSV, checking its header."""
+    reader = csv.DictReader(lines)
+    missing = [name for name in REQUIRED
+               if name not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError('missing columns: ' + ', '.join(missing))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def check_row(row, roles):
+    """Return the cleaned values and role ids of a row, or its problem."""
+    values = dict((name, (row.get(name) or '').strip()) for name in REQUIRED)
+    for name in REQUIRED:
+        if not values[name]:
+            return None, '{} is required'.format(name)
+        if len(values[name]) > LENGTHS[name]:
+            return None, '{} is longer than {} characters'.format(
+                name, LENGTHS[name])
+    if not EMAIL.match(values['email']):
+        return None, 'invalid email {}'.format(values['email'])
+    active = (row.get('is_active') or '').strip().lower()
+    if active not in FLAGS:
+        return None, 'invalid is_active {}'.format(row['is_active'])
+    values['is_active'] = FLAGS[active]
+    role_ids = []
+    for name in (row.get('roles') or '').split(';'):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in roles:
+            return None, 'unknown role {}'.format(name)
+        if roles[name] not in role_ids:
+            role_ids.append(roles[name])
+    return (values, role_ids), None
+
+
+def existing(column, keys):
+    """Return those of some keys already saved in a column."""
+    if not keys:
+        return set()
+    return set(key for key, in db.session.query(column).filter(
+        column.in_(keys)))
+
+
+def validate_chunk(chunk, roles, seen_names, seen_emails, errors):
+    """Return the rows of a chunk that can be inserted.
+
+    The problems of the others are appended to errors as (line, message).
+    """
+    checked = []
+    for line, row in chunk:
+        result, problem = check_row(row, roles)
+        if problem:
+            errors.append((line, problem))
+        else:
+            checked.append((line,) + result)
+    taken_names = existing(usr.user_name,
+                           [values['user_name'] for line, values, role_ids
+                            in checked])
+    taken_emails = existing(usr.email, [values['email'] for line, values,
+                                        role_ids in checked])
+    valid = []
+    for line, values, role_ids in checked:
+        name, email = values['user_name'], values['email']
+        if name in taken_names or name in seen_names:
+            errors.append((line, 'user name {} already exists'.format(name)))
+        elif email in taken_emails or email in seen_emails:
+            errors.append((line, 'email {} already exists'.format(email)))
+        else:
+            seen_names.add(name)
+            seen_emails.add(email)
+            valid.append((line, values, role_ids))
+    return valid
+
+
+def insert_chunk(rows, created_by):
+    """Insert the users of a chunk and their roles, returning the role count.
+
+    The inserted users are reported to the search indexes, which the unit
+    of work cannot see. New users have no cached role sets to invalidate.
+    """
+    now = datetime.now()
+    users = [dict(values, created_datetime=now, confirmation_sent_at=now,
+                  created_by=created_by) for line, values, role_ids in rows]
+    db.session.execute(usr.__table__.insert(), users)
+    user_ids = dict(db.session.query(usr.user_name, usr.user_id).filter(
+        usr.user_name.in_([user['user_name'] for user in users])))
+    user_roles = [dict(user_id=user_ids[values['user_name']],
+                       role_id=role_id, created_by=created_by,
+                       created_datetime=now)
+                  for line, values, role_ids in rows for role_id in role_ids]
+    if user_roles:
+        db.session.execute(usr_rol.__table__.insert(), user_roles)
+    tracked = search.tracked_columns(usr)
+    for user in users:
+        search.record_change(db.session, usr, user_ids[user['user_name']],
+                             dict((name, user[name]) for name in tracked))
+    return len(user_roles)
+
+
+def import_users(lines, created_by=None, max_errors=None):
+    """Import the users of a CSV, chunk by chunk.
+
+    Return the counts of created users, assigned roles and skipped rows,
+    the first max_errors (line, message) problems, and an Invitation per
+    created user to send the confirmation emails to.
+    """
+    max_errors = max_errors or app.config.get('IMPORT_MAX_ERRORS', 1000)
+    roles = assignable_roles()
+    rows = read_rows(lines)
+    seen_names, seen_emails = set(), set()
+    created = assigned = skipped = 0
+    errors = []
+    invitations = []
+    while True:
+        chunk = list(islice(rows, chunk_rows()))
+        if not chunk:
+            break
+        problems = []
+        valid = validate_chunk(chunk, roles, seen_names, seen_emails,
+                               problems)
+        if valid:
+            try:
+                assigned += insert_chunk(valid, created_by)
+                db.session.commit()
+            except IntegrityError as e:
+                db.session.rollback()
+                problems.extend((line, 'chunk not imported: {}'.format(
+                    e.orig)) for line, values, role_ids in valid)
+                valid = []
+        created += len(valid)
+        skipped += len(chunk) - len(valid)
+        errors.extend(sorted(problems)[:max_errors - len(errors)])
+        invitations.extend(Invitation(
+            values['first_name'] + ' ' + values['last_name'],
+            values['email'], values['user_name'])
+            for line, values, role_ids in valid)
+    return ImportResult(created, assigned, skipped, errors, invitations)
@@ -0,0 +1,174 @@
+"""Bounded pool of threads sending the queued emails.
+
+Messages wait in a queue of at most MAIL_QUEUE_SIZE entries for one of
+MAIL_POOL_WORKERS threads. A worker takes the messages waiting, up to
+MAIL_BATCH_SIZE of them, and sends them all over one mail.connect()
+connection, so a burst of emails costs a handshake per batch rather than a
+thread and a handshake per message. A message failing to send drops that
+connection; the rest of the batch goes over a new one.
+
+When the queue is full senders wait up to MAIL_QUEUE_TIMEOUT seconds for
+room, then get queue.Full, so a flood of emails slows the requests sending
+them down instead of piling up in memory.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from src import app, mail
+
+logger = logging.getLogger(__name__)
+
+MailStats = namedtuple('MailStats', [
+    'queued', 'max_queued', 'workers', 'sent', 'failed', 'batches',
+    'connections', 'avg_wait_ms', 'avg_send_ms', 'max_send_ms'])
+
+_STOP = object()
+
+
+class MailPool(object):
+    """Send queued messages from a fixed number of worker threads."""
+
+    def __init__(self, workers=4, queue_size=1000, batch_size=50,
+                 put_timeout=5):
+        """Set up a pool, its threads start with the first message."""
+        self.size = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._threads = []
+        self._reset_stats()
+
+    def _reset_stats(self):
+        """Zero the counters reported by stats."""
+        self._max_queued = 0
+        self._sent = 0
+        self._failed = 0
+        self._batches = 0
+        self._connections = 0
+        self._wait = 0.0
+        self._send = 0.0
+        self._max_send = 0.0
+
+    def _start(self):
+        """Start the workers, again in a forked process without them."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.queue_size)
+            self._threads = [threading.Thread(target=self._run,
+                                              name='mail-%d' % n)
+                             for n in range(self.size)]
+            self._reset_stats()
+            for thread in self._threads:
+                thread.daemon = True
+                thread.start()
+
+    def submit(self, msg, timeout=None):
+        """Queue a message, waiting for room when the queue is full.
+
+        The wait is bounded by timeout seconds, put_timeout when None, and
+        unbounded when 0.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        if timeout is None:
+            timeout = self.put_timeout
+        self._queue.put((time.time(), msg), timeout=timeout or None)
+        queued = self._queue.qsize()
+        if queued > self._max_queued:
+            self._max_queued = queued
+
+    def submit_all(self, messages):
+        """Queue many messages, waiting as long as it takes for room."""
+        for msg in messages:
+            self.submit(msg, timeout=0)
+
+    def _run(self):
+        """Send batches of queued messages until told to stop."""
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            with app.app_context():
+                self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        """Send a batch over one connection, opening a new one on failure."""
+        pending = list(reversed(batch))
+        with self._lock:
+            self._batches += 1
+        while pending:
+            try:
+                with mail.connect() as conn:
+                    with self._lock:
+                        self._connections += 1
+                    while pending:
+                        queued_at, msg = pending[-1]
+                        start = time.time()
+                        msg.send(conn)
+                        pending.pop()
+                        self._record(start - queued_at, time.time() - start)
+            except Exception:
+                queued_at, msg = pending.pop()
+                logger.exception('Could not send email to %s',
+                                 ', '.join(msg.send_to))
+                with self._lock:
+                    self._failed += 1
+
+    def _record(self, wait, send):
+        """Count a sent message and how long it waited and took."""
+        with self._lock:
+            self._sent += 1
+            self._wait += wait
+            self._send += send
+            if send > self._max_send:
+                self._max_send = send
+
+    def stats(self):
+        """Return the queue depth and the send counts and latencies."""
+        with self._lock:
+            sent = self._sent or 1
+            return MailStats(
+                self._queue.qsize() if self._queue else 0, self._max_queued,
+                len(self._threads), self._sent, self._failed, self._batches,
+                self._connections, round(self._wait * 1000 / sent, 1),
+                round(self._send * 1000 / sent, 1),
+                round(self._max_send * 1000, 1))
+
+    def close(self, timeout=30):
+        """Send the queued messages and stop the workers."""
+        if self._pid != os.getpid():
+            return
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        self._pid = None
+
+
+pool = MailPool(app.config.get('MAIL_POOL_WORKERS', 4),
+                app.config.get('MAIL_QUEUE_SIZE', 1000),
+                app.config.get('MAIL_BATCH_SIZE', 50),
+                app.config.get('MAIL_QUEUE_TIMEOUT', 5))
+atexit.register(pool.close)
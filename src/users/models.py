@@ -3,7 +3,8 @@
 from datetime import datetime
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
-from src import db, bcrypt
+from src import db
+from . import hashing
 
 
 class User(db.Model):
@@ -14,7 +15,11 @@ class User(db.Model):
     user_name = db.Column(db.String(50), nullable=False, unique=True)
     user_password = db.Column(db.Binary(60), nullable=False, server_default='')
     roles = db.relationship('Role', secondary='sec_users_roles',
-                            backref=db.backref('roles', lazy='dynamic'))
+                            primaryjoin='and_(User.user_id == '
+                                        'UserRole.user_id, '
+                                        'UserRole.is_active == True)',
+                            secondaryjoin='Role.role_id == UserRole.role_id',
+                            viewonly=True)
     first_name = db.Column(db.String(50), nullable=False)
     last_name = db.Column(db.String(50), nullable=False)
     email = db.Column(db.String(255), nullable=False, unique=True)
@@ -53,16 +58,16 @@ class User(db.Model):
     @password.setter
     def set_password(self, plaintext_password):
         """Save the hash for the plaintext password provided by the users."""
-        self.user_password = bcrypt.generate_password_hash(plaintext_password)
+        self.user_password = hashing.pool.hash_password(plaintext_password)
 
     def is_correct_password(self, plaintext_password):
         """Check password hash.
 
         Check if the hash for the plaintext password matches the user hashed
-        password.
+        password. The hashing runs in the password pool, see hashing.
         """
-        return bcrypt.check_password_hash(self.user_password,
-                                          plaintext_password)
+        return hashing.pool.check_password(self.user_password,
+                                           plaintext_password)
 
     def get_id(self):
         """Return the email address to satisfy Flask-Login's requirements."""
@@ -103,6 +108,16 @@ class Role(db.Model):
         self.created_by = created_by
         self.created_datetime = datetime.now()
 
+    @property
+    def active_users(self):
+        """Return a query of the users holding the role, read only.
+
+        The reverse of User.roles, following active assignments only.
+        """
+        return User.query.join(UserRole, UserRole.user_id == User.user_id) \
+            .filter(UserRole.role_id == self.role_id,
+                    UserRole.is_active == True)
+
     def __repr__(self):
         """Represent an instance of the class."""
         return self.role_name
@@ -123,7 +138,9 @@ class UserRole(db.Model):
     modified_by = db.Column(db.Integer)
     last_modified_datetime = db.Column(db.DateTime, nullable=True)
     __table_args__ = (UniqueConstraint('user_role_id',
-                                       name='UK_state_user_role'),)
+                                       name='UK_state_user_role'),
+                      UniqueConstraint('user_id', 'role_id',
+                                       name='sec_users_roles_user_role_key'))
 
     def __init__(self, user_id, role_id, created_by):
         """Create a new user role."""
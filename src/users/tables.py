@@ -1,7 +1,6 @@
 """Build Instruments Related Tables."""
 
-from flask_table import Table, Col, LinkCol, BoolCol, DatetimeCol, DateCol
-from flask import url_for
+from src.navigation.render import Table, Col, LinkCol, BoolCol
 
 
 class UserDetailsTable(Table):
@@ -36,15 +35,7 @@ class UserDetailsTable(Table):
         Col('Last Password Change',
             allow_sort=True, td_html_attrs={'style': 'font-size:12px'})
     allow_sort = True
-
-    def sort_url(self, col_key, reverse=False):
-        """Process sort url for the columns of the tables."""
-        if reverse:
-            direction = 'desc'
-        else:
-            direction = 'asc'
-        return url_for('users.users_processing',
-                       sort=col_key, direction=direction)
+    sort_endpoint = 'users.users_processing'
 
 
 class RolesDetailsTable(Table):
@@ -68,15 +59,7 @@ class RolesDetailsTable(Table):
     last_modified_datetime = Col('Role Modified', allow_sort=True,
                                  td_html_attrs={'style': 'font-size:12px'})
     allow_sort = True
-
-    def sort_url(self, col_key, reverse=False):
-        """Process sort url for the columns of the tables."""
-        if reverse:
-            direction = 'desc'
-        else:
-            direction = 'asc'
-        return url_for('users.users_processing', sort=col_key,
-                       direction=direction)
+    sort_endpoint = 'users.roles_processing'
 
 
 class UserRolesTable(Table):
@@ -94,12 +77,4 @@ class UserRolesTable(Table):
     role_description = Col('Role Description', allow_sort=False,
                            td_html_attrs={'style': 'font-size:12px'})
     allow_sort = True
-
-    def sort_url(self, col_key, reverse=False):
-        """Process sort url for the columns of the tables."""
-        if reverse:
-            direction = 'desc'
-        else:
-            direction = 'asc'
-        return url_for('users.users_processing', sort=col_key,
-                       direction=direction)
+    sort_endpoint = 'users.users_processing'
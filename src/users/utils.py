@@ -1,54 +1,101 @@
 """Utility Functions for user module."""
 
 import functools
-from flask import render_template, url_for, jsonify, session, redirect
+import logging
+import queue
+from collections import namedtuple
+from datetime import datetime
+from flask import render_template, url_for, jsonify, redirect, request
 from flask_login import current_user
 from flask_mail import Message
 
 from threading import Thread
 from itsdangerous import URLSafeTimedSerializer
-from sqlalchemy import or_, and_
+from sqlalchemy import and_, any_, bindparam, exists, literal, Integer
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from src import app, mail, db
-from src.navigation.utils import build_auth_menu_roles
-from . import models
+from src.navigation import paging, permissions, search
+from . import models, mailer
+from .models import User as usr
 from .models import Role as rol
 from .models import UserRole as usr_rol
 
+logger = logging.getLogger(__name__)
 
-def send_async_email(msg):
-    """Send generic email using threaded approach."""
-    with app.app_context():
-        mail.send(msg)
+
+def queue_email(msg):
+    """Queue an email for dispatch, False when the mail queue stayed full."""
+    try:
+        mailer.pool.submit(msg)
+    except queue.Full:
+        logger.warning('Mail queue full, email to %s not sent',
+                       ', '.join(msg.send_to))
+        return False
+    return True
 
 
 def send_email(subject, recipients, html_body):
-    """Create Generic Email for dispatch."""
+    """Create Generic Email and queue it for dispatch.
+
+    Return False when it could not be queued.
+    """
     msg = Message(subject, recipients)
     msg.html = html_body
-    thr = Thread(target=send_async_email, args=[msg])
-    thr.start()
+    return queue_email(msg)
 
 
-def send_confirmation_email(full_name, user_email, login_url, username):
-    """Send Confirmation Email for user registration."""
-    confirm_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+def confirmation_message(serializer, full_name, user_email, login_url,
+                         username):
+    """Create the Confirmation Email for user registration."""
     confirm_url = url_for(
         'users.confirm_email',
-        token=confirm_serializer.dumps(user_email,
-                                       salt='email-confirmation-salt'),
+        token=serializer.dumps(user_email, salt='email-confirmation-salt'),
         _external=True)
-    html = render_template(
+    msg = Message('Confirm Your Email Address', [user_email])
+    msg.html = render_template(
         'email_confirmation.html',
         confirm_url=confirm_url,
         name=full_name,
         login_url=login_url,
         username=username
         )
-    send_email('Confirm Your Email Address', [user_email], html)
+    return msg
+
+
+def send_confirmation_email(full_name, user_email, login_url, username):
+    """Send Confirmation Email for user registration.
+
+    Return False when it could not be queued.
+    """
+    confirm_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+    return queue_email(confirmation_message(confirm_serializer, full_name,
+                                            user_email, login_url, username))
+
+
+def send_confirmation_emails(invitations, base_url):
+    """Send the Confirmation Emails of imported users in the background.
+
+    One thread renders the emails as the mail pool makes room for them,
+    with links under base_url. Return the thread.
+    """
+    def feed():
+        with app.test_request_context(base_url=base_url):
+            serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+            login_url = url_for('users.login')
+            mailer.pool.submit_all(
+                confirmation_message(serializer, full_name, email,
+                                     login_url, user_name)
+                for full_name, email, user_name in invitations)
+    thread = Thread(target=feed, name='confirmation-emails')
+    thread.start()
+    return thread
 
 
 def send_forgotten_password_email(user_name, user_email):
-    """Send Email Request for user forgotten password."""
+    """Send Email Request for user forgotten password.
+
+    Return False when it could not be queued.
+    """
     forgotten_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
     forgotten_url = url_for(
         'users.password_reset',
@@ -58,48 +105,41 @@ def send_forgotten_password_email(user_name, user_email):
     html = render_template(
         'email_forgotten_password.html',
         forgotten_url=forgotten_url, user_name=user_name)
-    send_email('Forgotten Password Reset', [user_email], html)
+    return send_email('Forgotten Password Reset', [user_email], html)
 
 
-def build_users_list(sort, reverse, opt_search):
-    """Build & display a user list.
+class UserRow(namedtuple('UserRow', [
+        'user_id', 'user_name', 'first_name', 'last_name', 'email',
+        'confirmation_sent_at', 'is_confirmed', 'confirmed_at', 'is_active',
+        'created_datetime', 'login_datetime',
+        'password_last_change_datetime'])):
+    """Hold the user columns shown on the users page."""
+
+    __slots__ = ()
+
+    def full_name(self):
+        """Build a full name from First Name & Last Name."""
+        return self.first_name + ' ' + self.last_name
 
-    Display the data sorted by direction and where applicable filtered by
-     search string.
-    """
-    if sort is None:
-        sort = 'user_name'
-        reverse = 'asc'
-    if reverse:
-        reverse = 'desc'
-    else:
-        reverse = 'asc'
-    totalsort = str(str(sort) + ' ' + str(reverse))
-    if opt_search is None:
-        users_list = models.User.query.order_by(totalsort).all()
-    else:
-        search_string = '%' + opt_search + '%'
-        filter_clause1 = (models.User.user_name.like(search_string))
-        filter_clause2 = (models.User.first_name.like(search_string))
-        filter_clause3 = (models.User.last_name.like(search_string))
-        filter_clause4 = (models.User.email.like(search_string))
-        users_list = models.User.query.filter(or_(
-            filter_clause1,
-            filter_clause2,
-            filter_clause3,
-            filter_clause4
-        )).order_by(totalsort).all()
-    return users_list
 
+RoleRow = namedtuple('RoleRow', ['role_id', 'role_name', 'role_description',
+                                 'is_active', 'created_datetime',
+                                 'last_modified_datetime'])
 
-def fetch_role_list():
-    """Build up the role list."""
-    filter_clause1 = rol.is_active == bool(1)
-    filter_clause2 = rol.is_default == bool(0)
-    return rol.query.filter(and_(
-        filter_clause1,
-        filter_clause2
-    )).order_by(rol.role_name).all()
+
+def build_users_list(sort, reverse, opt_search, after=None, before=None):
+    """Build & display a page of the user list.
+
+    Display the data sorted by direction, one keyset page after or before
+     the given user ids, and where applicable filtered by search string.
+     Only the displayed columns are read, as UserRow tuples.
+    """
+    users_list = models.User.query
+    hits = None
+    if opt_search:
+        hits = search.find(models.User, opt_search)
+    return paging.paginate(users_list, models.User, sort, 'user_name',
+                           reverse, after, before, hits, UserRow)
 
 
 def fetch_user_role_list(user):
@@ -115,95 +155,155 @@ def fetch_user_role_list(user):
     return user_role_list
 
 
-def build_roles_list(sort, reverse, opt_search):
-    """Build & display a roles list.
+def build_roles_list(sort, reverse, opt_search, after=None, before=None):
+    """Build & display a page of the roles list.
 
-    Display the data sorted by direction and where applicable filtered by
-     search string.
+    Display the data sorted by direction, one keyset page after or before
+     the given role ids, and where applicable filtered by search string.
+     Only the displayed columns are read, as RoleRow tuples.
     """
-    if sort is None:
-        sort = 'role_name'
-        reverse = 'asc'
-    if reverse:
-        reverse = 'desc'
-    else:
-        reverse = 'asc'
-    totalsort = str(str(sort) + ' ' + str(reverse))
-    if opt_search is None:
-        roles_list = models.Role.query.order_by(totalsort).all()
-    else:
-        search_string = '%' + opt_search + '%'
-        filter_clause1 = (models.Role.role_description.like(search_string))
-        filter_clause2 = (models.Role.role_name.like(search_string))
-        roles_list = models.Role.query.filter(or_(
-            filter_clause1,
-            filter_clause2
-        )).order_by(totalsort).all()
-    return roles_list
+    roles_list = models.Role.query
+    hits = None
+    if opt_search:
+        hits = search.find(models.Role, opt_search)
+    return paging.paginate(roles_list, models.Role, sort, 'role_name',
+                           reverse, after, before, hits, RoleRow)
 
 
-def unassign_user_role(role_name, user_name):
-    """Unassign a role from a user."""
-    user = models.User.query.filter_by(user_name=user_name).first()
-    role = models.Role.query.filter_by(role_name=role_name).first()
-
-    filter_clause1 = models.UserRole.role_id == role.role_id
-    filter_clause2 = models.UserRole.user_id == user.user_id
-    for r in models.UserRole.query.filter(and_(
-        filter_clause1,
-        filter_clause2
-    )).all():
-        r.is_active = False
+def bulk_batches(user_ids):
+    """Split user ids into the batches one statement takes.
+
+    PostgreSQL takes them all as one array parameter, other databases as
+    IN lists of at most 500 ids, under the SQLite parameter limit.
+    """
+    user_ids = sorted(set(user_ids))
+    if db.engine.dialect.name == 'postgresql':
+        return [user_ids] if user_ids else []
+    return [user_ids[i:i + 500] for i in range(0, len(user_ids), 500)]
+
+
+def matches_ids(column, batch):
+    """Match a column to a batch of user ids."""
+    if db.engine.dialect.name == 'postgresql':
+        return column == any_(bindparam(None, batch, type_=ARRAY(Integer)))
+    return column.in_(batch)
+
+
+def assign_role(role_id, user_ids, modified_by):
+    """Assign a role to many users, reactivating revoked assignments.
+
+    On PostgreSQL each batch is one INSERT ... SELECT ... ON CONFLICT on the
+    (user_id, role_id) constraint. Elsewhere it is an UPDATE reactivating
+    the revoked rows and an INSERT of the missing ones, where a concurrent
+    assignment makes the insert fail on the constraint. Ids of missing
+    users are ignored. Return the number of assignments made.
+    """
+    table = usr_rol.__table__
+    now = datetime.now()
+    changed = 0
+    for batch in bulk_batches(user_ids):
+        rows = db.select([usr.user_id, literal(role_id), literal(True),
+                          literal(modified_by, Integer), literal(now)])
+        columns = ['user_id', 'role_id', 'is_active', 'created_by',
+                   'created_datetime']
+        if db.engine.dialect.name == 'postgresql':
+            insert = pg_insert(table).from_select(
+                columns, rows.where(matches_ids(usr.user_id, batch)))
+            insert = insert.on_conflict_do_update(
+                index_elements=['user_id', 'role_id'],
+                set_=dict(is_active=True,
+                          modified_by=insert.excluded.created_by,
+                          last_modified_datetime=insert.excluded
+                          .created_datetime),
+                where=table.c.is_active == False
+            ).returning(table.c.user_id)
+            touched = [user_id for user_id, in db.session.execute(insert)]
+            changed += len(touched)
+        else:
+            changed += db.session.execute(table.update().where(and_(
+                table.c.role_id == role_id,
+                table.c.is_active == False,
+                matches_ids(table.c.user_id, batch)
+            )).values(is_active=True, modified_by=modified_by,
+                      last_modified_datetime=now)).rowcount
+            changed += db.session.execute(table.insert().from_select(
+                columns, rows.where(and_(
+                    matches_ids(usr.user_id, batch),
+                    ~exists().where(and_(table.c.user_id == usr.user_id,
+                                         table.c.role_id == role_id)))))
+            ).rowcount
+            touched = batch
+        for user_id in touched:
+            permissions.record_change(db.session, 'user', user_id)
     db.session.commit()
-    return jsonify(errorstate=0)
+    return changed
 
 
-def is_currently_assigned(role_id, user_id):
-    """Verify if a role is currently assigned to a user and its active."""
-    filter_clause1 = models.UserRole.role_id == role_id
-    filter_clause2 = models.UserRole.user_id == user_id
-    filter_clause3 = models.UserRole.is_active == bool(1)
-    return models.UserRole.query.filter(and_(
-        filter_clause1,
-        filter_clause2,
-        filter_clause3
-    )).first()
+def revoke_role(role_id, user_ids, modified_by):
+    """Revoke a role from many users, one UPDATE per batch.
 
+    Return the number of assignments revoked.
+    """
+    table = usr_rol.__table__
+    now = datetime.now()
+    changed = 0
+    for batch in bulk_batches(user_ids):
+        update = table.update().where(and_(
+            table.c.role_id == role_id,
+            table.c.is_active == True,
+            matches_ids(table.c.user_id, batch)
+        )).values(is_active=False, modified_by=modified_by,
+                  last_modified_datetime=now)
+        if db.engine.dialect.name == 'postgresql':
+            touched = [user_id for user_id, in db.session.execute(
+                update.returning(table.c.user_id))]
+            changed += len(touched)
+        else:
+            changed += db.session.execute(update).rowcount
+            touched = batch
+        for user_id in touched:
+            permissions.record_change(db.session, 'user', user_id)
+    db.session.commit()
+    return changed
 
-def fetch_current_user_roles():
-    """Get the roles that the current user is assigned to."""
-    current_user_roles = list(current_user.roles)
-    if current_user_roles:
-        current_user_roles = [str(r) for r in current_user_roles]
-        return current_user_roles
 
+def unassign_user_role(role_name, user_name):
+    """Unassign a role from a user."""
+    found = db.session.query(usr.user_id, rol.role_id).filter(
+        usr.user_name == user_name, rol.role_name == role_name).first()
+    if found is None:
+        return jsonify(errorstate=1)
+    revoke_role(found.role_id, [found.user_id], current_user.user_id)
+    return jsonify(errorstate=0)
 
-def fetch_url_roles(view_function):
-    """Fetch the roles of the selected url."""
-    my_url = url_for(view_function)
-    if session is None:
-        build_auth_menu_roles()
-    return session['menu_dict'][my_url]
 
+def fetch_current_role_set():
+    """Get the interned role set id of the current user."""
+    return permissions.current_role_set()
 
-def has_required_roles(view_function):
+
+def has_required_roles(view_function, intents=()):
     """Validate whether current user in the authorized role.
 
     Create a decorator function to fetch current user roles.
     Fetch the authorized roles for the url passed in the parameter.
+    The request method and the intents, (form key, action) pairs such as
+    ('submit_assign', 'edit'), decide whether it views, creates, edits or
+    deletes (see permissions.request_action).
     If the user roles are not in the authorized list, redirect to
     unauthorized page.
     """
+    permissions.protect_endpoint(view_function)
+
     def actual_decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             if not current_user:
                 return redirect(url_for('users.login'))
-            user_roles = fetch_current_user_roles()
-            url_roles = fetch_url_roles(view_function)
-            print(user_roles, url_roles)
-            print(session['menu_dict'])
-            auth = any(i in url_roles for i in user_roles)
+            role_set_id = fetch_current_role_set()
+            action = permissions.request_action(request, intents)
+            auth = permissions.is_authorized(role_set_id, view_function,
+                                             action)
             if not auth:
                 return redirect(url_for('users.unauthorized_access'))
             return func(*args, **kwargs)
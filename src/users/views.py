@@ -1,14 +1,18 @@
 """Contain the views of the market indices blueprint."""
+import codecs
 import datetime
 from datetime import datetime
 from sqlalchemy.exc import IntegrityError
 from flask import render_template, Blueprint, request, \
-                    redirect, url_for, flash, session
+                    redirect, url_for, flash, session, abort, Response, \
+                    stream_with_context, jsonify
 from flask_login import logout_user, login_user, current_user, login_required
 from itsdangerous import URLSafeTimedSerializer, BadSignature
 from src import app, db
-from src.navigation.utils import build_auth_menu_roles
-from . import models, forms, utils, tables
+from src.navigation import permissions, search
+from src.navigation.paging import stream_template
+from . import models, forms, utils, tables, export, importer, mailer
+from .hashing import PasswordPoolBusy
 from .utils import has_required_roles
 
 
@@ -22,6 +26,14 @@ def unauthorized_access():
     """Error Handling page to inform user of unauthorized access."""
     return 'unauthorized access'
 
+
+@users_blueprint.errorhandler(PasswordPoolBusy)
+def password_pool_busy(error):
+    """Send the user back to the form when passwords cannot be hashed."""
+    db.session.rollback()
+    flash('Too many password checks right now, please try again.', 'error')
+    return redirect(request.url)
+
 #################################################################
 # Example Usage:                                                #
 @users_blueprint.route('/test', methods=['GET', 'POST'])        #       
@@ -29,7 +41,7 @@ def unauthorized_access():
 @has_required_roles('users.testview')                           #
 def testview():                                                 #
     """Test the required roles process."""                      #
-    return str(build_auth_menu_roles())                         #
+    return str(permissions.current_index().menu_masks)          #
                                                                 #
 #################################################################
 
@@ -53,7 +65,11 @@ def forgottenpassword():
             user = models.User.query.filter_by(email=form.email.data).first()
             if user and user.is_confirmed:
                 full_name = user.first_name + ' ' + user.last_name
-                utils.send_forgotten_password_email(full_name, user.email)
+                if not utils.send_forgotten_password_email(full_name,
+                                                           user.email):
+                    flash('The password change email could not be sent, '
+                          'please try again later.', 'error')
+                    return redirect(url_for('users.forgottenpassword'))
                 msg1 = 'Password change request sent to {} '.format(user.email)
                 msg2 = 'successfully, check for email!'
                 flash(msg1+msg2, 'success')
@@ -77,8 +93,11 @@ def reconfirm_email():
                 full_name = user.first_name + ' ' + user.last_name
                 login_url = url_for('users.login')
                 username = user.user_name
-                utils.send_confirmation_email(full_name, user.email,
-                                              login_url, username)
+                if not utils.send_confirmation_email(full_name, user.email,
+                                                     login_url, username):
+                    flash('The confirmation email could not be sent, please '
+                          'try again later.', 'error')
+                    return redirect(url_for('users.reconfirm_email'))
                 flash('Email confirmation request sent to {} successfully, '
                       'check for email!'
                       .format(user.email), 'success')
@@ -135,6 +154,10 @@ def index():
 
 @users_blueprint.route('/users', methods=['GET', 'POST'])
 @login_required
+@has_required_roles('users.users_processing',
+                    intents=[('my_action=unassign_role', 'delete'),
+                             ('submit_assign', 'edit'),
+                             ('?user_name', 'edit')])
 def users_processing():
     """Process User Details.
 
@@ -146,15 +169,21 @@ def users_processing():
     sort = request.args.get("sort")
     reverse = (request.args.get('direction', 'asc') == 'desc')
     opt_search = request.args.get("search_string")
-    users_list = utils.build_users_list(sort, reverse, opt_search)
-    users_table = tables.UserDetailsTable(users_list, sort_by=sort,
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    users_page = utils.build_users_list(sort, reverse, opt_search, after,
+                                        before)
+    users_table = tables.UserDetailsTable(users_page.rows, sort_by=sort,
                                           sort_reverse=reverse)
     assign_form = forms.AssignRoleForm()
+    import_form = forms.ImportUsersForm()
     user_roles_list = None
     show_roles = "hidden"
     if request.is_xhr:  # Ajax calls
         my_action = request.form['my_action']
         if my_action == 'unassign_role':
+            if not permissions.allows('users.users_processing', 'delete'):
+                abort(403)
             role_name = request.form['role_name']
             user_name = request.form['user_name']
             return utils.unassign_user_role(role_name, user_name)
@@ -167,11 +196,11 @@ def users_processing():
         show_roles = ''
     else:
         form = forms.UserDetailsForm()
-    role_list = utils.fetch_role_list()
-    assign_form.role.query = role_list
     if request.method == 'POST':
         print(request.form)
         if assign_form.submit_assign.data:
+            if not permissions.allows('users.users_processing', 'edit'):
+                return redirect(url_for('users.unauthorized_access'))
             if assign_form.validate_on_submit():
                 try:
                     """db.session.rollback()#Temporary rollback"""
@@ -179,21 +208,13 @@ def users_processing():
                     role_id = assign_form.role.data.role_id
                     user = models.User.query.filter_by(
                         user_name=user_name).first()
-                    my_user_role = utils.is_currently_assigned(role_id,
-                                                               user.user_id)
-                    if my_user_role:
+                    if not utils.assign_role(role_id, [user.user_id],
+                                             current_user.user_id):
                         msg1 = 'User already assigned to selected role'
                         flash(msg1, 'error')
                         flash_errors(assign_form)
                         return redirect(url_for('users.users_processing',
                                                 user_name=user_name))
-                    user_role = (models.UserRole(
-                        user_id=user.user_id,
-                        role_id=role_id,
-                        created_by=current_user.user_id
-                    ))
-                    db.session.add(user_role)
-                    db.session.commit()
                     msg1 = 'User {0} successfully added to the {1} Role.' \
                         .format(user.user_name,
                                 assign_form.role.data.role_name)
@@ -208,6 +229,9 @@ def users_processing():
                 flash_errors(assign_form)
 
         if form.submit_user_details.data:
+            if not permissions.allows('users.users_processing',
+                                      'edit' if opt_user else 'create'):
+                return redirect(url_for('users.unauthorized_access'))
             if form.validate_on_submit():
                 try:
                     if opt_user:
@@ -234,12 +258,15 @@ def users_processing():
                         login_url = url_for('users.login')
                         username = user.user_name
                         user_name = user.user_name
-                        utils.send_confirmation_email(full_name, user.email,
-                                                      login_url, username)
+                        sent = utils.send_confirmation_email(
+                            full_name, user.email, login_url, username)
                         msg1 = 'User {} successfully created! Advise user'\
                             .format(user.user_name)
                         msg2 = ' to confirm their email address.'
                         flash(msg1+msg2, 'success')
+                        if not sent:
+                            flash('The confirmation email could not be sent,'
+                                  ' please resend it later.', 'error')
                     return redirect(url_for('users.users_processing',
                                             user_name=user_name))
 
@@ -248,15 +275,17 @@ def users_processing():
                     flash_errors(form)
             else:
                 flash_errors(form)
-    return render_template('user_details.html', form=form,
-                           users_table=users_table, searchform=searchform,
-                           assign_form=assign_form,
+    return stream_template('user_details.html', form=form,
+                           users_table=users_table, users_page=users_page,
+                           searchform=searchform, assign_form=assign_form,
+                           import_form=import_form,
                            user_roles_list=user_roles_list,
                            show_roles=show_roles)
 
 
 @users_blueprint.route('/users/roles', methods=['GET', 'POST'])
 @login_required
+@has_required_roles('users.roles_processing', intents=[('?role_name', 'edit')])
 def roles_processing():
     """Process Roles Details.
 
@@ -266,8 +295,11 @@ def roles_processing():
     sort = request.args.get("sort")
     reverse = (request.args.get('direction', 'asc') == 'desc')
     opt_search = request.args.get("search_string")
-    roles_list = utils.build_roles_list(sort, reverse, opt_search)
-    roles_table = tables.RolesDetailsTable(roles_list, sort_by=sort,
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    roles_page = utils.build_roles_list(sort, reverse, opt_search, after,
+                                        before)
+    roles_table = tables.RolesDetailsTable(roles_page.rows, sort_by=sort,
                                            sort_reverse=reverse)
 
     opt_role = request.args.get("role_name")
@@ -304,8 +336,106 @@ def roles_processing():
                 flash_errors(form)
         else:
             flash_errors(form)
-    return render_template('role_details.html', form=form,
-                           roles_table=roles_table, searchform=searchform)
+    return stream_template('role_details.html', form=form,
+                           roles_table=roles_table, roles_page=roles_page,
+                           searchform=searchform)
+
+
+@users_blueprint.route('/users/import', methods=['POST'])
+@login_required
+def import_users():
+    """Import users and their roles from an uploaded CSV.
+
+    The users are inserted in chunks, see importer.import_users, and their
+    confirmation emails sent in the background. The user needs to be
+    allowed to create users.
+    """
+    if not all(permissions.authorize_many(
+            permissions.current_role_set(),
+            [('users.users_processing', 'create')])):
+        abort(403)
+    form = forms.ImportUsersForm()
+    if form.validate_on_submit():
+        try:
+            result = importer.import_users(
+                codecs.iterdecode(form.users_file.data.stream, 'utf-8-sig'),
+                current_user.user_id)
+        except ValueError as e:
+            flash('Users not imported, {}'.format(e), 'error')
+        else:
+            if result.invitations:
+                utils.send_confirmation_emails(result.invitations,
+                                               request.url_root)
+            flash('{} users imported with {} roles, {} rows skipped.'
+                  .format(result.created, result.assigned, result.skipped),
+                  'success')
+            for line, message in result.errors[:10]:
+                flash('Line {}: {}'.format(line, message), 'error')
+    else:
+        flash_errors(form)
+    return redirect(url_for('users.users_processing'))
+
+
+@users_blueprint.route('/users/roles/<int:role_id>/members',
+                       methods=['POST'])
+@login_required
+def role_members(role_id):
+    """Assign a role to many users or revoke it from them.
+
+    Take JSON such as {"action": "assign", "user_ids": [3, 7, 12]} and
+    return the number of assignments changed, eg {"changed": 2}. Assigning
+    needs edit and revoking delete access to users_processing, as on the
+    users page, and only assignable roles can be assigned.
+    """
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    user_ids = data.get('user_ids')
+    if action not in ('assign', 'revoke') or not isinstance(user_ids, list) \
+            or not all(isinstance(user_id, int) for user_id in user_ids):
+        abort(400)
+    check = ('users.users_processing',
+             'edit' if action == 'assign' else 'delete')
+    if not all(permissions.authorize_many(permissions.current_role_set(),
+                                          [check])):
+        abort(403)
+    if action == 'assign':
+        if not search.is_offered('assignable_roles', role_id):
+            abort(404)
+        changed = utils.assign_role(role_id, user_ids, current_user.user_id)
+    else:
+        changed = utils.revoke_role(role_id, user_ids, current_user.user_id)
+    return jsonify(changed=changed)
+
+
+@users_blueprint.route('/users/export/<name>.<fmt>')
+@login_required
+def export_access(name, fmt):
+    """Stream the users with their roles, or the role menu grants.
+
+    The export is sent as a chunked download while it is read, eg
+    /users/export/users.csv or /users/export/grants.json. The user needs
+    to be allowed to view one of the pages showing the exported rows.
+    """
+    if name not in export.EXPORTS or fmt not in export.FORMATS:
+        abort(404)
+    if not any(permissions.authorize_many(permissions.current_role_set(),
+                                          export.EXPORTS[name].pages)):
+        abort(403)
+    return Response(
+        stream_with_context(export.export_chunks(name, fmt)),
+        mimetype=export.FORMATS[fmt],
+        headers={'Content-Disposition':
+                 'attachment; filename={}.{}'.format(name, fmt)})
+
+
+@users_blueprint.route('/users/mail_stats')
+@login_required
+def mail_stats():
+    """Report the email queue depth and send latencies of this worker."""
+    if not any(permissions.authorize_many(permissions.current_role_set(),
+                                          ('users.users_processing',))):
+        abort(403)
+    return jsonify(mailer.pool.stats()._asdict())
 
 
 @users_blueprint.route('/confirm/<token>', methods=['GET', 'POST'])
@@ -368,7 +498,6 @@ def login():
                 db.session.add(user)
                 db.session.commit()
                 login_user(user, remember=form.remember_me.data)
-                build_auth_menu_roles()
                 return redirect(url_for('users.index'))
             else:
                 print('invalid form')